@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+"""
+Compare the time and peak memory of `rcsignal.discrete_convolution` with the previous implementation, which padded to
+a power of two and made three full-length copies per call.
+
+The signals are the size of the energy envelopes of an hour-long recording at 10 ms resolution.
+"""
+
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pyfftw
+
+import rcsignal
+
+
+old_fft_cache = {}
+
+
+def discrete_convolution_with_copies(x, h):
+    n_fft_min = len(x) + len(h) - 1
+    n_fft = rcsignal.smallest_power_of_two_greater_than(n_fft_min)
+    if n_fft not in old_fft_cache:
+        rfft_input = pyfftw.empty_aligned(n_fft, dtype='float64')
+        rfft_func = pyfftw.builders.rfft(rfft_input, overwrite_input=True)
+        irfft_input = pyfftw.empty_aligned((n_fft // 2) + 1, dtype='complex128')
+        irfft_func = pyfftw.builders.irfft(irfft_input, overwrite_input=True)
+        old_fft_cache[n_fft] = (rfft_input, rfft_func, irfft_input, irfft_func)
+    rfft_input, rfft_func, irfft_input, irfft_func = old_fft_cache[n_fft]
+    rfft_input[:len(x)] = x
+    rfft_input[len(x):] = 0
+    x_fft = np.copy(rfft_func())
+    rfft_input[:len(h)] = h
+    rfft_input[len(h):] = 0
+    h_fft = rfft_func()
+    irfft_input[:] = np.copy(x_fft * h_fft)
+    return np.copy(irfft_func()[:n_fft_min])
+
+
+def benchmark(label, func, repeats):
+    func()  # plan (and cache) the FFTs outside of the measurement
+    tracemalloc.start()
+    t_start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    elapsed = (time.perf_counter() - t_start) / repeats
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("{:<28} {:8.1f} ms {:8.1f} MiB peak".format(label, elapsed * 1000, peak / 2 ** 20))
+
+
+n_x = int(sys.argv[1]) if len(sys.argv) > 1 else 3600 * 100  # one hour at 10 ms
+n_h = int(sys.argv[2]) if len(sys.argv) > 2 else 3000 * 100  # 50 minutes at 10 ms
+repeats = 5
+
+rng = np.random.default_rng(0)
+x = rng.random(n_x)
+h = rng.random(n_h)
+out = np.empty(n_x + n_h - 1)
+
+print("len(x) = {}, len(h) = {}, power of two = {}, fast length = {}".format(
+    n_x, n_h,
+    rcsignal.smallest_power_of_two_greater_than(n_x + n_h - 1),
+    pyfftw.next_fast_len(n_x + n_h - 1),
+))
+
+benchmark("with copies", lambda: discrete_convolution_with_copies(x, h), repeats)
+benchmark("copy-free", lambda: rcsignal.discrete_convolution(x, h), repeats)
+benchmark("copy-free, out=", lambda: rcsignal.discrete_convolution(x, h, out=out), repeats)
+
+assert np.allclose(discrete_convolution_with_copies(x, h), rcsignal.discrete_convolution(x, h))
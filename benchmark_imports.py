@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+"""
+Measure how long the modules behind the command line scripts take to import, and fail if they got slower.
+
+The scripts are started once per stage in batch runs, so `import rc` should only cost what the stages that build an
+ffmpeg command need. The heavy modules (numpy, scipy, pyfftw, matplotlib, odfpy) are only imported inside the stages
+that use them. This checks that none of them is imported at the top level, which is what usually makes the imports
+slow again, and that each import stays under a time budget.
+
+Each module is imported in a fresh interpreter, a few times, and the fastest time is used, minus the time of an
+interpreter that imports nothing.
+
+    python3 benchmark_imports.py [budget in ms]
+"""
+
+import subprocess
+import sys
+import time
+
+modules = ['rc', 'rcbatch', 'rcplan', 'rcqueue', 'rcprofiles']
+heavy_modules = ['numpy', 'scipy', 'pyfftw', 'matplotlib', 'odf', 'rcsignal']
+repeats = 5
+
+
+def import_time(statement):
+    best = float('inf')
+    for _ in range(repeats):
+        t_start = time.perf_counter()
+        subprocess.check_call([sys.executable, '-c', statement])
+        best = min(best, time.perf_counter() - t_start)
+    return best
+
+
+def heavy_imports(module):
+    output = subprocess.check_output([sys.executable, '-c', 'import sys, {}; print(" ".join(sys.modules))'.format(module)])
+    loaded = output.decode().split()
+    return [m for m in heavy_modules if m in loaded]
+
+
+budget_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 150.
+
+baseline = import_time('pass')
+print("{:<12} {:8.1f} ms".format("(python)", baseline * 1000))
+
+failed = False
+for module in modules:
+    elapsed_ms = (import_time('import ' + module) - baseline) * 1000
+    heavy = heavy_imports(module)
+    problems = []
+    if heavy:
+        problems.append("imports " + ", ".join(heavy))
+    if elapsed_ms > budget_ms:
+        problems.append("over the budget of {:.0f} ms".format(budget_ms))
+    failed = failed or bool(problems)
+    print("{:<12} {:8.1f} ms  {}".format(module, elapsed_ms, "; ".join(problems) or "ok"))
+
+exit(1 if failed else 0)
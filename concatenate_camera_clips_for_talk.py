@@ -4,7 +4,10 @@ import rc
 import sys
 
 talk_name = sys.argv[1]
+smart_cut = '--smart-cut' in sys.argv[2:]
+# e.g. --profile=review
+options = dict(arg[2:].split('=', 1) for arg in sys.argv[2:] if arg.startswith('--profile='))
 
-print("Concatenating camera clips for talk {}".format(talk_name))
+print("Concatenating camera clips for talk {}{}".format(talk_name, " (smart cut)" if smart_cut else ""))
 
-rc.concatenate_camera_clips_for_talk(talk_name)
+rc.concatenate_camera_clips_for_talk(talk_name, smart_cut=smart_cut, **options)
@@ -4,7 +4,10 @@ import rc
 import sys
 
 talk_name = sys.argv[1]
+headless = '--headless' in sys.argv[2:]
 
 print("Extracting microphones audio for talk {}".format(talk_name))
 
-rc.extract_microphones_audio_for_talk(talk_name)
+report = rc.extract_microphones_audio_for_talk(talk_name, interactive=not headless)
+
+print("Delay: {delay} s, confidence: {confidence:.2f}".format(**report))
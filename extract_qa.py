@@ -4,7 +4,9 @@ import rc
 import sys
 
 qa_name = sys.argv[1]
+# e.g. --profile=review
+options = dict(arg[2:].split('=', 1) for arg in sys.argv[2:] if arg.startswith('--profile='))
 
 print("Extracting Q&A session {}".format(qa_name))
 
-rc.extract_qa(qa_name)
+rc.extract_qa(qa_name, **options)
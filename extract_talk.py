@@ -4,7 +4,9 @@ import rc
 import sys
 
 talk_name = sys.argv[1]
+# e.g. --profile=review
+options = dict(arg[2:].split('=', 1) for arg in sys.argv[2:] if arg.startswith('--profile='))
 
 print("Extracting talk {}".format(talk_name))
 
-rc.extract_talk(talk_name)
+rc.extract_talk(talk_name, **options)
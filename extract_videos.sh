@@ -1,5 +1,7 @@
 #!/bin/bash
 
+# To process everything in parallel instead, use: python process_conference.py --jobs 4
+
 # Normal
 #python extract_talk.py howe_popular_atheism
 #python extract_videos.py willenborg_hell
@@ -4,7 +4,9 @@ import rc
 import sys
 
 talk_name = sys.argv[1]
+# e.g. --profile=review
+options = dict(arg[2:].split('=', 1) for arg in sys.argv[2:] if arg.startswith('--profile='))
 
 print("Making slide video for talk {}".format(talk_name))
 
-rc.make_slide_video_for_talk(talk_name)
+rc.make_slide_video_for_talk(talk_name, **options)
@@ -4,7 +4,12 @@ import rc
 import sys
 
 talk_name = sys.argv[1]
+single_pass = '--single-pass' in sys.argv[2:]
+# e.g. --profile=review
+options = dict(arg[2:].split('=', 1) for arg in sys.argv[2:] if arg.startswith('--profile='))
+# e.g. --segments=4, to encode an urgent talk in 4 pieces at the same time
+options.update((k, int(v)) for k, v in (arg[2:].split('=', 1) for arg in sys.argv[2:] if arg.startswith('--segments=')))
 
-print("Making video for talk {}".format(talk_name))
+print("Making video for talk {}{}".format(talk_name, " in a single pass" if single_pass else ""))
 
-rc.make_talk_video(talk_name)
+rc.make_talk_video(talk_name, single_pass=single_pass, **options)
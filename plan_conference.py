@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+
+import rcbatch
+import rcplan
+import rcprofiles
+
+parser = argparse.ArgumentParser(description="Print the commands needed to process the conference, without running "
+                                             "them.")
+parser.add_argument('--talk', action='append', dest='talks', help="Only plan this talk. May be repeated.")
+parser.add_argument('--qa', action='append', dest='qas', help="Only plan this Q&A session. May be repeated.")
+parser.add_argument('--profile', choices=list(rcprofiles.profiles), default=None,
+                    help="The encoder profile for all the video stages. Defaults to each stage's own.")
+parser.add_argument('--stage', action='append', dest='stages', help="Only plan this stage. May be repeated.")
+parser.add_argument('--format', choices=['text', 'json', 'make'], default='text', help="The format of the plan.")
+parser.add_argument('--output', default=None, help="Write the plan to this file instead of the standard output.")
+parser.add_argument('--machines', type=int, default=1,
+                    help="Estimate how long the plan takes when split between this many machines.")
+args = parser.parse_args()
+
+talks = args.talks
+qas = args.qas
+if talks is not None and qas is None:
+    qas = []
+if qas is not None and talks is None:
+    talks = []
+
+jobs = rcbatch.conference_jobs(talks=talks, qas=qas, stages=args.stages, log=sys.stderr)
+specs = rcplan.conference_plan(jobs, profile=args.profile)
+
+if args.format == 'json':
+    plan = rcplan.to_json(specs)
+elif args.format == 'make':
+    plan = rcplan.to_makefile(specs, profile=args.profile)
+else:
+    plan = rcplan.to_text(specs, machines=args.machines)
+
+if args.output is None:
+    print(plan)
+else:
+    with open(args.output, 'w') as f:
+        print(plan, file=f)
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+import argparse
+import rcbatch
+import rcprofiles
+
+parser = argparse.ArgumentParser(description="Process all the talks and Q&A sessions in parallel.")
+parser.add_argument('--jobs', type=int, default=None, help="The number of encodes to run at the same time.")
+parser.add_argument('--threads', type=int, default=None, help="The number of threads for each ffmpeg process.")
+parser.add_argument('--talk', action='append', dest='talks', help="Only process this talk. May be repeated.")
+parser.add_argument('--qa', action='append', dest='qas', help="Only process this Q&A session. May be repeated.")
+parser.add_argument('--profile', choices=list(rcprofiles.profiles), default=None,
+                    help="The encoder profile for all the video stages. Defaults to each stage's own.")
+parser.add_argument('--stage', action='append', dest='stages', help="Only run this stage. May be repeated.")
+args = parser.parse_args()
+
+talks = args.talks
+qas = args.qas
+if talks is not None and qas is None:
+    qas = []
+if qas is not None and talks is None:
+    talks = []
+
+jobs = rcbatch.conference_jobs(talks=talks, qas=qas, stages=args.stages)
+
+print("Processing {} jobs".format(len(jobs)))
+
+results = rcbatch.run_jobs(jobs, max_workers=args.jobs, ffmpeg_threads=args.threads, profile=args.profile)
+
+failed = [job for job, result in results.items() if result != 'done']
+for stage, name in failed:
+    print("Not done: {} for {} ({})".format(stage, name, results[(stage, name)]))
+exit(1 if failed else 0)
@@ -0,0 +1,11 @@
+#!/usr/bin/env python3
+
+import rc
+import sys
+
+talk_name = sys.argv[1]
+
+print("Proposing timings for talk {}".format(talk_name))
+
+for filename in rc.propose_timings_for_talk(talk_name):
+    print("Written {}".format(filename))
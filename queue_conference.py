@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+import argparse
+
+import rcbatch
+import rcprofiles
+import rcqueue
+
+parser = argparse.ArgumentParser(description="Put the talks and Q&A sessions in the shared work queue, for the render "
+                                             "workers (see render_worker.py), or show the state of the queue.")
+parser.add_argument('--queue', default=None, help="The queue database. Defaults to one in the output folder.")
+parser.add_argument('--talk', action='append', dest='talks', help="Only queue this talk. May be repeated.")
+parser.add_argument('--qa', action='append', dest='qas', help="Only queue this Q&A session. May be repeated.")
+parser.add_argument('--profile', choices=list(rcprofiles.profiles), default=None,
+                    help="The encoder profile for all the video stages. Defaults to each stage's own.")
+parser.add_argument('--stage', action='append', dest='stages', help="Only queue this stage. May be repeated.")
+parser.add_argument('--attempts', type=int, default=3, help="How many times to try a job whose ffmpeg command fails.")
+parser.add_argument('--retry-failed', action='store_true', help="Put the jobs that failed or were skipped back.")
+parser.add_argument('--status', action='store_true', help="Only show the jobs in the queue.")
+args = parser.parse_args()
+
+connection = rcqueue.connect(args.queue)
+
+if not args.status:
+    talks = args.talks
+    qas = args.qas
+    if talks is not None and qas is None:
+        qas = []
+    if qas is not None and talks is None:
+        talks = []
+
+    jobs = rcbatch.conference_jobs(talks=talks, qas=qas, stages=args.stages)
+    added = rcqueue.enqueue(connection, jobs, profile=args.profile, max_attempts=args.attempts,
+                            retry_failed=args.retry_failed)
+    print("Queued {} of {} jobs".format(added, len(jobs)))
+
+for job in rcqueue.all_jobs(connection):
+    print("{:<8} {} for {} ({} of {} attempts){}".format(
+        job['state'], job['stage'], job['name'], job['attempts'], job['max_attempts'],
+        ', ' + job['worker'] if job['worker'] else ''))
+print(', '.join('{} {}'.format(n, state) for state, n in sorted(rcqueue.counts(connection).items())))
@@ -1,60 +1,184 @@
-from ODSReader.ODSReader import ODSReader
-import subprocess
 import os
+import contextlib
+import socket
 import functools
-from datetime import datetime, timedelta
-import rcsignal
-import numpy as np
-import matplotlib.pyplot as plt
+import math
+import concurrent.futures
+from fractions import Fraction
+from datetime import timedelta
+import rcfingerprint
+import rcods
+import rcplan
+import rcprogress
+import rcslides
+import rctiming
+from rcrecords import Parameters, Talk, QASession
+from rcmedia import media_length, media_lengths, keyframe_times
+from rcprofiles import get_profile, decode_cost
 import errno
+import glob
+import json
+import time
 
 info_file = 'rc2017.ods'
 
-crf_worst = 51
-crf_default = 23
-crf_visually_lossless = 18
-crf_lossless = 0
+# The number of threads each ffmpeg process may use. None lets ffmpeg decide, which is one thread per core.
+# The batch scheduler lowers this when it runs several encodes at the same time.
+ffmpeg_threads = None
 
+# Every ffmpeg command appends a line with its speed, CPU time and memory to this file (see `rcprogress`). None puts it
+# in the output folder.
+metrics_file = None
 
-def extract_microphones_audio_for_talk(name):
-    parameters = get_parameters()
-    talk_info = load_talk_info(name)
+# The sample rate of the camera audio used to sync the cameras of a Q&A session, which is plenty to find the delay to
+# well within a frame
+qa_sync_sample_rate = 16000
 
-    # Extract the audio from the camera video
-    camera_wav_filename = extract_camera_audio_for_talk(talk_info['name'])
 
-    # Calculate the delay where the audio from the camera matches the audio from the microphones
-    t_corr, corr = rcsignal.correlate_audio_files(
-        talk_info['original_audio_file'],
+def extract_microphones_audio_for_talk(name, force=False, interactive=True, min_confidence=.4, on_low_confidence='raise',
+                                       dry_run=False):
+    """
+    Extract the part of the microphones recording that matches the camera video.
+
+    The delay is found by correlating the microphones audio with the camera audio. A sync report is written next to the
+    output: a plot of the correlation (`<name>_mics_sync.png`) and a JSON file (`<name>_mics_sync.json`) with the
+    delay, the ratio of the highest correlation peak to the second highest (null if there is no second peak), a
+    confidence between 0 and 1, and the time spent in each stage.
+
+    :param name: The name of the talk as it appears in the spreadsheet.
+
+    :param force: Extract the audio even if none of its inputs have changed since the last time.
+
+    :param interactive: Also show the plot in a window, and wait for it to be closed before extracting the audio. Turn
+        this off for unattended (batch) runs.
+
+    :param min_confidence: The confidence below which the sync is considered unreliable.
+
+    :param on_low_confidence: What to do when the confidence is too low: 'raise' a RuntimeError before extracting the
+        audio, or 'flag' it in the report and carry on.
+
+    :param dry_run: Only plan the commands. The delay is only known once the audio is correlated, so the plan for this
+        stage is a call to this function.
+
+    :return: The report, as a dictionary, or a list of `rcplan.CommandSpec` for a dry run.
+
+    """
+    talk = load_talk(name)
+    if talk.original_audio_file is None:
+        raise ValueError("Row {!r} in the talks sheet: original_audio_file is missing, so there is no microphones "
+                         "recording to extract.".format(name))
+    report = {'name': name, 'elapsed': {}}
+
+    mics_wav_filename = os.path.join(get_output_dir(name), '{}_mics_audio.wav'.format(name))
+    report_filename = os.path.join(get_output_dir(name), '{}_mics_sync.json'.format(name))
+    plot_filename = os.path.join(get_output_dir(name), '{}_mics_sync.png'.format(name))
+
+    if dry_run:
+        specs = extract_camera_audio_for_talk(talk.name, force=force, dry_run=True)
+        camera_wav_filename = os.path.join(get_output_dir(name), '{}_camera.wav'.format(name))
+        fingerprint = _mics_audio_fingerprint(talk, camera_wav_filename)
+        if specs or not is_up_to_date(mics_wav_filename, fingerprint, force, dry_run=True):
+            specs.append(command_spec(
+                'extract_microphones_audio_for_talk', name,
+                rcplan.python_argv('extract_microphones_audio_for_talk', name,
+                                   interactive=False, min_confidence=min_confidence,
+                                   on_low_confidence=on_low_confidence),
+                inputs=[talk.original_audio_file, camera_wav_filename],
+                outputs=[mics_wav_filename, report_filename, plot_filename],
+                duration_ms=get_talk_duration(name),
+                cost_per_second=rcplan.analysis_cost_per_second,
+            ))
+        return specs
+
+    # Extract the audio from the camera video
+    t_start = time.time()
+    camera_wav_filename = extract_camera_audio_for_talk(talk.name, force=force)
+    report['elapsed']['extract_camera_audio'] = time.time() - t_start
+
+    fingerprint = _mics_audio_fingerprint(talk, camera_wav_filename)
+    if is_up_to_date(mics_wav_filename, fingerprint, force):
+        with open(report_filename, 'r') as f:
+            return json.load(f)
+
+    # numpy, scipy and pyfftw take long to import, and only this stage needs them
+    import rcsignal
+
+    # Calculate the delay where the audio from the camera matches the audio from the microphones.
+    # This is found at 1 s resolution first, then refined at 10 ms, and finally to a single sample.
+    delay, levels = rcsignal.estimate_delay(
+        talk.original_audio_file,
         camera_wav_filename,
-        window_duration=.05
+        resolutions=(1., .01),
     )
-    delay = t_corr[np.argmax(corr)]
-
-    # Plot the cross correlation just to make sure everything is sane.
-    plt.figure()
-    ax = plt.gca()
-    ax.plot(t_corr, corr)
+    for level, stage in zip(levels, ['coarse', 'fine', 'sample']):
+        report['elapsed']['correlate_{}'.format(stage)] = level['elapsed']
+
+    # The peak at the coarse level says whether the right part of the recording was found at all.
+    # The finer levels only search close to it, so their peaks say little.
+    ratio = rcsignal.peak_ratio(levels[0]['correlation'], exclusion=2)
+    report['delay'] = float(delay)
+    report['peak_ratio'] = ratio if math.isfinite(ratio) else None  # JSON has no infinity
+    report['confidence'] = rcsignal.peak_confidence(ratio)
+    report['flagged'] = report['confidence'] < min_confidence
+
+    # Plot the coarse cross correlation just to make sure everything is sane.
+    t_start = time.time()
+    title = "Calculated delay: {} s (confidence {:.2f})".format(delay, report['confidence'])
+    if interactive:
+        import matplotlib.pyplot as plt
+        fig = plt.figure()
+    else:
+        from matplotlib.figure import Figure  # no pyplot, so that no display is needed
+        fig = Figure()
+    ax = fig.gca()
+    ax.plot(levels[0]['lags'], levels[0]['correlation'])
     ax.axvline(delay, c='g', linestyle=':')
-    plt.title("Calculated delay: {} s".format(delay))
-    plt.show()
+    ax.set_title(title)
+    fig.savefig(plot_filename)
+    report['elapsed']['plot'] = time.time() - t_start
+
+    with open(report_filename, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if interactive:
+        plt.show()
+
+    if report['flagged'] and on_low_confidence == 'raise':
+        raise RuntimeError("The microphones could not be synced reliably for {} (confidence {:.2f}). See {}".format(
+            name, report['confidence'], report_filename))
 
     # Now extract the audio
-    subprocess.check_call([
+    t_start = time.time()
+    duration_ms = media_length(camera_wav_filename)
+    run_ffmpeg([
         'ffmpeg',
         # global options:
         '-y',  # overwrite
         # input stream 0
-        '-i', talk_info['original_audio_file'],
+        '-i', talk.original_audio_file,
         # output options:
         '-ss', str(delay),
-        '-t', str(media_length(camera_wav_filename) / 1000.),
+        '-t', str(duration_ms / 1000.),
         '-acodec', 'copy',
-        os.path.join(get_output_dir(name), '{}_mics_audio.wav'.format(name))
-    ])
+        mics_wav_filename
+    ], stage='extract_microphones_audio_for_talk', name=name, duration_ms=duration_ms)
+    report['elapsed']['extract_microphones_audio'] = time.time() - t_start
+
+    with open(report_filename, 'w') as f:
+        json.dump(report, f, indent=2)
+    rcfingerprint.record(mics_wav_filename, fingerprint)
+
+    return report
+
+
+def _mics_audio_fingerprint(talk, camera_wav_filename):
+    return rcfingerprint.fingerprint({
+        'original_audio_file': rcfingerprint.file_stat(talk.original_audio_file),
+        'camera_audio_file': rcfingerprint.file_stat(camera_wav_filename),
+    })
 
 
-def extract_camera_audio_for_talk(name):
+def extract_camera_audio_for_talk(name, force=False, dry_run=False):
     """
     Extract the audio from the concatenated camera clip
 
@@ -62,11 +186,22 @@ def extract_camera_audio_for_talk(name):
 
     :param name: The name of the talk as it appears in the spreadsheet.
 
+    :param force: Extract the audio even if the camera video has not changed since the last time.
+
+    :param dry_run: Only plan the command.
+
+    :return: The filename of the audio, or a list of `rcplan.CommandSpec` for a dry run.
+
     """
-    parameters = get_parameters()
     camera_video_filename = os.path.join(get_output_dir(name), '{}_camera.mp4'.format(name))  # generated by `concatenate_camera_clips_for_talk`
     output_wav_filename = os.path.join(get_output_dir(name), '{}_camera.wav'.format(name))
-    subprocess.check_call([
+    fingerprint = rcfingerprint.fingerprint({
+        'camera_video_file': rcfingerprint.file_stat(camera_video_filename),
+    })
+    if is_up_to_date(output_wav_filename, fingerprint, force, dry_run):
+        return [] if dry_run else output_wav_filename
+
+    spec = command_spec('extract_camera_audio_for_talk', name, [
         'ffmpeg',
         # global options:
         '-y',  # overwrite
@@ -74,37 +209,81 @@ def extract_camera_audio_for_talk(name):
         '-i', camera_video_filename,
         # output options:
         output_wav_filename
-    ])
+    ], inputs=[camera_video_filename], outputs=[output_wav_filename], duration_ms=get_talk_duration(name))
+    if dry_run:
+        return [spec]
+
+    run_command_spec(spec)
+    rcfingerprint.record(output_wav_filename, fingerprint)
 
     return output_wav_filename
 
 
-def make_talk_video(name, crf=crf_visually_lossless, preset='slow'):
+def make_talk_video(name, profile='master', crf=None, preset=None, single_pass=False, segments=None, force=False,
+                    dry_run=False):
     """
     Make a video for the talk using previously created camera video and slides video.
 
-    This assumes that `concatenate_camera_clips_for_talk` and `make_slide_video_for_talk` have already been run.
+    This assumes that `concatenate_camera_clips_for_talk` and `make_slide_video_for_talk` have already been run, unless
+    `single_pass` is used.
 
     :param name: The name of the talk as it appears in the spreadsheet.
 
+    :param profile: The name of the encoder profile, see `rcprofiles`.
+
+    :param crf: Override the crf of the profile.
+
+    :param preset: Override the preset of the profile.
+
+    :param single_pass: Build the video straight from the camera clips and the slide images, in a single encode,
+        instead of from the intermediate camera and slides videos. See `make_talk_video_single_pass`.
+
+    :param segments: Split the video into this many segments and encode them at the same time. See
+        `make_talk_video_segmented`.
+
+    :param force: Make the video even if none of its inputs have changed since the last time.
+
+    :param dry_run: Only plan the commands.
+
+    :return: A list of `rcplan.CommandSpec` for a dry run.
+
     """
-    parameters = get_parameters()
+    if single_pass:
+        return make_talk_video_single_pass(name, profile=profile, crf=crf, preset=preset, force=force, dry_run=dry_run)
+    if segments is not None and segments > 1:
+        return make_talk_video_segmented(
+            name, segments, profile=profile, crf=crf, preset=preset, force=force, dry_run=dry_run)
+
+    parameters = load_parameters()
+    profile = get_profile(profile, crf=crf, preset=preset)
 
     streamselect_filename = os.path.join(get_output_dir(name), '{}_streamselect.cmd'.format(name))
     slide_video_filename = os.path.join(get_output_dir(name), '{}_slides.mp4'.format(name))  # generated by `make_slide_video_for_talk`
     camera_video_filename = os.path.join(get_output_dir(name), '{}_camera.mp4'.format(name))  # generated by `concatenate_camera_clips_for_talk`
     final_video_filename = os.path.join(get_output_dir(name), '{}.mp4'.format(name))
 
+    fingerprint = rcfingerprint.fingerprint({
+        'stream_timings_file': rcfingerprint.file_hash(get_stream_timings_filename(name)),
+        'slide_video_file': rcfingerprint.file_stat(slide_video_filename),
+        'camera_video_file': rcfingerprint.file_stat(camera_video_filename),
+        'duration_ms': get_talk_duration(name),
+        'fps': str(parameters.source_fps),
+        'profile': profile.describe(),
+    })
+    if is_up_to_date(final_video_filename, fingerprint, force, dry_run):
+        return [] if dry_run else None
+
     write_stream_timings_cmd_file(read_stream_timings(name), streamselect_filename)
 
     # This assumes that the slides are already at the same size as the camera (1080p)
     # slides is input 0, camera is input 1
     filters = [
-        "[0][1]streamselect=inputs=2:map=0,sendcmd=f={},setdar[v]".format(streamselect_filename),
+        "[0][1]streamselect=inputs=2:map=0,sendcmd=f={},{}setdar[v]".format(
+            streamselect_filename, _scale_filter_chain(profile)),
         "[1:a]anull[a]",  # Use audio from camera for now (TODO: use processed audio from DAW)
     ]
 
-    subprocess.check_call([
+    spec = command_spec('make_talk_video', name, [
         'ffmpeg',
         # global options:
         '-y',  # overwrite
@@ -115,174 +294,793 @@ def make_talk_video(name, crf=crf_visually_lossless, preset='slow'):
         # output options:
         '-t', str(get_talk_duration(name) / 1000.),
         '-filter_complex', ";".join(filters),
-        '-r', (parameters['source_fps']),  # Match the camera frame rate
-        '-c:v', 'libx264',
-        '-crf', str(int(crf)),
-        '-preset', str(preset),
+        '-r', str(parameters.source_fps),  # Match the camera frame rate
+    ] + profile.encode_options() + [
         '-map', '[v]',
         '-map', '[a]',
         final_video_filename
-    ])
+    ], inputs=[slide_video_filename, camera_video_filename, streamselect_filename], outputs=[final_video_filename],
+        duration_ms=get_talk_duration(name), profile=profile)
+    if dry_run:
+        return [spec]
+
+    run_command_spec(spec)
+    rcfingerprint.record(final_video_filename, fingerprint)
 
 
-def concatenate_camera_clips_for_talk(name, crf=crf_visually_lossless, preset='slow'):
+def make_talk_video_single_pass(name, profile='master', crf=None, preset=None, force=False, dry_run=False):
     """
-    Create a camera mux file and use it to create a video with only the camera for a talk.
+    Make a video for the talk straight from the camera clips and the slide images, in a single encode.
 
-    :param name: The name of the talk as it appears in the spreadsheet
+    The camera mux file, the slides mux file and the streamselect command file are written, and fed to one filter graph.
+    This skips the intermediate `_camera.mp4` and `_slides.mp4` videos, and the two extra encodes that create them.
+
+    The slides mux file points at copies of the slide images scaled to the camera size, from the slide cache.
+
+    :param name: The name of the talk as it appears in the spreadsheet.
+
+    :param profile: The name of the encoder profile, see `rcprofiles`.
+
+    :param crf: Override the crf of the profile.
+
+    :param preset: Override the preset of the profile.
 
-    :param crf:
+    :param force: Make the video even if none of its inputs have changed since the last time.
 
-    :param preset:
+    :param dry_run: Only plan the command. The mux files are still written, and the slides cached.
+
+    :return: A list of `rcplan.CommandSpec` for a dry run.
 
     """
-    parameters = get_parameters()
+    parameters = load_parameters()
+    profile = get_profile(profile, crf=crf, preset=preset)
 
     camera_mux_filename = os.path.join(get_output_dir(name), '{}_camera.mux'.format(name))
+    slide_mux_filename = os.path.join(get_output_dir(name), '{}_slides.mux'.format(name))
+    streamselect_filename = os.path.join(get_output_dir(name), '{}_streamselect.cmd'.format(name))
+    final_video_filename = os.path.join(get_output_dir(name), '{}.mp4'.format(name))
+
+    ss, to = get_talk_ss_to(name)
+    slides = read_slide_timings(name)
+    fingerprint = rcfingerprint.fingerprint({
+        'talk_info': load_talk_info(name),
+        'camera_files': [rcfingerprint.file_stat(f) for f in get_talk_input_files(name)],
+        'slide_timings_file': rcfingerprint.file_hash(get_slide_timings_filename(name)),
+        'slide_files': get_slide_files_stats(slides),
+        'stream_timings_file': rcfingerprint.file_hash(get_stream_timings_filename(name)),
+        'ss_to_ms': [ss, to],
+        'fps': str(parameters.source_fps),
+        'profile': profile.describe(),
+    })
+    if is_up_to_date(final_video_filename, fingerprint, force, dry_run):
+        return [] if dry_run else None
+
     write_camera_mux_file_for_talk(name, camera_mux_filename)
+    write_slide_timings_mux_file(slides, slide_mux_filename, to - ss)
+    write_stream_timings_cmd_file(read_stream_timings(name), streamselect_filename)
+
+    # slides is input 0, camera is input 1.
+    # Both are resampled to the camera frame rate and start at t=0, so that streamselect can switch between them.
+    filters = [
+        "[0:v]fps={},setpts=PTS-STARTPTS[slides]".format(parameters.source_fps),
+        "[1:v]fps={},setpts=PTS-STARTPTS[camera]".format(parameters.source_fps),
+        "[slides][camera]streamselect=inputs=2:map=0,sendcmd=f={},{}setdar[v]".format(
+            streamselect_filename, _scale_filter_chain(profile)),
+        "[1:a]asetpts=PTS-STARTPTS[a]",  # Use audio from camera for now (TODO: use processed audio from DAW)
+    ]
+
+    spec = command_spec('make_talk_video', name, [
+        'ffmpeg',
+        # global options:
+        '-y',  # overwrite
+        # input stream 0 (slides)
+        '-safe', '0',  # allow absolute paths
+        '-f', 'concat',
+        '-i', slide_mux_filename,
+        # input stream 1 (camera)
+        '-ss', str(ss / 1000.),  # seek in the input, so that the slides and camera timelines line up
+    ] + list(profile.decode_options) + [
+        '-safe', '0',  # allow absolute paths
+        '-f', 'concat',
+        '-i', camera_mux_filename,
+        # output options:
+        '-t', str((to - ss) / 1000.),
+        '-filter_complex', ";".join(filters),
+        '-r', str(parameters.source_fps),  # Match the camera frame rate
+    ] + profile.encode_options() + [
+        '-map', '[v]',
+        '-map', '[a]',
+        final_video_filename
+    ], inputs=[camera_mux_filename, slide_mux_filename, streamselect_filename] + get_talk_input_files(name),
+        outputs=[final_video_filename], duration_ms=to - ss, profile=profile)
+    if dry_run:
+        return [spec]
+
+    run_command_spec(spec)
+    rcfingerprint.record(final_video_filename, fingerprint)
+
+
+def make_talk_video_segmented(name, segments, profile='master', crf=None, preset=None, force=False, dry_run=False):
+    """
+    Make a video for the talk like `make_talk_video`, but split into segments which are encoded at the same time.
+
+    A single x264 encode with a slow preset stops getting faster at about 8 threads, so an urgent talk is split at
+    points where the picture changes anyway (a switch between slides and camera, or a new slide), close to equal
+    lengths. Each segment is encoded by its own ffmpeg process with its share of the threads, and the segments are
+    then joined without re-encoding, with the camera audio copied in.
+
+    :param name: The name of the talk as it appears in the spreadsheet.
+
+    :param segments: The number of segments, e.g. the number of cores divided by 4.
+
+    :param profile: The name of the encoder profile, see `rcprofiles`.
+
+    :param crf: Override the crf of the profile.
+
+    :param preset: Override the preset of the profile.
+
+    :param force: Make the video even if none of its inputs have changed since the last time.
+
+    :param dry_run: Only plan the commands.
+
+    :return: A list of `rcplan.CommandSpec` for a dry run.
+
+    """
+    parameters = load_parameters()
+    profile = get_profile(profile, crf=crf, preset=preset)
+
+    output_dir = get_output_dir(name)
+    slide_video_filename = os.path.join(output_dir, '{}_slides.mp4'.format(name))  # generated by `make_slide_video_for_talk`
+    camera_video_filename = os.path.join(output_dir, '{}_camera.mp4'.format(name))  # generated by `concatenate_camera_clips_for_talk`
+    final_video_filename = os.path.join(output_dir, '{}.mp4'.format(name))
+
+    # The same inputs as `make_talk_video`, so that either can pick up where the other left off
+    fingerprint = rcfingerprint.fingerprint({
+        'stream_timings_file': rcfingerprint.file_hash(get_stream_timings_filename(name)),
+        'slide_video_file': rcfingerprint.file_stat(slide_video_filename),
+        'camera_video_file': rcfingerprint.file_stat(camera_video_filename),
+        'duration_ms': get_talk_duration(name),
+        'fps': str(parameters.source_fps),
+        'profile': profile.describe(),
+    })
+    if is_up_to_date(final_video_filename, fingerprint, force, dry_run):
+        return [] if dry_run else None
+
+    fps = parameters.source_fps
+    total_frames = round(Fraction(get_talk_duration(name)) / 1000 * fps)
+    stream_track = load_stream_track(name)
+    switch_times = list(stream_track.times) + list(load_slide_track(name).times)
+    switch_frames = [round(Fraction(t) / 1000 * fps) for t in switch_times]
+    boundaries = get_segment_boundaries(switch_frames, total_frames, segments)
+
+    threads = max(1, (ffmpeg_threads or os.cpu_count() or 1) // (len(boundaries) - 1))
+    segment_filenames = []
+    specs = []
+    for i, (start_frame, stop_frame) in enumerate(zip(boundaries[:-1], boundaries[1:])):
+        start = timedelta(seconds=float(start_frame / fps))
+        start_ms = round(start_frame * 1000 / fps)
+        stop_ms = round(stop_frame * 1000 / fps)
+
+        # The stream shown at the start of the segment, then the switches during it, relative to its start.
+        # As in `make_talk_video`, streamselect starts with the slides.
+        segment_streams = [{'time': timedelta(0), 'name': stream_track.at(start_ms, 'slides')}]
+        segment_streams += [
+            {'time': timedelta(milliseconds=t - start_ms), 'name': stream}
+            for t, stream in stream_track.between(start_ms, stop_ms) if t > start_ms
+        ]
+        streamselect_filename = os.path.join(output_dir, '{}_streamselect_{:03d}.cmd'.format(name, i))
+        write_stream_timings_cmd_file(segment_streams, streamselect_filename)
+
+        filters = [
+            "[0][1]streamselect=inputs=2:map=0,sendcmd=f={},{}setdar[v]".format(
+                streamselect_filename, _scale_filter_chain(profile)),
+        ]
+        segment_filename = os.path.join(output_dir, '{}_segment_{:03d}.ts'.format(name, i))
+        segment_filenames.append(segment_filename)
+        specs.append(command_spec('make_talk_video', name, [
+            'ffmpeg',
+            # global options:
+            '-y',  # overwrite
+            # input stream 0 (slides), seeking accurately to the first frame of the segment
+            '-ss', str(start.total_seconds()),
+            '-i', slide_video_filename,
+            # input stream 1 (camera)
+            '-ss', str(start.total_seconds()),
+            '-i', camera_video_filename,
+            # output options:
+            '-frames:v', str(stop_frame - start_frame),
+            '-filter_complex', ";".join(filters),
+            '-r', str(fps),  # Match the camera frame rate
+        ] + profile.encode_options() + [
+            '-map', '[v]',
+            '-an',  # the audio is added in one piece at the end
+            '-f', 'mpegts',
+            segment_filename
+        ], inputs=[slide_video_filename, camera_video_filename, streamselect_filename], outputs=[segment_filename],
+            duration_ms=(stop_ms - start_ms), profile=profile))
+
+    segments_mux_filename = os.path.join(output_dir, '{}_segments.mux'.format(name))
+    with open(segments_mux_filename, 'w') as mux_file:
+        mux_file.write("\n".join("file '{}'".format(f) for f in segment_filenames))
+    concat_spec = command_spec('make_talk_video', name, [
+        'ffmpeg',
+        # global options:
+        '-y',  # overwrite
+        # input stream 0 (video segments)
+        '-safe', '0',  # allow absolute paths
+        '-f', 'concat',
+        '-i', segments_mux_filename,
+        # input stream 1 (camera)
+        '-i', camera_video_filename,
+        # output options:
+        '-t', str(get_talk_duration(name) / 1000.),
+        '-map', '0:v',
+        '-map', '1:a',  # Use audio from camera for now (TODO: use processed audio from DAW)
+        '-c', 'copy',
+        final_video_filename
+    ], inputs=[segments_mux_filename, camera_video_filename] + segment_filenames, outputs=[final_video_filename],
+        duration_ms=get_talk_duration(name))
+    if dry_run:
+        return specs + [concat_spec]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(specs)) as executor:
+        # Each thread only waits for its ffmpeg process
+        for future in [executor.submit(run_command_spec, spec, threads) for spec in specs]:
+            future.result()
+    run_command_spec(concat_spec)
+    rcfingerprint.record(final_video_filename, fingerprint)
+
+    for f in segment_filenames:
+        os.remove(f)
+
+
+def get_segment_boundaries(switch_frames, total_frames, segments, snap_window=.5):
+    """
+    Choose where to split a video into segments of about the same length, preferring frames where the picture changes.
+
+    :param switch_frames: The frames where the picture changes, e.g. where the stream or the slide changes.
+
+    :param total_frames: The number of frames in the video.
+
+    :param segments: The number of segments wanted.
+
+    :param snap_window: How far from an equal split a boundary may be moved to reach a switch, as a fraction of the
+        equal segment length.
+
+    :return list: The first frame of each segment, followed by `total_frames`. There may be fewer segments than asked
+        for, if the video is very short.
+
+    >>> get_segment_boundaries([0, 90, 260, 480, 700], 1000, 4)
+    [0, 260, 480, 700, 1000]
+    >>> get_segment_boundaries([], 1000, 4)
+    [0, 250, 500, 750, 1000]
+    >>> get_segment_boundaries([10], 3, 4)
+    [0, 1, 2, 3]
+    """
+    segment_length = total_frames / segments
+    window = segment_length * snap_window / 2
+    candidates = sorted(set(f for f in switch_frames if 0 < f < total_frames))
+    boundaries = [0]
+    for k in range(1, segments):
+        target = k * segment_length
+        nearby = [f for f in candidates if abs(f - target) <= window]
+        boundary = min(nearby, key=lambda f: abs(f - target)) if nearby else round(target)
+        if boundaries[-1] < boundary < total_frames:
+            boundaries.append(boundary)
+    boundaries.append(total_frames)
+    return boundaries
+
+
+def concatenate_camera_clips_for_talk(name, profile='master', crf=None, preset=None, force=False, smart_cut=False,
+                                      dry_run=False):
+    """
+    Create a camera mux file and use it to create a video with only the camera for a talk.
+
+    :param name: The name of the talk as it appears in the spreadsheet
+
+    :param profile: The name of the encoder profile, see `rcprofiles`.
+
+    :param crf: Override the crf of the profile.
+
+    :param preset: Override the preset of the profile.
+
+    :param force: Make the video even if none of its inputs have changed since the last time.
+
+    :param smart_cut: Only re-encode the video around the start and stop times, and copy the rest of the camera stream.
+        See `smart_cut_camera_clips_for_talk`. This is ignored for profiles which change the size or codec of the video.
+
+    :param dry_run: Only plan the commands.
+
+    :return: A list of `rcplan.CommandSpec` for a dry run.
+
+    """
+    parameters = load_parameters()
+    profile = get_profile(profile, crf=crf, preset=preset)
+    smart_cut = smart_cut and profile.keeps_source_stream()
 
     camera_video_filename = os.path.join(get_output_dir(name), '{}_camera.mp4'.format(name))
     ss, to = get_talk_ss_to(name)
-    subprocess.check_call([
+    fingerprint = rcfingerprint.fingerprint({
+        'talk_info': load_talk_info(name),
+        'camera_files': [rcfingerprint.file_stat(f) for f in get_talk_input_files(name)],
+        'ss_to_ms': [ss, to],
+        'fps': str(parameters.source_fps),
+        'profile': profile.describe(),
+        'smart_cut': smart_cut,
+    })
+    if is_up_to_date(camera_video_filename, fingerprint, force, dry_run):
+        return [] if dry_run else None
+
+    if smart_cut:
+        specs = smart_cut_camera_clips_for_talk(name, camera_video_filename, profile=profile, dry_run=dry_run)
+        if dry_run and specs:
+            return specs
+        if specs:
+            rcfingerprint.record(camera_video_filename, fingerprint)
+            return
+
+    camera_mux_filename = os.path.join(get_output_dir(name), '{}_camera.mux'.format(name))
+    write_camera_mux_file_for_talk(name, camera_mux_filename)
+
+    spec = command_spec('concatenate_camera_clips_for_talk', name, [
         'ffmpeg',
         # global options:
         '-y',  # overwrite
         # input stream 0 (camera)
+    ] + list(profile.decode_options) + [
         '-safe', '0',  # allow absolute paths
         '-f', 'concat',
         '-i', camera_mux_filename,
         # output options:
         '-ss', str(ss / 1000.),
         '-to', str(to / 1000.),
-        '-r', (parameters['source_fps']),  # Match the camera frame rate
-        '-c:v', 'libx264',
-        '-crf', str(int(crf)),
-        '-preset', str(preset),
+    ] + _scale_options(profile) + [
+        '-r', str(parameters.source_fps),  # Match the camera frame rate
+    ] + profile.encode_options() + [
         camera_video_filename
-    ])
+    ], inputs=[camera_mux_filename] + get_talk_input_files(name), outputs=[camera_video_filename],
+        duration_ms=to - ss, profile=profile)
+    if dry_run:
+        return [spec]
+
+    run_command_spec(spec)
+    rcfingerprint.record(camera_video_filename, fingerprint)
 
 
-def make_slide_video_for_talk(name, crf=crf_visually_lossless, preset='slow'):
+def smart_cut_camera_clips_for_talk(name, output_filename, profile='master', crf=None, preset=None, dry_run=False):
     """
-    Create a slides mux file and use it to create a video with only the slides.
+    Trim and concatenate the camera clips for a talk, re-encoding only the bits before the first and after the last
+    keyframe inside the trimmed range.
+
+    The video is cut into three pieces:
 
-    No scaling is done here, since using filter_complex with large mux files seems to make the memory blow up in ffmpeg.
-    Therefore, the PNG files in the mux file should already match that of the camera.
+    - head: from `start_time_ms` in the first clip up to the next keyframe, re-encoded;
+    - middle: from that keyframe up to the last keyframe before `stop_time_ms` in the last clip, copied;
+    - tail: from that keyframe up to `stop_time_ms`, re-encoded.
+
+    The pieces are made as MPEG-TS, so that the parameter sets of the re-encoded pieces are carried in the stream, and
+    then concatenated without re-encoding. The audio is small, so it is re-encoded in all three pieces to keep it
+    continuous.
 
     :param name: The name of the talk as it appears in the spreadsheet.
 
+    :param output_filename: Where to write the trimmed camera video.
+
+    :param profile: The name of the encoder profile for the re-encoded pieces, see `rcprofiles`. It should keep the size
+        and codec of the camera stream.
+
+    :param crf: Override the crf of the profile.
+
+    :param preset: Override the preset of the profile.
+
+    :param dry_run: Only plan the commands. The keyframes are still looked up, and the mux files written.
+
+    :return: False if there are no keyframes in the trimmed range, in which case nothing was done and the caller should
+        re-encode everything instead. Otherwise True, or the list of `rcplan.CommandSpec` for a dry run.
+
     """
-    parameters = get_parameters()
+    parameters = load_parameters()
+    profile = get_profile(profile, crf=crf, preset=preset)
+    talk = load_talk(name)
+    input_files = talk.input_files
+    first_file, last_file = input_files[0], input_files[-1]
+    start = talk.start_time_ms / 1000.
+    stop = talk.stop_time_ms / 1000.
+    search_window = 30.  # seconds, much longer than any GOP
+
+    keyframe_in = [t for t in keyframe_times(first_file, start, start + search_window) if t >= start]
+    keyframe_out = [t for t in keyframe_times(last_file, stop - search_window, stop) if t <= stop]
+    if not keyframe_in or not keyframe_out:
+        return False
+    keyframe_in, keyframe_out = keyframe_in[0], keyframe_out[-1]
+    if first_file == last_file and keyframe_in >= keyframe_out:
+        return False
+
+    output_dir = get_output_dir(name)
+    encode_options = [
+        '-r', str(parameters.source_fps),  # Match the camera frame rate
+    ] + profile.encode_options() + [
+        '-c:a', 'aac',
+        '-f', 'mpegts',
+    ]
+    pieces = []
+    specs = []
+
+    if keyframe_in > start:
+        head_filename = os.path.join(output_dir, '{}_camera_head.ts'.format(name))
+        specs.append(command_spec('concatenate_camera_clips_for_talk', name, [
+            'ffmpeg',
+            # global options:
+            '-y',  # overwrite
+            # input stream 0 (first camera clip)
+            '-ss', str(start),
+            '-i', first_file,
+            # output options:
+            '-t', str(keyframe_in - start),
+        ] + encode_options + [
+            head_filename
+        ], inputs=[first_file], outputs=[head_filename], duration_ms=(keyframe_in - start) * 1000, profile=profile))
+        pieces.append(head_filename)
+
+    middle_mux_filename = os.path.join(output_dir, '{}_camera_middle.mux'.format(name))
+    with open(middle_mux_filename, 'w') as mux_file:
+        for f in input_files:
+            mux_file.write("file '{}'\n".format(f))
+            if f == first_file:
+                mux_file.write("inpoint {}\n".format(keyframe_in))
+            if f == last_file:
+                mux_file.write("outpoint {}\n".format(keyframe_out))
+    middle_filename = os.path.join(output_dir, '{}_camera_middle.ts'.format(name))
+    specs.append(command_spec('concatenate_camera_clips_for_talk', name, [
+        'ffmpeg',
+        # global options:
+        '-y',  # overwrite
+        # input stream 0 (camera)
+        '-safe', '0',  # allow absolute paths
+        '-f', 'concat',
+        '-i', middle_mux_filename,
+        # output options:
+        '-c:v', 'copy',
+        '-c:a', 'aac',
+        '-f', 'mpegts',
+        middle_filename
+    ], inputs=[middle_mux_filename] + list(input_files), outputs=[middle_filename], duration_ms=get_talk_duration(name)))
+    pieces.append(middle_filename)
+
+    if stop > keyframe_out:
+        tail_filename = os.path.join(output_dir, '{}_camera_tail.ts'.format(name))
+        specs.append(command_spec('concatenate_camera_clips_for_talk', name, [
+            'ffmpeg',
+            # global options:
+            '-y',  # overwrite
+            # input stream 0 (last camera clip)
+            '-ss', str(keyframe_out),
+            '-i', last_file,
+            # output options:
+            '-t', str(stop - keyframe_out),
+        ] + encode_options + [
+            tail_filename
+        ], inputs=[last_file], outputs=[tail_filename], duration_ms=(stop - keyframe_out) * 1000, profile=profile))
+        pieces.append(tail_filename)
+
+    pieces_mux_filename = os.path.join(output_dir, '{}_camera_pieces.mux'.format(name))
+    with open(pieces_mux_filename, 'w') as mux_file:
+        mux_file.write("\n".join("file '{}'".format(f) for f in pieces))
+    specs.append(command_spec('concatenate_camera_clips_for_talk', name, [
+        'ffmpeg',
+        # global options:
+        '-y',  # overwrite
+        # input stream 0 (pieces)
+        '-safe', '0',  # allow absolute paths
+        '-f', 'concat',
+        '-i', pieces_mux_filename,
+        # output options:
+        '-c', 'copy',
+        '-bsf:a', 'aac_adtstoasc',  # the audio in the pieces has ADTS headers, which mp4 does not want
+        output_filename
+    ], inputs=[pieces_mux_filename] + pieces, outputs=[output_filename], duration_ms=get_talk_duration(name)))
+    if dry_run:
+        return specs
 
-    slides = read_slide_timings(name)
+    for spec in specs:
+        run_command_spec(spec)
+    for f in pieces:
+        os.remove(f)
 
-    slide_mux_filename = os.path.join(get_output_dir(name), '{}_slides.mux'.format(name))
-    write_slide_timings_mux_file(slides, slide_mux_filename, get_talk_duration(name))
+    return True
+
+
+def make_slide_video_for_talk(name, profile='master', crf=None, preset=None, force=False, dry_run=False):
+    """
+    Create a video with only the slides.
+
+    Each slide image is decoded and scaled to the video size once, and the encoder is sent one frame per slide change,
+    timed by a setpts filter, see `rcslides`. The images therefore no longer need to match the camera, and neither the
+    memory used nor the data piped grows with the duration of the talk.
+
+    :param name: The name of the talk as it appears in the spreadsheet.
+
+    :param profile: The name of the encoder profile, see `rcprofiles`.
+
+    :param crf: Override the crf of the profile.
+
+    :param preset: Override the preset of the profile.
+
+    :param force: Make the video even if none of its inputs have changed since the last time.
+
+    :param dry_run: Only plan the command.
+
+    :return: A list of `rcplan.CommandSpec` for a dry run.
+
+    """
+    parameters = load_parameters()
+    profile = get_profile(profile, crf=crf, preset=preset)
+
+    slides = read_slide_timings(name)
 
     slide_video_filename = os.path.join(get_output_dir(name), '{}_slides.mp4'.format(name))
-    subprocess.check_call([
+    fingerprint = rcfingerprint.fingerprint({
+        'slide_timings_file': rcfingerprint.file_hash(get_slide_timings_filename(name)),
+        'slide_files': get_slide_files_stats(slides),
+        'duration_ms': get_talk_duration(name),
+        'fps': str(parameters.source_fps),
+        'profile': profile.describe(),
+        'renderer': 'rcslides-vfr',
+    })
+    if is_up_to_date(slide_video_filename, fingerprint, force, dry_run):
+        return [] if dry_run else None
+
+    if dry_run:
+        # The frames are piped from Python, so the plan is a call to this function
+        return [command_spec(
+            'make_slide_video_for_talk', name,
+            rcplan.python_argv('make_slide_video_for_talk', name,
+                               profile=profile.name, crf=profile.crf, preset=profile.preset),
+            inputs=[get_slide_timings_filename(name)] + sorted(set(s['filename'] for s in slides)),
+            outputs=[slide_video_filename], duration_ms=get_talk_duration(name), profile=profile,
+        )]
+
+    if profile.resolution is None:
+        width, height = parameters.source_w, parameters.source_h
+    else:
+        height = profile.resolution
+        width = 2 * round(parameters.source_w * height / parameters.source_h / 2)
+
+    def encoder_command(input_options, output_options, output_filename):
+        return _with_thread_budget([
+            'ffmpeg',
+            # global options:
+            '-y',  # overwrite
+            # input stream 0 (one raw frame on stdin per slide shown):
+        ] + input_options + [
+            # output options:
+        ] + output_options + profile.encode_options() + [
+            '-an',  # no audio
+            '-r', str(parameters.source_fps),  # Match the camera frame rate, by repeating frames
+            output_filename
+        ])
+
+    progress = rcprogress.FfmpegProgress('make_slide_video_for_talk', name, get_talk_duration(name),
+                                         output=slide_video_filename, metrics_file=get_metrics_file())
+    with publishing(slide_video_filename) as tmp_filename:
+        rcslides.render_slides(slides, get_talk_duration(name), parameters.source_fps,
+                               functools.partial(encoder_command, output_filename=tmp_filename), width, height,
+                               progress=progress)
+    rcfingerprint.record(slide_video_filename, fingerprint)
+
+
+def propose_timings_for_talk(name, force=False, dry_run=False):
+    """
+    Propose the stream and slide timings of a talk from the camera video, see `rcvision`.
+
+    The camera clips are decoded at a low resolution and frame rate, the slide changes are found in them and matched
+    against the slide images, and the stream switches follow from the slide changes. The proposals are written to the
+    output folder of the talk, as `streams_timings--<name>.proposed.txt` and `slide_timings--<name>.proposed.txt`, in
+    the format of the timing programs, as a starting point for the person doing the timing. The timing files in the
+    timing folder are never written.
+
+    :param name: The name of the talk as it appears in the spreadsheet.
+
+    :param force: Make the proposals even if none of their inputs have changed since the last time.
+
+    :param dry_run: Only plan the command. The analysis is planned as a call to this function.
+
+    :return: The filenames of the proposed stream and slide timings, or a list of `rcplan.CommandSpec` for a dry run.
+
+    """
+    talk = load_talk(name)
+    output_dir = get_output_dir(name)
+    stream_timings_filename = os.path.join(output_dir, 'streams_timings--{}.proposed.txt'.format(name))
+    slide_timings_filename = os.path.join(output_dir, 'slide_timings--{}.proposed.txt'.format(name))
+    slide_files = sorted(glob.glob(os.path.join(get_slide_folder(name), '*.png')))
+    ffmpeg_ss, ffmpeg_to = get_talk_ss_to(name)
+
+    fingerprint = rcfingerprint.fingerprint({
+        'talk_info': load_talk_info(name),
+        'camera_files': [rcfingerprint.file_stat(f) for f in talk.input_files],
+        'slide_files': {f: rcfingerprint.file_stat(f) for f in slide_files},
+        'ss_to_ms': [ffmpeg_ss, ffmpeg_to],
+        'analysis': 'rcvision',
+    })
+    if is_up_to_date(slide_timings_filename, fingerprint, force, dry_run):
+        return [] if dry_run else (stream_timings_filename, slide_timings_filename)
+
+    # Not the <name>_camera.mux of the other stages, which may be reading it while this stage runs
+    camera_mux_filename = os.path.join(output_dir, '{}_proposal.mux'.format(name))
+    write_camera_mux_file_for_talk(name, camera_mux_filename)
+    if dry_run:
+        return [command_spec(
+            'propose_timings_for_talk', name, rcplan.python_argv('propose_timings_for_talk', name),
+            inputs=[camera_mux_filename] + list(talk.input_files) + slide_files,
+            outputs=[stream_timings_filename, slide_timings_filename],
+            duration_ms=ffmpeg_to - ffmpeg_ss, cost_per_second=decode_cost,
+        )]
+
+    # numpy takes long to import, and only the stages that analyse audio or video need it
+    import numpy as np
+    import rcvision
+
+    width, height = rcvision.frame_width, rcvision.frame_height
+    duration_ms = ffmpeg_to - ffmpeg_ss
+    expected_frames = int(duration_ms / 1000. * rcvision.sample_fps) + 1
+    frames = read_ffmpeg_output([
         'ffmpeg',
         # global options:
-        '-y',  # overwrite
-        # input stream 0:
+        '-v', 'error',
+        # input stream 0, decoded as fast as possible, since only a small picture is needed:
+        '-skip_loop_filter', 'all',
+        '-flags2', 'fast',
         '-safe', '0',  # allow absolute paths
         '-f', 'concat',
-        '-i', slide_mux_filename,
+        '-ss', str(ffmpeg_ss / 1000.),
+        '-t', str(duration_ms / 1000.),
+        '-i', camera_mux_filename,
         # output options:
-        '-c:v', 'libx264',
-        '-crf', str(int(crf)),
-        '-preset', str(preset),
-        '-an',  # no audio
-        '-r', (parameters['source_fps']),  # Match the camera frame rate
-        slide_video_filename
-    ])
+        '-an',
+        '-vf', 'fps={},scale={}:{}:flags=area,format=gray'.format(rcvision.sample_fps, width, height),
+        '-f', 'rawvideo',
+        '-pix_fmt', 'gray',
+        '-',
+    ], lambda stdout: rcvision.read_frames(stdout, width, height, expected_frames),
+        stage='propose_timings_for_talk', name=name, duration_ms=duration_ms)
+    # The grey picture is the luma plane, which comes first in a yuv420p frame
+    slides = np.array([
+        np.frombuffer(rcslides.decode_slide(rcslides.cached_slide(f, width, height), width, height),
+                      dtype=np.uint8, count=width * height).reshape(height, width)
+        for f in slide_files
+    ]).reshape(len(slide_files), height, width)
+
+    slide_changes = rcvision.propose_slide_changes(frames, slides, [os.path.basename(f) for f in slide_files])
+    stream_switches = [(t, stream) for t, stream in rcvision.propose_stream_switches(slide_changes)
+                       if t < duration_ms]
+    if not stream_switches:
+        stream_switches = [(0, 'camera')]
+
+    stream_values = {
+        'slides': 1,
+        'camera': 2,
+    }
+    with publishing(stream_timings_filename) as tmp_filename:
+        rctiming.write_timing_file(tmp_filename, stream_switches, lambda stream: stream_values[stream])
+    with publishing(slide_timings_filename) as tmp_filename:
+        rctiming.write_timing_file(tmp_filename, slide_changes)
+    rcfingerprint.record(slide_timings_filename, fingerprint)
+
+    print("Proposed {} slide changes and {} stream switches for {} from {} frames".format(
+        len(slide_changes), len(stream_switches), name, len(frames)))
+    return stream_timings_filename, slide_timings_filename
 
 
 def read_stream_timings(name):
     """
     Interpret the output of Simon's stream timing program.
 
-    :param name: The name of the text file where the stream timings are stored.
+    :param name: The name of the talk as it appears in the spreadsheet.
+
+    :return: A list of dictionaries with the interpreted and cleaned data.
+
+    """
+    return [{'time': timedelta(milliseconds=t), 'name': stream} for t, stream in load_stream_track(name)]
+
+
+def read_slide_timings(name):
+    """
+    Interpret the output of Simon's slide timing program.
+
+    :param name: The name of the talk as it appears in the spreadsheet.
 
     :return: A list of dictionaries with the interpreted and cleaned data.
 
     """
+    return [{'time': timedelta(milliseconds=t), 'filename': filename} for t, filename in load_slide_track(name)]
+
+
+def load_stream_track(name):
+    """
+    Get which stream is shown when during a talk, e.g. `load_stream_track(name).at(t_ms)` gives 'slides' or 'camera'.
 
+    :param name: The name of the talk as it appears in the spreadsheet.
+
+    :return rctiming.TimingTrack:
+
+    """
     stream_map = {
         1: 'slides',
         2: 'camera',
     }
-    parameters = get_parameters()
-    stream_timings_file = os.path.join(parameters['rc_base_folder'], 'timing', name, 'streams_timings--{}.txt'.format(name))
-    streams = []
-    with open(stream_timings_file, 'r') as f:
-        for line in f:
-            stream_time, stream_number = line.strip().split('->')
-            ref_time = datetime.strptime('0:00:00', '%H:%M:%S')
-            streams.append({
-                'time': datetime.strptime(stream_time, '%H:%M:%S') - ref_time,
-                'name': stream_map[int(stream_number)],
-            })
+    return rctiming.read_timing_file(
+        get_stream_timings_filename(name), lambda value: stream_map[int(value)], fps=load_parameters().source_fps)
 
-    # If there are duplicate times, keep only the last one
-    streams = [streams[i] for i in range(len(streams)) if i == len(streams) - 1 or streams[i]['time'] != streams[i + 1]['time']]
 
-    # If there are duplicate stream names, keep only the first one
-    streams = [streams[i] for i in range(len(streams)) if i == 0 or streams[i]['name'] != streams[i - 1]['name']]
+def load_slide_track(name):
+    """
+    Get which slide is shown when during a talk, as the absolute filenames of the slide images.
 
-    return streams
+    :param name: The name of the talk as it appears in the spreadsheet.
 
+    :return rctiming.TimingTrack:
 
-def read_slide_timings(name):
     """
-    Interpret the output of Simon's slide timing program.
+    slide_folder = get_slide_folder(name)
+    return rctiming.read_timing_file(
+        get_slide_timings_filename(name), lambda value: os.path.join(slide_folder, value),
+        fps=load_parameters().source_fps)
 
-    :param name: The name of the text file where the slide timings are stored.
 
-    :return: A list of dictionaries with the interpreted and cleaned data.
+def get_slide_folder(name):
+    parameters = load_parameters()
+    return os.path.join(parameters.rc_base_folder, 'slides', name)
+
+
+def get_stream_timings_filename(name):
+    parameters = load_parameters()
+    return os.path.join(parameters.rc_base_folder, 'timing', name, 'streams_timings--{}.txt'.format(name))
+
+
+def get_slide_timings_filename(name):
+    parameters = load_parameters()
+    return os.path.join(parameters.rc_base_folder, 'timing', name, 'slide_timings--{}.txt'.format(name))
+
 
+def get_slide_files_stats(slide_timings):
     """
-    parameters = get_parameters()
-    slide_timings_file = os.path.join(parameters['rc_base_folder'], 'timing', name, 'slide_timings--{}.txt'.format(name))
-    slides = []
-    with open(slide_timings_file, 'r') as f:
-        for line in f:
-            slide_time, slide_filename = line.strip().split('->')
-            ref_time = datetime.strptime('0:00:00', '%H:%M:%S')
-            slides.append({
-                'time': datetime.strptime(slide_time, '%H:%M:%S') - ref_time,
-                'filename': os.path.join(parameters['rc_base_folder'], 'slides', name, slide_filename)
-            })
+    Describe the slide images used in a talk, so that a changed slide causes the slides video to be remade.
 
-    # If there are duplicate times, keep only the last one
-    slides = [slides[i] for i in range(len(slides)) if i == len(slides) - 1 or slides[i]['time'] != slides[i + 1]['time']]
+    :param slide_timings: A list of dictionaries, as returned by `read_slide_timings`.
 
-    # If there are duplicate filenames, keep only the first one
-    slides = [slides[i] for i in range(len(slides)) if i == 0 or slides[i]['filename'] != slides[i - 1]['filename']]
+    :return: A dictionary mapping each filename to its size and mtime.
 
-    return slides
+    """
+    return {s['filename']: rcfingerprint.file_stat(s['filename']) for s in slide_timings}
 
 
-def write_stream_timings_cmd_file(stream_timings, output_filename):
+def write_stream_timings_cmd_file(stream_timings, output_filename, fps=None):
     """
     Prepare a commmand file for the ffmpeg filter_complex.
     This is used to select which stream is shown at which time in the output video.
 
+    Each switch is moved to the nearest frame, so that it happens on that exact frame.
+
     :param stream_timings: A list of dictionaries, saying which stream should be shown at what time.
 
     :param output_filename: The name of the output file.
 
+    :param fps: The frame rate of the output video. Defaults to that of the camera.
+
     """
+    if fps is None:
+        fps = load_parameters().source_fps
     stream_map = {
         'slides': 0,
         'camera': 1,
     }
     with open(output_filename, 'w') as f:
         for stream in stream_timings:
-            f.write("{} streamselect map {};\n".format(stream['time'], stream_map[stream['name']]))
+            frame = rctiming.frame_at(stream['time'] // timedelta(milliseconds=1), fps)
+            f.write("{} streamselect map {};\n".format(rctiming.format_frame_time(frame, fps), stream_map[stream['name']]))
 
 
-def write_slide_timings_mux_file(slide_timings, output_filename, total_duration_ms):
+def write_slide_timings_mux_file(slide_timings, output_filename, total_duration_ms, use_cache=True, fps=None):
     """
     Prepare a file for the ffmpeg concat demuxer.
     This file may be used as an input to ffmpeg to provide the slides for a talk.
@@ -296,54 +1094,65 @@ def write_slide_timings_mux_file(slide_timings, output_filename, total_duration_
     :param total_duration_ms: The total duration of the video that will be created by this mux file. The last slide will
         persist to this time.
 
+    :param use_cache: Point at copies of the slides scaled to the camera size (see `rcslides.cached_slide`), rather
+        than at the original images, which then have to match the camera already.
+
+    :param fps: The frame rate of the video. Each slide change is moved to the nearest frame of it, and the durations
+        are written to the microsecond, which is what the concat demuxer adds them up in, so that they do not drift.
+        Defaults to the frame rate of the camera.
+
     """
+    parameters = load_parameters()
+    if fps is None:
+        fps = parameters.source_fps
+    filenames = [s['filename'] for s in slide_timings]
+    if use_cache:
+        filenames = [rcslides.cached_slide(f, parameters.source_w, parameters.source_h) for f in filenames]
+
+    # The microsecond at which each slide starts, and at which the last one stops
+    frames = [rctiming.frame_at(s['time'] // timedelta(milliseconds=1), fps) for s in slide_timings]
+    frames.append(rctiming.frame_at(total_duration_ms, fps))
+    starts_us = [math.floor(Fraction(frame) / fps * 10 ** 6) for frame in frames]
+
     with open(output_filename, 'w') as f:
+        last_filename = filenames[0]
         for i in range(len(slide_timings)):
-            f.write("file '{}'\n".format(slide_timings[i]['filename']))
-            start = slide_timings[i]['time']
-            try:
-                stop = slide_timings[i + 1]['time']
-            except IndexError:
-                stop = timedelta(seconds=total_duration_ms / 1000.)
-            f.write("duration {}\n".format(stop - start))
+            duration_us = starts_us[i + 1] - starts_us[i]
+            if duration_us <= 0:
+                continue  # replaced by a later slide on the same frame, or after the end of the video
+            last_filename = filenames[i]
+            f.write("file '{}'\n".format(os.path.abspath(last_filename)))
+            f.write("duration {}.{:06d}\n".format(*divmod(duration_us, 10 ** 6)))
         # Due to an issue in ffmpeg, we have to repeat the last filename
-        f.write("file '{}'\n".format(slide_timings[-1]['filename']))
+        f.write("file '{}'\n".format(os.path.abspath(last_filename)))
 
 
-def media_length(filename):
+def get_talk_ss_to(name: str):
     """
-    Get the duration of a video or audio file.
+    Get the duration to seek to (-ss option in ffmpeg) and the time at which the camera should shop (-to option in
+    ffmpeg) for the given talk.
 
-    :param filename: The video or audio file to analyse
+    :param name: The name of the talk as it appears in the spreadsheet.
 
-    :return: The duration, as an integer number of seconds.
+    :return float, float: The -ss and -to parameters for trimming the concatenated camera input, in milliseconds.
 
     """
-    try:
-        return int(subprocess.check_output(['mediainfo', '--Inform=General;%Duration%', filename]))
-    except:
-        raise RuntimeError('Is mediainfo installed? On linux, try: sudo apt install mediainfo')
+    talk = load_talk(name)
+    ffmpeg_ss = talk.start_time_ms
+    ffmpeg_to = sum(media_lengths(talk.input_files[:-1])) + talk.stop_time_ms
+    return ffmpeg_ss, ffmpeg_to
 
 
-def get_talk_ss_to(name: str):
+def get_talk_input_files(name: str):
     """
-    Get the duration to seek to (-ss option in ffmpeg) and the time at which the camera should shop (-to option in
-    ffmpeg) for the given talk.
+    Get the camera clips that make up the specified talk.
 
     :param name: The name of the talk as it appears in the spreadsheet.
 
-    :return float, float: The -ss and -to parameters for trimming the concatenated camera input, in milliseconds.
+    :return list: The absolute filenames of the clips, in order.
 
     """
-    talk_info = load_talk_info(name)
-    parameters = get_parameters()
-    input_files = [os.path.join(parameters['rc_base_folder'], talk_info['cam_input_folder'], "MVI_{:04d}.MP4".format(i)) for i in range(
-        int(talk_info['start_video']),
-        int(talk_info['stop_video']) + 1
-    )]
-    ffmpeg_ss = float(talk_info['start_time_ms'])
-    ffmpeg_to = sum(media_length(f) for f in input_files[:-1]) + float(talk_info['stop_time_ms'])
-    return ffmpeg_ss, ffmpeg_to
+    return list(load_talk(name).input_files)
 
 
 def get_talk_duration(name: str):
@@ -368,200 +1177,530 @@ def write_camera_mux_file_for_talk(name, output_filename):
     :param output_filename: The name of the output file
 
     """
-    talk_info = load_talk_info(name)
-    parameters = get_parameters()
-    input_files = [os.path.join(parameters['rc_base_folder'], talk_info['cam_input_folder'], "MVI_{:04d}.MP4".format(i)) for i in range(
-        int(talk_info['start_video']),
-        int(talk_info['stop_video']) + 1
-    )]
+    input_files = get_talk_input_files(name)
     with open(output_filename, 'w') as mux_file:
         mux_file.write("\n".join("file '{}'".format(f) for f in input_files))
 
 
-def write_camera_mux_files_for_qa(name, cam1_mux_filename, cam2_mux_filename):
+def write_camera_mux_files_for_qa(name, *mux_filenames):
     """
-    Write mux files which tell ffmpeg to concatenate the source video files for the two cameras used during Q&A
+    Write mux files which tell ffmpeg to concatenate the source video files for each of the cameras used during Q&A
     sessions.
 
     :param name: The name of the q&a session as it appears in the spreadsheet.
 
-    :param cam1_mux_filename: The name of the output file for camera 1
-
-    :param cam2_mux_filename: The name of the output file for camera 2
+    :param mux_filenames: The name of the output file for each camera, starting with camera 1.
 
     :return: The values of the -ss and -to parameters that should be passed to ffmpeg when these mux files are used as
-        inputs.
-
-    """
-    qa_info = load_qa_info(name)
-    parameters = get_parameters()
-
-    cam1_input_files = [os.path.join(
-        parameters['rc_base_folder'],
-        qa_info['cam1_input_folder'],
-        "MVI_{:04d}.MP4".format(i)
-    ) for i in range(
-        int(qa_info['cam1_start_video']),
-        int(qa_info['cam1_stop_video']) + 1
-    )]
-    cam2_input_files = [os.path.join(
-        parameters['rc_base_folder'],
-        qa_info['cam2_input_folder'],
-        "MVI_{:04d}.MP4".format(i)
-    ) for i in range(
-        int(qa_info['cam2_start_video']),
-        int(qa_info['cam2_stop_video']) + 1
-    )]
-    ffmpeg_ss = float(qa_info['cam1_start_time_ms'])
-    ffmpeg_to = sum(media_length(f) for f in cam1_input_files[:-1]) + float(qa_info['cam1_stop_time_ms'])
-    with open(cam1_mux_filename, 'w') as mux_file:
-        mux_file.write("\n".join("file '{}'".format(f) for f in cam1_input_files))
-    with open(cam2_mux_filename, 'w') as mux_file:
-        mux_file.write("\n".join("file '{}'".format(f) for f in cam2_input_files))
+        inputs, in the time of camera 1.
+
+    """
+    qa = load_qa_session(name)
+    if len(mux_filenames) != len(qa.cameras):
+        raise ValueError("{} has {} cameras, but {} mux files were given.".format(
+            name, len(qa.cameras), len(mux_filenames)))
+
+    cam1 = qa.cameras[0]
+    ffmpeg_ss = qa.start_time_ms
+    ffmpeg_to = sum(media_lengths(cam1.input_files[:-1])) + qa.stop_time_ms
+    for camera, mux_filename in zip(qa.cameras, mux_filenames):
+        with open(mux_filename, 'w') as mux_file:
+            mux_file.write("\n".join("file '{}'".format(f) for f in camera.input_files))
     return ffmpeg_ss, ffmpeg_to
 
 
-def extract_talk(name):
+def sync_qa_cameras(name, force=False, min_confidence=.4, dry_run=False):
     """
-    Make a 480p split-screen video of the camera and a black canvas (over which slides will be shown)
+    Find the sync delays of the cameras used during a Q&A session, by correlating their audio with that of camera 1.
+
+    The audio of each camera is extracted from its concat mux and correlated with camera 1, like the microphones of a
+    talk (see `extract_microphones_audio_for_talk`). The result is written to `<name>_sync.json`: for each camera after
+    camera 1, the delay in ms, the ratio of the highest correlation peak to the second highest, a confidence between 0
+    and 1, and whether it is flagged as unreliable. `extract_qa` uses the delays which are not flagged instead of the
+    ones in the qa sheet, see `load_synced_qa_session`. The delays are only found again when the camera clips change.
+
+    :param name: The name of the q&a session as it appears in the spreadsheet.
+
+    :param force: Find the delays even if the camera clips have not changed since the last time.
+
+    :param min_confidence: The confidence below which a delay is flagged, and the one in the qa sheet is used instead.
+
+    :param dry_run: Only plan the commands. The correlation is planned as a call to this function.
+
+    :return: The report, as a dictionary, or a list of `rcplan.CommandSpec` for a dry run.
+
+    """
+    qa = load_qa_session(name)
+    output_dir = get_output_dir(name)
+    report_filename = os.path.join(output_dir, '{}_sync.json'.format(name))
+    mux_filenames = [os.path.join(output_dir, '{}_camera{}.mux'.format(name, i)) for i in range(1, len(qa.cameras) + 1)]
+    wav_filenames = [os.path.join(output_dir, '{}_camera{}.wav'.format(name, i)) for i in range(1, len(qa.cameras) + 1)]
+
+    inputs_fingerprint = _qa_sync_fingerprint(qa)
+    fingerprint = rcfingerprint.fingerprint({'inputs': inputs_fingerprint, 'min_confidence': min_confidence})
+    if is_up_to_date(report_filename, fingerprint, force, dry_run):
+        if dry_run:
+            return []
+        with open(report_filename, 'r') as f:
+            return json.load(f)
+
+    write_camera_mux_files_for_qa(name, *mux_filenames)
+    specs = [command_spec('sync_qa_cameras', name, [
+        'ffmpeg',
+        # global options:
+        '-y',  # overwrite
+        # input stream 0:
+        '-safe', '0',  # allow absolute paths
+        '-f', 'concat',
+        '-i', mux_filename,
+        # output options:
+        '-vn',
+        '-ac', '1',
+        '-ar', str(qa_sync_sample_rate),
+        wav_filename
+    ], inputs=[mux_filename] + list(camera.input_files), outputs=[wav_filename],
+        duration_ms=sum(media_lengths(camera.input_files)))
+        for camera, mux_filename, wav_filename in zip(qa.cameras, mux_filenames, wav_filenames)]
+    if dry_run:
+        return specs + [command_spec(
+            'sync_qa_cameras', name,
+            rcplan.python_argv('sync_qa_cameras', name, min_confidence=min_confidence),
+            inputs=wav_filenames, outputs=[report_filename],
+            duration_ms=sum(spec.duration_ms for spec in specs),
+            cost_per_second=rcplan.analysis_cost_per_second,
+        )]
+
+    report = {'name': name, 'inputs': inputs_fingerprint, 'cameras': [], 'elapsed': {}}
+    t_start = time.time()
+    for spec in specs:
+        run_command_spec(spec)
+    report['elapsed']['extract_camera_audio'] = time.time() - t_start
+
+    # numpy, scipy and pyfftw take long to import, and only the stages that correlate audio need them
+    import rcsignal
+
+    for i, wav_filename in enumerate(wav_filenames[1:], 2):
+        t_start = time.time()
+        delay, levels = rcsignal.estimate_delay(wav_filenames[0], wav_filename, resolutions=(1., .01))
+        # As for the microphones, only the peak at the coarse level says whether the right part was found at all
+        ratio = rcsignal.peak_ratio(levels[0]['correlation'], exclusion=2)
+        confidence = rcsignal.peak_confidence(ratio)
+        report['cameras'].append({
+            'camera': i,
+            'sync_delay_ms': float(delay) * 1000.,
+            'peak_ratio': ratio if math.isfinite(ratio) else None,  # JSON has no infinity
+            'confidence': confidence,
+            'flagged': confidence < min_confidence,
+        })
+        report['elapsed']['correlate_camera{}'.format(i)] = time.time() - t_start
+
+    with open(report_filename, 'w') as f:
+        json.dump(report, f, indent=2)
+    rcfingerprint.record(report_filename, fingerprint)
+    for wav_filename in wav_filenames:
+        os.remove(wav_filename)  # only needed for the correlation, and large
+
+    for camera in report['cameras']:
+        if camera['flagged']:
+            print("The delay of camera {} of {} could not be found reliably (confidence {:.2f}), so the one in the qa "
+                  "sheet is used. See {}".format(camera['camera'], name, camera['confidence'], report_filename))
+    return report
+
+
+def _qa_sync_fingerprint(qa):
+    return rcfingerprint.fingerprint({
+        'camera_files': [[rcfingerprint.file_stat(f) for f in camera.input_files] for camera in qa.cameras],
+        'sample_rate': qa_sync_sample_rate,
+    })
+
+
+def load_synced_qa_session(name):
+    """
+    Get a Q&A session, with the sync delays found by `sync_qa_cameras` instead of the ones in the sheet, where they
+    were found reliably from the current camera clips.
+
+    :param name: The name of the q&a session as it appears in the spreadsheet.
+
+    :return QASession:
+
+    """
+    qa = load_qa_session(name)
+    report_filename = os.path.join(get_output_dir(name), '{}_sync.json'.format(name))
+    try:
+        with open(report_filename, 'r') as f:
+            report = json.load(f)
+    except FileNotFoundError:
+        return qa
+    if report.get('inputs') != _qa_sync_fingerprint(qa):
+        return qa  # made from other camera clips
+    delays = {camera['camera']: camera['sync_delay_ms'] for camera in report['cameras'] if not camera['flagged']}
+    return qa.with_sync_delays([delays.get(i) for i in range(2, len(qa.cameras) + 1)])
+
+
+def get_grid_layout(n_tiles, tile_width, tile_height):
+    """
+    Arrange tiles in a grid which is as square as possible, filled row by row.
+
+    :return: The number of columns and rows, and the layout for ffmpeg's xstack filter.
+
+    >>> get_grid_layout(2, 854, 480)
+    (2, 1, '0_0|854_0')
+    >>> get_grid_layout(3, 854, 480)
+    (2, 2, '0_0|854_0|0_480')
+    """
+    columns = math.ceil(math.sqrt(n_tiles))
+    rows = math.ceil(n_tiles / columns)
+    layout = '|'.join('{}_{}'.format((i % columns) * tile_width, (i // columns) * tile_height) for i in range(n_tiles))
+    return columns, rows, layout
+
+
+def extract_talk(name, profile='proxy', crf=None, preset=None, force=False, dry_run=False):
+    """
+    Make a split-screen video of the camera and a black canvas (over which slides will be shown)
     This is used for gathering timing information.
 
+    The video is written to `<name>_<profile>.mp4`, and only made again when the camera clips, the spreadsheet row or
+    the profile change, so the proxy can be rendered once and reused by everyone doing the timing.
+
     :param name: The name of the talk as it appears in the spreadsheet.
 
+    :param profile: The name of the encoder profile, see `rcprofiles`.
+
+    :param crf: Override the crf of the profile.
+
+    :param preset: Override the preset of the profile.
+
+    :param force: Make the video even if none of its inputs have changed since the last time.
+
+    :param dry_run: Only plan the command.
+
+    :return: The filename of the video, or a list of `rcplan.CommandSpec` for a dry run.
+
     """
-    parameters = get_parameters()
+    profile = get_profile(profile, crf=crf, preset=preset)
+
+    video_filename = os.path.join(get_output_dir(name), '{}_{}.mp4'.format(name, profile.name))
+    ffmpeg_ss, ffmpeg_to = get_talk_ss_to(name)
+    fingerprint = rcfingerprint.fingerprint({
+        'talk_info': load_talk_info(name),
+        'camera_files': [rcfingerprint.file_stat(f) for f in get_talk_input_files(name)],
+        'ss_to_ms': [ffmpeg_ss, ffmpeg_to],
+        'profile': profile.describe(),
+    })
+    if is_up_to_date(video_filename, fingerprint, force, dry_run):
+        return [] if dry_run else video_filename
 
-    camera_mux_filename = os.path.join(parameters['output_dir'], name, '{}_camera.mux'.format(name))
+    camera_mux_filename = os.path.join(get_output_dir(name), '{}_camera.mux'.format(name))
     write_camera_mux_file_for_talk(name, camera_mux_filename)
 
-    video_filename = os.path.join(parameters['output_dir'], name, '{}.mp4'.format(name))
-    ffmpeg_ss, ffmpeg_to = get_talk_ss_to(name)
-    subprocess.check_call([
+    # The canvas on the left is 4:3, e.g. 640 wide at 480p
+    filters = [f for f in [profile.scale_filter(), 'pad=iw+ih*4/3:ih:ih*4/3'] if f is not None]
+
+    spec = command_spec('extract_talk', name, [
         'ffmpeg',
         # global options:
         '-y',  # overwrite
         # input stream 0:
+    ] + list(profile.decode_options) + [
         '-safe', '0',  # allow absolute paths
         '-f', 'concat',
         '-i', camera_mux_filename,
         # output options:
         '-ss', str(ffmpeg_ss / 1000.),
         '-to', str(ffmpeg_to / 1000.),
-        '-vf', 'scale=-1:480,pad=iw+640:ih:640',
-        '-c:v', 'libx264',
-        '-crf', '30',
+        '-vf', ','.join(filters),
+    ] + profile.encode_options() + [
         '-c:a', 'copy',
-        '-preset', 'ultrafast',
         video_filename
-    ])
+    ], inputs=[camera_mux_filename] + get_talk_input_files(name), outputs=[video_filename],
+        duration_ms=ffmpeg_to - ffmpeg_ss, profile=profile)
+    if dry_run:
+        return [spec]
+
+    run_command_spec(spec)
+    rcfingerprint.record(video_filename, fingerprint)
+    return video_filename
 
 
-def extract_qa(name, dry_run=False):
+def extract_qa(name, dry_run=False, profile='proxy', crf=None, preset=None, force=False):
     """
-    Make a 480p split-screen video of the two cameras used during Q&A.
+    Make a video of all the cameras used during Q&A, side by side, or in a grid for more than two cameras.
     This is used for gathering timing information.
 
+    Each camera is scaled down to its tile before the tiles are put together, so the filters after the scaling only
+    handle small frames. The cameras are lined up by their sync delays, from `sync_qa_cameras` or the qa sheet, and
+    their audio is mixed.
+
     :param name: The name of the q&a session as it appears in the spreadsheet.
 
-    :param dry_run: Whether to actually create the video, or to just return the ffmpeg command that would be used.
+    :param dry_run: Whether to actually create the video, or to just plan the ffmpeg command that would be used.
 
-    :return: The result of check_call or the command that would be called.
+    :param profile: The name of the encoder profile, see `rcprofiles`. Each camera is scaled to the resolution of the
+        profile, or to 480p if the profile keeps the source size, since several cameras next to each other would be
+        too big.
+
+    :param crf: Override the crf of the profile.
+
+    :param preset: Override the preset of the profile.
+
+    :param force: Make the video even if none of its inputs have changed since the last time.
+
+    :return: The result of check_call, None if the video is up to date, or a list of `rcplan.CommandSpec` for a dry
+        run. `CommandSpec.command_line` gives the command as a string.
+
+    :raises ValueError: If the sync delay of a camera is neither in the qa sheet nor found by `sync_qa_cameras`.
 
     """
-    parameters = get_parameters()
-    qa_info = load_qa_info(name)
+    qa = load_synced_qa_session(name)
+    parameters = load_parameters()
+    profile = get_profile(profile, crf=crf, preset=preset)
+    n_cameras = len(qa.cameras)
+
+    mux_filenames = [os.path.join(get_output_dir(name), '{}_camera{}.mux'.format(name, i))
+                     for i in range(1, n_cameras + 1)]
+    ffmpeg_ss, ffmpeg_to = write_camera_mux_files_for_qa(name, *mux_filenames)
+    # The inputs are shifted so that the camera which started first starts at 0, which moves camera 1 as well
+    offsets_ms = qa.camera_offsets_ms()
+    ffmpeg_ss += offsets_ms[0]
+    ffmpeg_to += offsets_ms[0]
+
+    video_filename = os.path.join(get_output_dir(name), '{}.mp4'.format(name))
+    fingerprint = rcfingerprint.fingerprint({
+        'qa_info': load_qa_info(name),
+        'camera_files': [rcfingerprint.file_stat(f) for camera in qa.cameras for f in camera.input_files],
+        'ss_to_ms': [ffmpeg_ss, ffmpeg_to],
+        'offsets_ms': offsets_ms,
+        'profile': profile.describe(),
+        'compositor': 'grid',
+    })
+    if is_up_to_date(video_filename, fingerprint, force, dry_run):
+        return [] if dry_run else None
+
+    tile_height = profile.resolution or 480
+    tile_width = 2 * round(parameters.source_w * tile_height / parameters.source_h / 2)
+    columns, rows, layout = get_grid_layout(n_cameras, tile_width, tile_height)
 
-    cam1_mux_filename = os.path.join(parameters['output_dir'], name, '{}_camera1.mux'.format(name))
-    cam2_mux_filename = os.path.join(parameters['output_dir'], name, '{}_camera2.mux'.format(name))
-    ffmpeg_ss, ffmpeg_to = write_camera_mux_files_for_qa(name, cam1_mux_filename, cam2_mux_filename)
-    video_filename = os.path.join(parameters['output_dir'], name, '{}.mp4'.format(name))
     ffmpeg_command = [
         'ffmpeg',
         # global options:
         '-y',  # overwrite
     ]
-
-    if qa_info['sync_delay_ms'] > 0:
-        # cam1 starts first
+    for mux_filename, offset_ms in zip(mux_filenames, offsets_ms):
+        # input stream i:
+        if offset_ms:
+            ffmpeg_command.extend(['-itsoffset', str(offset_ms / 1000.)])
         ffmpeg_command.extend([
-            # input stream 0:
-            '-safe', '0',  # allow absolute paths
-            '-f', 'concat',
-            '-i', cam1_mux_filename,
-            # input stream 1:
-            '-itsoffset', str(qa_info['sync_delay_ms'] / 1000.),
-            '-safe', '0',  # allow absolute paths
-            '-f', 'concat',
-            '-i', cam2_mux_filename,
-            # processing:
-            '-filter_complex',
-            ';'.join([
-                '[0:v]pad=iw*2:ih[padded]',  # pad cam1, put it on the left
-                '[padded][1:v]overlay=W/2:0[sidebyside]',  # overlay cam2 on the right
-                '[sidebyside]scale=-2:480[v]',
-                '[0:a][1:a]amix[a]',
-            ]),
-        ])
-    elif qa_info['sync_delay_ms'] < 0:
-        # cam2 starts first
-        ffmpeg_command.extend([
-            # input stream 0:
-            '-itsoffset', str(-qa_info['sync_delay_ms'] / 1000.),
-            '-safe', '0',  # allow absolute paths
-            '-f', 'concat',
-            '-i', cam1_mux_filename,
-            # input stream 1:
-            '-safe', '0',  # allow absolute paths
-            '-f', 'concat',
-            '-i', cam2_mux_filename,
-            # processing:
-            '-filter_complex',
-            ';'.join([
-                '[1:v]pad=iw*2:ih:iw:0[padded]',  # pad cam2, put it on the right
-                '[padded][0:v]overlay=0:0[sidebyside]',  # overlay cam1 on the left
-                '[sidebyside]scale=-2:480[v]',
-                '[0:a][1:a]amix[a]',
-            ]),
-        ])
-    else:
-        # cam1 and cam2 are already synchronised
-        ffmpeg_command.extend([
-            # input stream 0:
-            '-safe', '0',  # allow absolute paths
-            '-f', 'concat',
-            '-i', cam1_mux_filename,
-            # input stream 1:
             '-safe', '0',  # allow absolute paths
             '-f', 'concat',
-            '-i', cam2_mux_filename,
-            # processing:
-            '-filter_complex',
-            ';'.join([
-                '[0:v]pad=iw*2:ih[padded]',  # pad cam1, put it on the left
-                '[padded][1:v]overlay=W/2:0[sidebyside]',  # overlay cam2 on the right
-                '[sidebyside]scale=-2:480[v]',
-                '[0:a][1:a]amix[a]',
-            ]),
+        ] + list(profile.decode_options) + [
+            '-i', mux_filename,
         ])
 
+    filters = []
+    for i in range(n_cameras):
+        # Scale each camera to its tile first, keeping its aspect ratio, e.g. for a handheld camera
+        filters.append('[{}:v]scale={}:{}:force_original_aspect_ratio=decrease:flags={},'
+                       'pad={}:{}:(ow-iw)/2:(oh-ih)/2,setsar=1[v{}]'.format(
+                           i, tile_width, tile_height, profile.scale_flags, tile_width, tile_height, i))
+    filters.append('{}xstack=inputs={}:layout={}{}[v]'.format(
+        ''.join('[v{}]'.format(i) for i in range(n_cameras)), n_cameras, layout,
+        ':fill=black' if columns * rows > n_cameras else ''))
+    for i in range(n_cameras):
+        # Fill the time before a camera started with silence, so that the audio lines up with the video
+        filters.append('[{}:a]aresample=async=1:first_pts=0[a{}]'.format(i, i))
+    filters.append('{}amix=inputs={}:dropout_transition=0[a]'.format(
+        ''.join('[a{}]'.format(i) for i in range(n_cameras)), n_cameras))
+
     ffmpeg_command.extend([
+        # processing:
+        '-filter_complex', ';'.join(filters),
         # output options:
         '-map', '[v]',
         '-map', '[a]',
         '-ac', '2',
         '-ss', str(ffmpeg_ss / 1000.),
         '-to', str(ffmpeg_to / 1000.),
-        '-c:v', 'libx264',
-        '-crf', '30',
-        '-preset', 'ultrafast',
-        '-async', '1',
+    ] + profile.encode_options() + [
         video_filename
     ])
 
+    inputs = mux_filenames + [f for camera in qa.cameras for f in camera.input_files]
+    spec = command_spec('extract_qa', name, ffmpeg_command, inputs=inputs, outputs=[video_filename],
+                        duration_ms=ffmpeg_to - ffmpeg_ss, profile=profile)
     if dry_run:
-        return subprocess.list2cmdline(ffmpeg_command)
+        return [spec]
+    result = run_command_spec(spec)
+    rcfingerprint.record(video_filename, fingerprint)
+    return result
+
+
+def is_up_to_date(output_filename, fingerprint, force=False, dry_run=False):
+    """
+    Check whether a stage can be skipped, because its output was already made from the same inputs.
+
+    :param output_filename: The output of the stage.
+
+    :param fingerprint: The fingerprint of the current inputs of the stage.
+
+    :param force: Never skip the stage.
+
+    :param dry_run: Only check, without reporting it or forgetting the fingerprint of an output that is out of date.
+
+    :return: True if the stage can be skipped.
+
+    """
+    if not force and rcfingerprint.is_up_to_date(output_filename, fingerprint):
+        if not dry_run:
+            print("{} is up to date, skipping.".format(output_filename))
+        return True
+    if not dry_run:
+        rcfingerprint.invalidate(output_filename)
+    return False
+
+
+def command_spec(stage, name, argv, inputs, outputs, duration_ms, profile=None, cost_per_second=None):
+    """
+    Describe a command of a stage, for plans (see `rcplan`).
+
+    :param stage: The name of the stage.
+
+    :param name: The name of the talk or q&a session.
+
+    :param argv: The command.
+
+    :param inputs: The files the command reads.
+
+    :param outputs: The files the command writes.
+
+    :param duration_ms: The duration of the output, from which the cost is estimated.
+
+    :param profile: The encoder profile, for commands which encode video.
+
+    :param cost_per_second: The cost per second of output for commands which do not encode video. Defaults to that of
+        copying streams.
+
+    :return rcplan.CommandSpec:
+
+    """
+    duration_s = duration_ms / 1000.
+    if profile is not None:
+        estimated_cost = profile.estimated_cost(duration_s, load_parameters().source_h)
     else:
-        return subprocess.check_call(ffmpeg_command)
+        estimated_cost = duration_s * (rcplan.copy_cost_per_second if cost_per_second is None else cost_per_second)
+    return rcplan.CommandSpec(
+        stage=stage,
+        name=name,
+        inputs=tuple(inputs),
+        outputs=tuple(outputs),
+        argv=tuple(argv),
+        estimated_cost=estimated_cost,
+        duration_ms=duration_ms,
+    )
+
+
+def run_ffmpeg(command, threads=None, stage=None, name=None, duration_ms=None):
+    """
+    Run an ffmpeg command, applying the `ffmpeg_threads` budget to the output.
+
+    ffmpeg's status line is replaced by a progress report every few seconds, and the speed of the command is recorded
+    in the metrics file, see `rcprogress`.
+
+    :param command: The full ffmpeg command, with the output filename last.
+
+    :param threads: Use this many threads instead of `ffmpeg_threads`, e.g. for one of several segments of a video
+        which are encoded at the same time.
+
+    :param stage: The stage the command belongs to, for the report and the metrics.
+
+    :param name: The name of the talk or q&a session.
+
+    :param duration_ms: The expected duration of the output, to report how much is done.
+
+    :return: The return code, which is always 0.
+
+    :raises subprocess.CalledProcessError: If ffmpeg fails.
+
+    """
+    with publishing(command[-1]) as tmp_filename:
+        return rcprogress.run(_with_thread_budget(command[:-1] + [tmp_filename], threads), stage, name, duration_ms,
+                              output=command[-1], metrics_file=get_metrics_file())
+
+
+def read_ffmpeg_output(command, read, threads=None, stage=None, name=None, duration_ms=None):
+    """
+    Run an ffmpeg command which writes its output to stdout, like `run_ffmpeg`, and read the output while ffmpeg writes
+    it, see `rcprogress.read_output`.
+
+    :param command: The full ffmpeg command, with `-` as the output.
+
+    :param read: A function which reads the output from a binary file, and returns what it makes of it.
+
+    The other parameters are those of `run_ffmpeg`.
+
+    :return: What `read` returned.
+
+    :raises subprocess.CalledProcessError: If ffmpeg fails.
+
+    """
+    return rcprogress.read_output(_with_thread_budget(command, threads), read, stage, name, duration_ms,
+                                  metrics_file=get_metrics_file())
+
+
+def run_command_spec(spec, threads=None):
+    """Run the command of a `rcplan.CommandSpec`, see `run_ffmpeg`."""
+    return run_ffmpeg(list(spec.argv), threads, spec.stage, spec.name, spec.duration_ms)
+
+
+def get_metrics_file():
+    if metrics_file is not None:
+        return metrics_file
+    return os.path.join(load_parameters().output_folder, 'rcmetrics.jsonl')
+
+
+@contextlib.contextmanager
+def publishing(output_filename):
+    """
+    Write an output under a temporary name, and rename it to `output_filename` once it is complete.
+
+    Other stages, and other machines sharing the output folder (see `rcqueue`), therefore never see a half-written
+    file, and two workers making the same output do not write into the same file. The temporary name keeps the
+    extension, so that ffmpeg still picks the format from it. It is removed if writing fails.
+
+    :param output_filename: The output of the stage.
+
+    :return: A context manager giving the temporary filename to write.
+
+    """
+    root, ext = os.path.splitext(output_filename)
+    tmp_filename = '{}.{}-{}.tmp{}'.format(root, socket.gethostname(), os.getpid(), ext)
+    try:
+        yield tmp_filename
+        os.replace(tmp_filename, output_filename)
+    finally:
+        try:
+            os.remove(tmp_filename)
+        except FileNotFoundError:
+            pass
+
+
+def _with_thread_budget(command, threads=None):
+    if threads is None:
+        threads = ffmpeg_threads
+    if threads is not None:
+        threads = str(int(threads))
+        command = command[:1] + ['-filter_complex_threads', threads] + command[1:-1] + ['-threads', threads] + command[-1:]
+    return command
+
+
+def _scale_options(profile):
+    scale_filter = profile.scale_filter()
+    return [] if scale_filter is None else ['-vf', scale_filter]
+
+
+def _scale_filter_chain(profile):
+    # For inserting into a filter chain, e.g. "...,{}setdar"
+    scale_filter = profile.scale_filter()
+    return '' if scale_filter is None else scale_filter + ','
 
 
 def mkdir(path):
@@ -575,19 +1714,90 @@ def mkdir(path):
 
 
 def get_output_dir(name):
-    parameters = get_parameters()
-    output_dir = os.path.join(parameters['output_folder'], name)
+    parameters = load_parameters()
+    output_dir = os.path.join(parameters.output_folder, name)
     mkdir(output_dir)
     return output_dir
 
 
+@functools.lru_cache(maxsize=None, typed=False)
+def load_talk(name):
+    """
+    Get a talk, parsed and checked.
+
+    :param name: The name of the talk as it appears in the spreadsheet.
+
+    :return Talk:
+
+    :raises ValueError: If the row of the talk is broken.
+
+    """
+    return Talk.from_row(load_talk_info(name), load_parameters())
+
+
+def load_all_talks():
+    """
+    Get all the talks, parsed and checked.
+
+    :return: A dictionary mapping the name of each talk to a `Talk`.
+
+    :raises ValueError: If any row of the talks sheet is broken.
+
+    """
+    return {name: load_talk(name) for name in load_all_talk_info()}
+
+
+@functools.lru_cache(maxsize=None, typed=False)
+def load_qa_session(name):
+    """
+    Get a Q&A session, parsed and checked.
+
+    :param name: The name of the q&a session as it appears in the spreadsheet.
+
+    :return QASession:
+
+    :raises ValueError: If the row of the session is broken.
+
+    """
+    return QASession.from_row(load_qa_info(name), load_parameters())
+
+
+def load_all_qa_sessions():
+    """
+    Get all the Q&A sessions, parsed and checked.
+
+    :return: A dictionary mapping the name of each session to a `QASession`.
+
+    :raises ValueError: If any row of the qa sheet is broken.
+
+    """
+    return {name: load_qa_session(name) for name in load_all_qa_info()}
+
+
+@functools.lru_cache(maxsize=1, typed=False)
+def load_parameters():
+    """
+    Get the global settings, parsed and checked.
+
+    :return Parameters:
+
+    """
+    return Parameters.from_row(get_parameters())
+
+
 def load_talk_info(name):
     return load_all_talk_info()[name]
 
 
+@functools.lru_cache(maxsize=1, typed=False)
+def load_info_sheets():
+    """Read all the sheets we need from the info spreadsheet at once, or from the cache if it has not changed."""
+    return rcods.load_sheets(info_file, ['talks', 'qa', 'parameters'])
+
+
 @functools.lru_cache(maxsize=1, typed=False)
 def load_all_talk_info():
-    sheet = ODSReader(info_file).getSheet('talks')
+    sheet = load_info_sheets()['talks']
     keys = sheet[0]
     return {values[0]: dict(zip(keys, values)) for values in sheet[1:]}
 
@@ -598,11 +1808,11 @@ def load_qa_info(name):
 
 @functools.lru_cache(maxsize=1, typed=False)
 def load_all_qa_info():
-    sheet = ODSReader(info_file).getSheet('qa')
+    sheet = load_info_sheets()['qa']
     keys = sheet[0]
     return {values[0]: dict(zip(keys, values)) for values in sheet[1:]}
 
 
 @functools.lru_cache(maxsize=1, typed=False)
 def get_parameters():
-    return {x[0]: x[1] for x in ODSReader(info_file).getSheet('parameters')}
+    return {x[0]: x[1] for x in load_info_sheets()['parameters']}
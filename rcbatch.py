@@ -0,0 +1,225 @@
+"""
+Process the whole conference in parallel.
+
+Every talk is broken up into the stages in `rc`, with the dependencies between them. The stages of all the talks and
+Q&A sessions form one dependency graph, which is run on a process pool. Stages which do not depend on each other, even
+within the same talk, run at the same time.
+"""
+
+import collections
+import concurrent.futures
+import os
+import sys
+import time
+import traceback
+
+import rc
+import rcslides
+
+Job = collections.namedtuple('Job', ['stage', 'name', 'depends_on'])
+
+talk_stages = collections.OrderedDict([
+    # stage: the stages it depends on
+    ('concatenate_camera_clips_for_talk', []),
+    ('extract_camera_audio_for_talk', ['concatenate_camera_clips_for_talk']),
+    ('extract_microphones_audio_for_talk', ['extract_camera_audio_for_talk']),
+    ('make_slide_video_for_talk', []),
+    ('make_talk_video', ['concatenate_camera_clips_for_talk', 'make_slide_video_for_talk']),
+    ('propose_timings_for_talk', []),
+])
+
+qa_stages = collections.OrderedDict([
+    ('sync_qa_cameras', []),
+    ('extract_qa', ['sync_qa_cameras']),
+])
+
+# Stages which only run when asked for by name, e.g. with `--stage`
+optional_stages = {
+    'propose_timings_for_talk',  # a starting point for the timing, not part of the videos
+}
+
+# Keyword arguments for stages which would otherwise wait for a human
+stage_options = {
+    'extract_microphones_audio_for_talk': {'interactive': False},
+}
+
+# The stages which encode video, and therefore take an encoder profile
+video_stages = {
+    'concatenate_camera_clips_for_talk',
+    'make_slide_video_for_talk',
+    'make_talk_video',
+    'extract_qa',
+}
+
+
+def talk_jobs(name, stages=None):
+    """
+    Get the jobs needed to process one talk.
+
+    :param name: The name of the talk as it appears in the spreadsheet.
+
+    :param stages: Only include these stages. Dependencies on stages which are left out are dropped, so that e.g. only
+        the final video can be remade from existing intermediate videos. Defaults to all the stages but the
+        `optional_stages`.
+
+    :return: A list of jobs.
+
+    """
+    return _jobs(name, talk_stages, stages)
+
+
+def qa_jobs(name, stages=None):
+    """
+    Get the jobs needed to process one Q&A session.
+
+    :param name: The name of the q&a session as it appears in the spreadsheet.
+
+    :param stages: Only include these stages.
+
+    :return: A list of jobs.
+
+    """
+    return _jobs(name, qa_stages, stages)
+
+
+def conference_jobs(talks=None, qas=None, stages=None, log=sys.stdout):
+    """
+    Get the jobs needed to process the whole conference.
+
+    :param talks: The names of the talks to process. Defaults to all the talks in the spreadsheet.
+
+    :param qas: The names of the q&a sessions to process. Defaults to all the sessions in the spreadsheet.
+
+    :param stages: Only include these stages.
+
+    :param log: Where to report rows which are broken, and therefore left out.
+
+    :return: A list of jobs.
+
+    """
+    if talks is None:
+        talks = list(rc.load_all_talk_info())
+    if qas is None:
+        qas = list(rc.load_all_qa_info())
+
+    # Parse and check every row up front, so that a broken row is reported before anything is encoded rather than
+    # when its first stage runs.
+    jobs = []
+    for name in talks:
+        if _check_row(rc.load_talk, name, log):
+            jobs.extend(talk_jobs(name, stages))
+    for name in qas:
+        if _check_row(rc.load_qa_session, name, log):
+            jobs.extend(qa_jobs(name, stages))
+    return jobs
+
+
+def run_jobs(jobs, max_workers=None, ffmpeg_threads=None, profile=None, log=sys.stdout):
+    """
+    Run jobs on a process pool, starting each job as soon as the jobs it depends on are done.
+
+    When a job fails, the jobs that depend on it are skipped, but everything else carries on.
+
+    :param jobs: A list of jobs, e.g. from `conference_jobs`.
+
+    :param max_workers: The maximum number of jobs (and therefore ffmpeg encodes) that run at the same time. Defaults
+        to a quarter of the cores, since x264 uses several threads per encode anyway.
+
+    :param ffmpeg_threads: The number of threads each ffmpeg process may use. Defaults to the cores divided evenly
+        between the workers.
+
+    :param profile: The encoder profile for all the stages which encode video, see `rcprofiles`. Defaults to the
+        default profile of each stage.
+
+    :param log: Where to report progress.
+
+    :return: A dictionary mapping each job to 'done', 'failed' or 'skipped'.
+
+    """
+    cpu_count = os.cpu_count() or 1
+    if max_workers is None:
+        max_workers = max(1, cpu_count // 4)
+    if ffmpeg_threads is None:
+        ffmpeg_threads = max(1, cpu_count // max_workers)
+
+    waiting = list(jobs)
+    results = {}
+    running = {}
+    started = {}
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_worker,
+            initargs=(ffmpeg_threads,),
+    ) as executor:
+        while waiting or running:
+            for job in list(waiting):
+                states = [results.get(_key(job, stage)) for stage in job.depends_on]
+                if any(state in ('failed', 'skipped') for state in states):
+                    waiting.remove(job)
+                    results[_key(job)] = 'skipped'
+                    print("Skipping {} for {}, since a stage it depends on did not succeed".format(*_key(job)), file=log)
+                elif all(state == 'done' for state in states):
+                    waiting.remove(job)
+                    running[executor.submit(_run_job, job.stage, job.name, profile)] = job
+                    started[_key(job)] = time.time()
+                    print("Started {} for {}".format(*_key(job)), file=log)
+
+            if not running:
+                # Everything left is waiting on a job which is not in the list.
+                for job in waiting:
+                    results[_key(job)] = 'skipped'
+                    print("Skipping {} for {}, since a stage it depends on is missing".format(*_key(job)), file=log)
+                break
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                elapsed = time.time() - started[_key(job)]
+                try:
+                    future.result()
+                except Exception:
+                    results[_key(job)] = 'failed'
+                    print("Failed {} for {} after {:.0f} s:".format(*_key(job), elapsed), file=log)
+                    print(traceback.format_exc(), file=log)
+                else:
+                    results[_key(job)] = 'done'
+                    print("Finished {} for {} in {:.0f} s".format(*_key(job), elapsed), file=log)
+            if not running:
+                rcslides.evict()  # no job is reading the slide cache now
+
+    return results
+
+
+def _jobs(name, all_stages, stages):
+    if stages is None:
+        stages = [stage for stage in all_stages if stage not in optional_stages]
+    return [
+        Job(stage=stage, name=name, depends_on=[d for d in depends_on if d in stages])
+        for stage, depends_on in all_stages.items()
+        if stage in stages
+    ]
+
+
+def _check_row(load, name, log):
+    try:
+        load(name)
+    except ValueError as e:
+        print("Leaving out {}: {}".format(name, e), file=log)
+        return False
+    return True
+
+
+def _key(job, stage=None):
+    return stage or job.stage, job.name
+
+
+def _init_worker(ffmpeg_threads):
+    rc.ffmpeg_threads = ffmpeg_threads
+
+
+def _run_job(stage, name, profile=None):
+    options = dict(stage_options.get(stage, {}))
+    if profile is not None and stage in video_stages:
+        options['profile'] = profile
+    getattr(rc, stage)(name, **options)
@@ -0,0 +1,107 @@
+"""
+Make-style fingerprints, so that stages whose inputs have not changed can be skipped.
+
+Each output file gets a small sidecar file (`<output>.fingerprint`) with a hash of everything that went into it. A stage
+builds a dictionary describing its inputs, and only runs ffmpeg if the output is missing or the hash does not match.
+"""
+
+import hashlib
+import json
+import os
+
+
+def file_stat(filename):
+    """
+    Describe a file by its size and modification time, which is much cheaper than hashing its content.
+
+    :param filename: The file to describe.
+
+    :return: A list with the size and mtime (in ns) of the file, or None if the file does not exist.
+
+    """
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def file_hash(filename):
+    """
+    Hash the content of a (small) file, like a timing file.
+
+    :param filename: The file to hash.
+
+    :return: The hex digest of the content, or None if the file does not exist.
+
+    """
+    try:
+        with open(filename, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def fingerprint(inputs):
+    """
+    Calculate the fingerprint of the inputs of a stage.
+
+    :param inputs: Anything that can be serialised to JSON, e.g. a dictionary with the spreadsheet row, file stats and
+        encoder settings.
+
+    :return: The fingerprint, as a hex string.
+
+    >>> fingerprint({'crf': 18, 'preset': 'slow'}) == fingerprint({'preset': 'slow', 'crf': 18})
+    True
+    >>> fingerprint({'crf': 18, 'preset': 'slow'}) == fingerprint({'crf': 23, 'preset': 'slow'})
+    False
+    """
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def fingerprint_filename(output_filename):
+    return '{}.fingerprint'.format(output_filename)
+
+
+def is_up_to_date(output_filename, expected_fingerprint):
+    """
+    Check whether an output exists and was made from the same inputs.
+
+    :param output_filename: The output of the stage.
+
+    :param expected_fingerprint: The fingerprint of the current inputs of the stage.
+
+    :return: True if the stage can be skipped.
+
+    """
+    if not os.path.exists(output_filename):
+        return False
+    try:
+        with open(fingerprint_filename(output_filename), 'r') as f:
+            return f.read().strip() == expected_fingerprint
+    except FileNotFoundError:
+        return False
+
+
+def invalidate(output_filename):
+    """Forget the fingerprint of an output, e.g. before it is overwritten, so that a half-written file is never trusted."""
+    try:
+        os.remove(fingerprint_filename(output_filename))
+    except FileNotFoundError:
+        pass
+
+
+def record(output_filename, new_fingerprint):
+    """
+    Remember the fingerprint of an output that was created successfully.
+
+    :param output_filename: The output of the stage.
+
+    :param new_fingerprint: The fingerprint of the inputs that were used to create it.
+
+    """
+    # Written to a temporary file and renamed, like the outputs, so that no process ever reads half a fingerprint
+    tmp_filename = '{}.{}.tmp'.format(fingerprint_filename(output_filename), os.getpid())
+    with open(tmp_filename, 'w') as f:
+        f.write(new_fingerprint + '\n')
+    os.replace(tmp_filename, fingerprint_filename(output_filename))
@@ -0,0 +1,226 @@
+"""
+Probing of media files, with a persistent cache of durations.
+
+Spawning `mediainfo` is slow compared to everything else that happens before ffmpeg starts, and the same camera clips
+are probed by several stages for every talk. Durations are therefore kept in an in-process memo, backed by a JSON file
+on disk. Entries are keyed by the absolute path, and are only trusted while the size and mtime of the file still match.
+"""
+
+import json
+import os
+import subprocess
+
+duration_cache_file = os.path.join('.rccache', 'media_durations.json')
+
+_duration_memo = {}
+_duration_memo_loaded = False
+
+
+def media_length(filename):
+    """
+    Get the duration of a video or audio file.
+
+    :param filename: The video or audio file to analyse
+
+    :return: The duration, as an integer number of milliseconds.
+
+    """
+    return media_lengths([filename])[0]
+
+
+def media_lengths(filenames, probe_siblings=True):
+    """
+    Get the durations of several video or audio files, probing all the uncached ones with a single mediainfo call.
+
+    :param filenames: The video or audio files to analyse.
+
+    :param probe_siblings: When a file is not cached yet, also probe the other files with the same extension in its
+        folder. The camera clips for all the talks in a session share a folder, so this warms the cache for the rest of
+        the session too.
+
+    :return: A list with the duration of each file, as an integer number of milliseconds.
+
+    """
+    _load_duration_cache()
+    keys = [_stat_key(f) for f in filenames]
+    for f, (path, stat) in zip(filenames, keys):
+        if stat is None:
+            raise FileNotFoundError('No such media file: {}'.format(f))
+    missing = [f for f, key in zip(filenames, keys) if _duration_memo.get(key[0], {}).get('stat') != key[1]]
+
+    if missing:
+        probed = _with_siblings(missing) if probe_siblings else missing
+        try:
+            durations = _probe_durations(probed)
+        except RuntimeError:
+            if probed == missing:
+                raise
+            # One of the siblings broke mediainfo. Only the files that were asked for may fail.
+            probed = missing
+            durations = _probe_durations(probed)
+        for f, duration in zip(probed, durations):
+            path, stat = _stat_key(f)
+            if duration is not None and stat is not None:
+                _duration_memo[path] = {'stat': stat, 'duration': duration}
+        _save_duration_cache()
+
+    for f, (path, stat) in zip(filenames, keys):
+        if _duration_memo.get(path, {}).get('stat') != stat:
+            raise RuntimeError('mediainfo did not report a duration for {}'.format(f))
+    return [_duration_memo[path]['duration'] for path, stat in keys]
+
+
+def probe_folder(folder, extension='.MP4'):
+    """
+    Probe all the media files in a folder with a single mediainfo call, and remember their durations.
+
+    :param folder: The folder to scan, e.g. the `cam_input_folder` of a talk.
+
+    :param extension: Only files with this extension are probed.
+
+    :return: A dictionary mapping each file name to its duration in milliseconds.
+
+    """
+    filenames = sorted(
+        os.path.join(folder, f) for f in os.listdir(folder)
+        if os.path.splitext(f)[1] == extension and not _is_temporary(f)
+    )
+    return dict(zip(filenames, media_lengths(filenames, probe_siblings=False)))
+
+
+def keyframe_times(filename, start=None, end=None):
+    """
+    Find the keyframes in the video stream of a file, without decoding it.
+
+    :param filename: The video file to analyse.
+
+    :param start: Only look at packets from (roughly) this time, in seconds. Defaults to the start of the file.
+
+    :param end: Only look at packets up to (roughly) this time, in seconds. Defaults to the end of the file.
+
+    :return: A sorted list with the presentation time of each keyframe, in seconds.
+
+    """
+    command = [
+        'ffprobe',
+        '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags',
+        '-of', 'csv=print_section=0',
+    ]
+    if start is not None or end is not None:
+        command.extend(['-read_intervals', '{}%{}'.format(
+            '' if start is None else max(0., start),
+            '' if end is None else end,
+        )])
+    command.append(filename)
+    try:
+        output = subprocess.check_output(command)
+    except OSError:
+        raise RuntimeError('Is ffprobe installed? It comes with ffmpeg.')
+
+    times = []
+    for line in output.decode().splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ('', 'N/A'):
+            times.append(float(pts_time))
+    return sorted(times)
+
+
+def clear_duration_cache():
+    """Forget all cached durations, both in memory and on disk."""
+    global _duration_memo_loaded
+    _duration_memo.clear()
+    _duration_memo_loaded = True
+    try:
+        os.remove(duration_cache_file)
+    except FileNotFoundError:
+        pass
+
+
+def _probe_durations(filenames):
+    separator = '|'
+    try:
+        output = subprocess.check_output(
+            ['mediainfo', '--Inform=General;%CompleteName%{}%Duration%\\n'.format(separator)] + list(filenames)
+        )
+    except OSError:
+        raise RuntimeError('Is mediainfo installed? On linux, try: sudo apt install mediainfo')
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError('mediainfo failed with exit code {}'.format(e.returncode))
+
+    # mediainfo reports files in the order given, but match on the name anyway so that a missing line can not shift
+    # the durations of all the files after it.
+    durations = {}
+    for line in output.decode().splitlines():
+        path, _, duration = line.rpartition(separator)
+        if path and duration:
+            durations[os.path.abspath(path)] = int(float(duration))
+
+    # None for the files without a duration, e.g. corrupt clips
+    return [durations.get(os.path.abspath(f)) for f in filenames]
+
+
+def _with_siblings(filenames):
+    result = list(filenames)
+    seen = set(os.path.abspath(f) for f in filenames)
+    for folder, extension in sorted(set((os.path.dirname(f), os.path.splitext(f)[1]) for f in filenames)):
+        try:
+            siblings = sorted(os.listdir(folder or '.'))
+        except OSError:
+            continue
+        for sibling in siblings:
+            path = os.path.abspath(os.path.join(folder, sibling))
+            if os.path.splitext(sibling)[1] != extension or _is_temporary(sibling) or path in seen:
+                continue
+            stat = _stat_key(path)[1]
+            if stat is None or _duration_memo.get(path, {}).get('stat') == stat:
+                continue  # deleted since it was listed, or already known
+            seen.add(path)
+            result.append(path)
+    return result
+
+
+def _is_temporary(name):
+    # Files being written by `rc.publishing`, e.g. talk_camera.host-123.tmp.wav, which may be incomplete
+    return os.path.splitext(os.path.splitext(name)[0])[1] == '.tmp'
+
+
+def _stat_key(filename):
+    # The stat is None if the file does not exist (anymore)
+    path = os.path.abspath(filename)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return path, None
+    return path, [st.st_size, st.st_mtime_ns]
+
+
+def _load_duration_cache():
+    global _duration_memo_loaded
+    if _duration_memo_loaded:
+        return
+    _duration_memo_loaded = True
+    try:
+        with open(duration_cache_file, 'r') as f:
+            _duration_memo.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+
+
+def _save_duration_cache():
+    # Write to a temporary file and rename it, so that several processes sharing the cache never see a partial file.
+    folder = os.path.dirname(duration_cache_file)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    entries = {}
+    try:
+        with open(duration_cache_file, 'r') as f:
+            entries.update(json.load(f))  # keep whatever other processes have probed in the meantime
+    except (OSError, ValueError):
+        pass
+    entries.update(_duration_memo)
+    tmp_filename = '{}.{}.tmp'.format(duration_cache_file, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        json.dump(entries, f)
+    os.replace(tmp_filename, duration_cache_file)
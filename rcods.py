@@ -0,0 +1,146 @@
+"""
+A fast reader for the sheets in the info spreadsheet, with a cache.
+
+`ODSReader` builds a DOM of the whole document with odfpy, which is slow. This streams `content.xml` straight out of
+the ODS (zip) file with `iterparse`, only collects the text of the sheets that are asked for, and gives the same rows
+as `ODSReader.getSheet`. The result is cached in a JSON file, which is used for as long as the size and mtime of the
+spreadsheet stay the same.
+"""
+
+import json
+import os
+import xml.etree.ElementTree as ElementTree
+import zipfile
+
+cache_folder = '.rccache'
+
+_table_ns = '{urn:oasis:names:tc:opendocument:xmlns:table:1.0}'
+_text_ns = '{urn:oasis:names:tc:opendocument:xmlns:text:1.0}'
+_table = _table_ns + 'table'
+_table_name = _table_ns + 'name'
+_table_row = _table_ns + 'table-row'
+_table_cell = _table_ns + 'table-cell'
+_columns_repeated = _table_ns + 'number-columns-repeated'
+_text_p = _text_ns + 'p'
+_text_s = _text_ns + 's'
+_text_s_count = _text_ns + 'c'
+_text_tab = _text_ns + 'tab'
+
+
+def load_sheets(filename, names, use_cache=True):
+    """
+    Get the rows of some sheets in a spreadsheet, from the cache if the spreadsheet has not changed.
+
+    :param filename: The ODS file to read.
+
+    :param names: The names of the sheets to read.
+
+    :param use_cache: Whether to use (and update) the cache.
+
+    :return: A dictionary mapping each sheet name to a list of rows, where each row is a list of cell texts, like
+        `ODSReader.getSheet`.
+
+    """
+    names = list(names)
+    if not use_cache:
+        return read_sheets(filename, names)
+
+    st = os.stat(filename)
+    stat = [st.st_size, st.st_mtime_ns]
+    cache_filename = os.path.join(cache_folder, '{}.sheets.json'.format(os.path.basename(filename)))
+    cached = {}
+    try:
+        with open(cache_filename, 'r') as f:
+            cache = json.load(f)
+        if cache['filename'] == os.path.abspath(filename) and cache['stat'] == stat:
+            cached = cache['sheets']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    if all(name in cached for name in names):
+        return {name: cached[name] for name in names}
+
+    sheets = read_sheets(filename, set(names) | set(cached))
+    os.makedirs(cache_folder, exist_ok=True)
+    tmp_filename = '{}.{}.tmp'.format(cache_filename, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        json.dump({'filename': os.path.abspath(filename), 'stat': stat, 'sheets': sheets}, f)
+    os.replace(tmp_filename, cache_filename)
+    return {name: sheets[name] for name in names}
+
+
+def read_sheets(filename, names=None):
+    """
+    Read the rows of some sheets in a spreadsheet.
+
+    As in `ODSReader`, cells starting with '#' are comments and are left out, empty rows are left out, and repeated
+    rows are only read once.
+
+    :param filename: The ODS file to read.
+
+    :param names: The names of the sheets to read. Defaults to all the sheets.
+
+    :return: A dictionary mapping each sheet name to a list of rows, where each row is a list of cell texts (or None for
+        empty cells before the last non-empty one).
+
+    """
+    sheets = {}
+    rows = None  # the rows of the current sheet, if it is wanted
+    cells = None
+    count = 0
+
+    with zipfile.ZipFile(filename) as z, z.open('content.xml') as content:
+        for event, element in ElementTree.iterparse(content, events=('start', 'end')):
+            tag = element.tag
+            if event == 'start':
+                if tag == _table:
+                    name = element.get(_table_name)
+                    rows = [] if names is None or name in names else None
+                elif tag == _table_row and rows is not None:
+                    cells = []
+                    count = 0
+                continue
+
+            if rows is None:
+                if tag == _table:
+                    element.clear()
+                continue
+
+            if tag == _table_cell:
+                text = _cell_text(element)
+                repeat = int(element.get(_columns_repeated) or 1)
+                if text:
+                    if text[0] != '#':  # ignore comments cells
+                        if len(cells) < count:
+                            cells.extend([None] * (count - len(cells)))
+                        cells[count:count + repeat] = [text] * repeat
+                        count += repeat
+                else:
+                    count += repeat
+                element.clear()
+            elif tag == _table_row:
+                if cells:
+                    rows.append(cells)
+                cells = None
+                element.clear()
+            elif tag == _table:
+                sheets[element.get(_table_name)] = rows
+                rows = None
+                element.clear()
+
+    return sheets
+
+
+def _cell_text(cell):
+    parts = []
+    for p in cell.iter(_text_p):
+        for node in p.iter():
+            if node.tag == _text_s:
+                parts.append(' ' * int(node.get(_text_s_count) or 1))
+            elif node.tag == _text_tab:
+                parts.append('\t')
+            elif node.text:
+                parts.append(node.text)
+            if node is not p and node.tail:
+                parts.append(node.tail)
+    return ''.join(parts)
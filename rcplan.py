@@ -0,0 +1,219 @@
+"""
+Plans: the commands the stages would run, without running them.
+
+Every stage in `rc` takes `dry_run=True`, and then returns a list of `CommandSpec` instead of encoding anything. A dry
+run is not free of side effects, since the commands need them to be run as they are:
+
+- the small text files the commands read (mux files, streamselect command files) are written to the output folder,
+- the slides those mux files point at are scaled into the slide cache (see `rcslides.cached_slide`), with ffmpeg,
+- the durations of the camera clips are probed (and cached, see `rcmedia`), and so are the keyframes around the cuts
+  of a smart cut, with ffprobe.
+
+The encoded outputs themselves are never touched. A plan for the whole conference can be printed, exported as JSON or
+as a Makefile, and split between machines to estimate the total render time.
+"""
+
+import json
+import shlex
+import sys
+from dataclasses import dataclass
+
+# Rough seconds of work per second of output, for work which is not encoding video
+copy_cost_per_second = .002  # copying streams, extracting audio
+analysis_cost_per_second = .005  # correlating audio
+
+
+@dataclass(frozen=True)
+class CommandSpec:
+    """One command of a stage."""
+    __slots__ = ('stage', 'name', 'inputs', 'outputs', 'argv', 'estimated_cost', 'duration_ms')
+    stage: str
+    name: str  # the talk or Q&A session
+    inputs: tuple  # the files the command reads
+    outputs: tuple  # the files the command writes
+    argv: tuple
+    estimated_cost: float  # in seconds on a reference machine, see `rcprofiles.EncoderProfile.estimated_cost`
+    duration_ms: float  # the duration of the output, for progress reports
+
+    def command_line(self):
+        """The command, quoted for a POSIX shell."""
+        return shlex.join(self.argv)
+
+    def to_dict(self):
+        return {
+            'stage': self.stage,
+            'name': self.name,
+            'inputs': list(self.inputs),
+            'outputs': list(self.outputs),
+            'argv': list(self.argv),
+            'estimated_cost': self.estimated_cost,
+            'duration_ms': self.duration_ms,
+        }
+
+
+def python_argv(function, name, **kwargs):
+    """
+    Get a command which calls a function of `rc` for a talk, for steps which are not a single ffmpeg command.
+
+    >>> python_argv('make_slide_video_for_talk', 'howe_force', profile='master')[2]
+    "import rc; rc.make_slide_video_for_talk('howe_force', profile='master')"
+    """
+    arguments = [repr(name)] + ['{}={!r}'.format(k, v) for k, v in sorted(kwargs.items())]
+    return ('python3', '-c', 'import rc; rc.{}({})'.format(function, ', '.join(arguments)))
+
+
+def conference_plan(jobs, profile=None, log=sys.stderr):
+    """
+    Plan the jobs of a batch run.
+
+    :param jobs: A list of `rcbatch.Job`, e.g. from `rcbatch.conference_jobs`.
+
+    :param profile: The encoder profile for the stages which encode video, as in `rcbatch.run_jobs`.
+
+    :param log: Where to report stages which could not be planned, e.g. because an earlier stage has to run first.
+
+    :return list: The `CommandSpec` of every command, in an order in which they can be run. Stages which are up to date
+        have no commands.
+
+    """
+    import rc
+
+    specs = []
+    planned = set()  # (stage, name) of the jobs with commands
+    outputs = set()
+    for job in jobs:
+        options = stage_options(job.stage, profile)
+        # A stage whose inputs are about to be remade is not up to date, whatever its fingerprint says now
+        if any((stage, job.name) in planned for stage in job.depends_on):
+            options['force'] = True
+        try:
+            job_specs = getattr(rc, job.stage)(job.name, dry_run=True, **options)
+        except (OSError, ValueError) as e:
+            print("Could not plan {} for {}: {}".format(job.stage, job.name, e), file=log)
+            continue
+        for spec in job_specs:
+            if spec.outputs[0] not in outputs:  # e.g. the camera audio, which the microphones stage plans as well
+                outputs.add(spec.outputs[0])
+                specs.append(spec)
+        if job_specs:
+            planned.add((job.stage, job.name))
+    return specs
+
+
+def stage_options(stage, profile=None):
+    """
+    Get the keyword arguments a batch run calls a stage with.
+
+    :param stage: The name of the stage.
+
+    :param profile: The encoder profile for the stages which encode video, as in `rcbatch.run_jobs`.
+
+    :return dict:
+
+    >>> stage_options('make_talk_video', 'proxy'), stage_options('extract_camera_audio_for_talk', 'proxy')
+    ({'profile': 'proxy'}, {})
+    """
+    import rcbatch
+
+    options = dict(rcbatch.stage_options.get(stage, {}))
+    if profile is not None and stage in rcbatch.video_stages:
+        options['profile'] = profile
+    return options
+
+
+def total_cost(specs):
+    return sum(spec.estimated_cost for spec in specs)
+
+
+def assign_to_machines(specs, machines):
+    """
+    Spread the work between machines, keeping all the commands for a talk on the same machine, since they depend on
+    each other. The talks are handed out longest first, each to the machine with the least work so far.
+
+    :param specs: A list of `CommandSpec`.
+
+    :param machines: The number of machines.
+
+    :return list: For each machine, a tuple of its estimated cost and the names of its talks and Q&A sessions.
+
+    >>> specs = [CommandSpec('s', n, (), (), (), c, 0) for n, c in [('a', 5.), ('b', 3.), ('a', 1.), ('c', 2.), ('d', 2.)]]
+    >>> assign_to_machines(specs, 2)
+    [(6.0, ['a']), (7.0, ['b', 'c', 'd'])]
+    """
+    costs = {}
+    for spec in specs:
+        costs[spec.name] = costs.get(spec.name, 0.) + spec.estimated_cost
+    loads = [[0., []] for _ in range(machines)]
+    for name in sorted(costs, key=lambda n: -costs[n]):
+        load = min(loads, key=lambda l: l[0])
+        load[0] += costs[name]
+        load[1].append(name)
+    return [(cost, names) for cost, names in loads]
+
+
+def to_json(specs):
+    return json.dumps({
+        'estimated_cost': total_cost(specs),
+        'commands': [spec.to_dict() for spec in specs],
+    }, indent=2)
+
+
+def to_makefile(specs, profile=None):
+    """
+    Write a plan as a Makefile, with a rule for each stage of each talk and Q&A session.
+
+    The rules call the stages themselves (see `python_argv`) rather than their commands, so that the outputs are only
+    published once they are complete and their fingerprints are recorded, as in any other run. The rule of a stage
+    makes the output of its last command, and its other outputs depend on that one. Stages which need the output of
+    another stage depend on it, so `make -j` runs them in a valid order and in parallel, and can be run from this folder
+    on a machine which has the same paths.
+
+    :param specs: The plan, e.g. from `conference_plan`.
+
+    :param profile: The encoder profile the plan was made with.
+
+    >>> makefile = to_makefile([CommandSpec('s', 't', ('in',), ('a', 'b'), ('cmd',), 5., 0),
+    ...                         CommandSpec('s', 't', ('b',), ('c',), ('cmd',), 1., 0)])
+    >>> [line for line in makefile.splitlines()[3:] if not line.startswith('\\t')]  # without the command
+    ['all: c', '', '# s for t, about 6 s', 'c: in', 'a b: c']
+    """
+    stages = {}  # (stage, name) -> specs, in the order of the plan
+    for spec in specs:
+        stages.setdefault((spec.stage, spec.name), []).append(spec)
+
+    lines = [
+        '# Generated by plan_conference.py. Estimated cost: {:.0f} s'.format(total_cost(specs)),
+        '',
+        '.PHONY: all',
+        'all: {}'.format(' '.join(_make_escape(s[-1].outputs[0]) for s in stages.values())),
+        '',
+    ]
+    for (stage, name), stage_specs in stages.items():
+        target = stage_specs[-1].outputs[0]
+        outputs = [f for spec in stage_specs for f in spec.outputs]
+        inputs = [f for spec in stage_specs for f in spec.inputs if f not in outputs]
+        command = shlex.join(python_argv(stage, name, **stage_options(stage, profile)))
+        lines.append('# {} for {}, about {:.0f} s'.format(stage, name, total_cost(stage_specs)))
+        lines.append('{}: {}'.format(_make_escape(target), ' '.join(_make_escape(f) for f in dict.fromkeys(inputs))))
+        lines.append('\t{}'.format(command.replace('$', '$$')))
+        others = [f for f in dict.fromkeys(outputs) if f != target]
+        if others:
+            lines.append('{}: {}'.format(' '.join(_make_escape(f) for f in others), _make_escape(target)))
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def to_text(specs, machines=1):
+    lines = []
+    for spec in specs:
+        lines.append('{:>8.0f} s  {} for {}'.format(spec.estimated_cost, spec.stage, spec.name))
+        lines.append('            {}'.format(spec.command_line()))
+    lines.append('{} commands, about {:.0f} s in total'.format(len(specs), total_cost(specs)))
+    if machines > 1:
+        for i, (cost, names) in enumerate(assign_to_machines(specs, machines), 1):
+            lines.append('Machine {}: about {:.0f} s for {}'.format(i, cost, ', '.join(names)))
+    return '\n'.join(lines)
+
+
+def _make_escape(filename):
+    return filename.replace('$', '$$').replace(' ', '\\ ').replace(':', '\\:')
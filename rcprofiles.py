@@ -0,0 +1,189 @@
+"""
+Named encoder profiles.
+
+Every stage that encodes video takes a profile, instead of its own crf and preset. The profiles only use software
+encoders, so the same profile gives the same quality on any machine.
+
+- proxy: small and very fast, for gathering timing information. Rendered once and reused.
+- review: good enough to check the edit, at 720p.
+- master: the published videos.
+- archive: keeps as much of the source as is reasonable, for re-editing later.
+"""
+
+import dataclasses
+from dataclasses import dataclass
+
+crf_worst = 51
+crf_default = 23
+crf_visually_lossless = 18
+crf_lossless = 0
+
+# Rough seconds of encoding per second of 1080p video with libx264 on one reference machine, for plans (see `rcplan`).
+# Other sizes are scaled by the number of pixels, and decoding the source costs `decode_cost` on top of that.
+preset_cost = {
+    'ultrafast': .08,
+    'superfast': .1,
+    'veryfast': .15,
+    'faster': .25,
+    'fast': .3,
+    'medium': .4,
+    'slow': .7,
+    'slower': 1.4,
+    'veryslow': 3.,
+}
+decode_cost = .05
+
+
+@dataclass(frozen=True)
+class EncoderProfile:
+    """The video encoder settings for one tier of output."""
+    __slots__ = ('name', 'codec', 'crf', 'preset', 'threads', 'tune', 'resolution', 'scale_flags', 'decode_options')
+    name: str
+    codec: str
+    crf: int
+    preset: str
+    threads: int  # x264 threads, or None to let x264 decide. The batch budget (`rc.ffmpeg_threads`) takes precedence.
+    tune: str  # or None
+    resolution: int  # the output height, or None to keep the source size
+    scale_flags: str  # the swscale algorithm used when scaling to `resolution`
+    decode_options: tuple  # extra input options for the camera clips, trading decoding accuracy for speed
+
+    def encode_options(self):
+        """
+        Get the ffmpeg output options for the video encoder.
+
+        >>> profiles['proxy'].encode_options()
+        ['-c:v', 'libx264', '-crf', '28', '-preset', 'ultrafast', '-tune', 'fastdecode']
+        """
+        options = [
+            '-c:v', self.codec,
+            '-crf', str(int(self.crf)),
+            '-preset', str(self.preset),
+        ]
+        if self.tune is not None:
+            options.extend(['-tune', self.tune])
+        if self.threads is not None:
+            options.extend(['-threads', str(int(self.threads))])
+        return options
+
+    def scale_filter(self):
+        """
+        Get the filter that scales the video to the profile's resolution, keeping the aspect ratio.
+
+        :return: The filter, or None if the video should keep its size.
+
+        >>> profiles['review'].scale_filter()
+        'scale=-2:720:flags=bicubic'
+        >>> profiles['master'].scale_filter() is None
+        True
+        """
+        if self.resolution is None:
+            return None
+        return 'scale=-2:{}:flags={}'.format(int(self.resolution), self.scale_flags)
+
+    def keeps_source_stream(self):
+        """Whether the output can be spliced with copied camera stream, as in a smart cut."""
+        return self.resolution is None and self.codec == 'libx264'
+
+    def estimated_cost(self, duration_s, source_height=1080):
+        """
+        Estimate how long encoding a video with this profile takes on the reference machine.
+
+        :param duration_s: The duration of the video.
+
+        :param source_height: The height of the source video.
+
+        :return float: The time, in seconds.
+
+        >>> round(profiles['master'].estimated_cost(3600), 1), round(profiles['proxy'].estimated_cost(3600), 1)
+        (2700.0, 236.9)
+        """
+        height = self.resolution or source_height
+        pixels = (height / 1080) ** 2
+        return duration_s * (decode_cost * (source_height / 1080) ** 2 + preset_cost.get(self.preset, 1.) * pixels)
+
+    def describe(self):
+        """Describe the profile for a fingerprint, so that changing a setting remakes the outputs."""
+        return dataclasses.asdict(self)
+
+
+profiles = {
+    'proxy': EncoderProfile(
+        name='proxy',
+        codec='libx264',
+        crf=28,
+        preset='ultrafast',
+        threads=None,
+        tune='fastdecode',  # for scrubbing back and forth while timing
+        resolution=480,
+        scale_flags='fast_bilinear',
+        # Skipping the deblocking filter and using the non-spec-compliant shortcuts of the decoder makes decoding the
+        # 1080p camera clips, which is most of the work at this size, a lot faster. The artefacts do not survive the
+        # downscale.
+        decode_options=('-skip_loop_filter', 'all', '-flags2', 'fast'),
+    ),
+    'review': EncoderProfile(
+        name='review',
+        codec='libx264',
+        crf=crf_default,
+        preset='veryfast',
+        threads=None,
+        tune=None,
+        resolution=720,
+        scale_flags='bicubic',
+        decode_options=(),
+    ),
+    'master': EncoderProfile(
+        name='master',
+        codec='libx264',
+        crf=crf_visually_lossless,
+        preset='slow',
+        threads=None,
+        tune=None,
+        resolution=None,
+        scale_flags='bicubic',
+        decode_options=(),
+    ),
+    'archive': EncoderProfile(
+        name='archive',
+        codec='libx264',
+        crf=14,
+        preset='veryslow',
+        threads=None,
+        tune='film',
+        resolution=None,
+        scale_flags='lanczos',
+        decode_options=(),
+    ),
+}
+
+
+def get_profile(profile, crf=None, preset=None):
+    """
+    Look up an encoder profile, optionally overriding its crf and preset.
+
+    :param profile: The name of a profile, or an `EncoderProfile`.
+
+    :param crf: Use this crf instead of the profile's.
+
+    :param preset: Use this preset instead of the profile's.
+
+    :return EncoderProfile:
+
+    >>> get_profile('master', crf=20).crf
+    20
+    >>> get_profile('fast')
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown encoder profile 'fast', should be one of: proxy, review, master, archive.
+    """
+    if not isinstance(profile, EncoderProfile):
+        try:
+            profile = profiles[profile]
+        except KeyError:
+            raise ValueError("Unknown encoder profile {!r}, should be one of: {}.".format(
+                profile, ", ".join(profiles))) from None
+    overrides = {k: v for k, v in [('crf', crf), ('preset', preset)] if v is not None}
+    if overrides:
+        profile = dataclasses.replace(profile, **overrides)
+    return profile
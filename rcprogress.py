@@ -0,0 +1,319 @@
+"""
+Run ffmpeg with a progress report, and record how fast each command ran.
+
+ffmpeg is started with `-progress pipe:1 -nostats`, so that it writes its progress as `key=value` lines to stdout
+instead of redrawing a status line on the terminal. A line is printed for every `report_interval_s`, with the share
+of the expected duration done so far, and when the command ends one JSON line is appended to a metrics file with:
+
+- the stage, the talk or Q&A session and the output file,
+- the preset, crf and thread count from the command,
+- the wall time, and the CPU time and peak memory (RSS) of ffmpeg itself,
+- the last frame rate, bitrate and speed ffmpeg reported, and the average frame rate and speed over the whole run.
+
+Commands which write their output to stdout, e.g. raw frames to analyse, send their progress through another pipe
+instead (`read_output`).
+
+`summarize` groups the records, e.g. by stage and preset, to see where the time goes.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+report_interval_s = 10.
+
+
+class FfmpegProgress:
+    """The progress of one ffmpeg process, read from its `-progress` output."""
+
+    def __init__(self, stage=None, name=None, duration_ms=None, output=None, metrics_file=None, log=sys.stderr):
+        """
+        :param stage: The stage the command belongs to, for the report and the metrics.
+
+        :param name: The name of the talk or q&a session.
+
+        :param duration_ms: The expected duration of the output, to report how much is done.
+
+        :param output: The output to report. Defaults to the last argument of the command, which may be a temporary
+            file (see `rc.publishing`).
+
+        :param metrics_file: The JSON lines file to append the metrics to, or None to not record them.
+
+        :param log: Where to report the progress, or None to not report it.
+        """
+        self.stage = stage
+        self.name = name
+        self.duration_ms = duration_ms
+        self.output = output
+        self.metrics_file = metrics_file
+        self.log = log
+        self.command = None
+        self.process = None
+        self.latest = {}  # the last complete block of progress values
+        self._reader = None
+        self._progress = None  # the pipe the progress is read from
+        self._started = None
+
+    def popen(self, command, **kwargs):
+        """
+        Start ffmpeg, with its progress on stdout, or on another pipe if `stdout` is given.
+
+        :param command: The full ffmpeg command.
+
+        :param kwargs: Passed on to `subprocess.Popen`, e.g. `stdin=subprocess.PIPE`, or `stdout=subprocess.PIPE` for a
+            command which writes its output to stdout.
+
+        :return subprocess.Popen: The process.
+
+        """
+        if 'stdout' not in kwargs:
+            self.command = command[:1] + ['-progress', 'pipe:1', '-nostats'] + command[1:]
+            self._start(command, stdout=subprocess.PIPE, **kwargs)
+            self._progress = self.process.stdout
+        else:
+            read_fd, write_fd = os.pipe()
+            self._progress = os.fdopen(read_fd, 'rb')
+            self.command = command[:1] + ['-progress', 'pipe:{}'.format(write_fd), '-nostats'] + command[1:]
+            try:
+                self._start(command, pass_fds=tuple(kwargs.pop('pass_fds', ())) + (write_fd,), **kwargs)
+            except BaseException:
+                self._progress.close()
+                raise
+            finally:
+                os.close(write_fd)  # so that the pipe ends when ffmpeg does
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+        return self.process
+
+    def wait(self):
+        """
+        Wait for ffmpeg to end, and record its metrics.
+
+        :return int: The return code.
+
+        """
+        rusage = None
+        if hasattr(os, 'wait4'):
+            # Popen.wait does not give the resource usage, so reap the process here and tell Popen about it
+            _, status, rusage = os.wait4(self.process.pid, 0)
+            self.process.returncode = os.waitstatus_to_exitcode(status)
+        else:
+            self.process.wait()
+        self._reader.join()
+        self._progress.close()
+
+        metrics = self.metrics(time.time() - self._started, rusage)
+        if self.log is not None:
+            print("{}: {} in {:.0f} s, {:.1f}x realtime".format(
+                self._label(), 'done' if self.process.returncode == 0 else 'failed', metrics['elapsed_s'],
+                metrics['average_speed'] or 0.), file=self.log)
+        if self.metrics_file is not None:
+            append_metrics(self.metrics_file, metrics)
+        return self.process.returncode
+
+    def fraction_done(self):
+        """The share of the expected duration written so far, or None if it is not known."""
+        out_time_us = _number(self.latest.get('out_time_us'))
+        if not self.duration_ms or out_time_us is None:
+            return None
+        return min(max(out_time_us / 1000. / self.duration_ms, 0.), 1.)
+
+    def metrics(self, elapsed_s, rusage=None):
+        """
+        Describe the run, for the metrics file.
+
+        :param elapsed_s: The wall time.
+
+        :param rusage: The resource usage of ffmpeg, from `os.wait4`.
+
+        :return dict:
+
+        """
+        frames = _number(self.latest.get('frame'))
+        out_time_us = _number(self.latest.get('out_time_us'))
+        metrics = {
+            'stage': self.stage,
+            'name': self.name,
+            'output': self.output,
+            'preset': _option(self.command, '-preset'),
+            'crf': _option(self.command, '-crf'),
+            'threads': _option(self.command, '-threads'),
+            'returncode': self.process.returncode,
+            'started': self._started,
+            'elapsed_s': elapsed_s,
+            'duration_s': None if self.duration_ms is None else self.duration_ms / 1000.,
+            'out_time_s': None if out_time_us is None else out_time_us / 10 ** 6,
+            'frames': frames,
+            'fps': _number(self.latest.get('fps')),
+            'bitrate_kbps': _number(self.latest.get('bitrate', '').replace('kbits/s', '')),
+            'speed': _number(self.latest.get('speed', '').rstrip('x')),
+            'average_fps': None if frames is None or not elapsed_s else frames / elapsed_s,
+            'average_speed': None if out_time_us is None or not elapsed_s else out_time_us / 10 ** 6 / elapsed_s,
+            'total_size': _number(self.latest.get('total_size')),
+            'cpu_user_s': None,
+            'cpu_system_s': None,
+            'peak_rss_mib': None,
+        }
+        if rusage is not None:
+            metrics['cpu_user_s'] = rusage.ru_utime
+            metrics['cpu_system_s'] = rusage.ru_stime
+            # ru_maxrss is in KiB on Linux, but in bytes on macOS
+            metrics['peak_rss_mib'] = rusage.ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+        return metrics
+
+    def _start(self, command, **kwargs):
+        if self.output is None:
+            self.output = command[-1]
+        self._started = time.time()
+        self.process = subprocess.Popen(self.command, **kwargs)
+
+    def _read(self):
+        block = {}
+        last_report = time.time()
+        for line in self._progress:
+            key, _, value = line.decode(errors='replace').strip().partition('=')
+            block[key] = value
+            if key != 'progress':
+                continue
+            self.latest, block = block, {}
+            if self.log is not None and value == 'continue' and time.time() - last_report >= report_interval_s:
+                last_report = time.time()
+                self._report()
+
+    def _report(self):
+        fraction = self.fraction_done()
+        print("{}: {}{} fps, {}".format(
+            self._label(),
+            '' if fraction is None else '{:.0%}, '.format(fraction),
+            self.latest.get('fps', '?'),
+            self.latest.get('speed', '?').strip()), file=self.log)
+
+    def _label(self):
+        output = os.path.basename(self.output)
+        if self.stage is None:
+            return output
+        return '{} for {} ({})'.format(self.stage, self.name, output)
+
+
+def run(command, stage=None, name=None, duration_ms=None, output=None, metrics_file=None, log=sys.stderr):
+    """
+    Run an ffmpeg command, reporting its progress and recording its metrics.
+
+    :param command: The full ffmpeg command, with the output filename last.
+
+    The other parameters are those of `FfmpegProgress`.
+
+    :raises subprocess.CalledProcessError: If ffmpeg fails.
+
+    """
+    progress = FfmpegProgress(stage, name, duration_ms, output, metrics_file, log)
+    progress.popen(command)
+    return_code = progress.wait()
+    if return_code != 0:
+        raise subprocess.CalledProcessError(return_code, command)
+    return return_code
+
+
+def read_output(command, read, stage=None, name=None, duration_ms=None, output='stdout', metrics_file=None,
+                log=sys.stderr):
+    """
+    Run an ffmpeg command which writes its output to stdout, reporting its progress and recording its metrics, and read
+    the output while ffmpeg writes it.
+
+    :param command: The full ffmpeg command, with `-` as the output.
+
+    :param read: A function which reads the output from a binary file, and returns what it makes of it.
+
+    The other parameters are those of `FfmpegProgress`.
+
+    :return: What `read` returned.
+
+    :raises subprocess.CalledProcessError: If ffmpeg fails.
+
+    """
+    progress = FfmpegProgress(stage, name, duration_ms, output, metrics_file, log)
+    process = progress.popen(command, stdout=subprocess.PIPE)
+    try:
+        result = read(process.stdout)
+    finally:
+        process.stdout.close()  # if `read` stopped early, ffmpeg stops too instead of waiting for it
+        return_code = progress.wait()
+    if return_code != 0:
+        raise subprocess.CalledProcessError(return_code, command)
+    return result
+
+
+def append_metrics(metrics_file, metrics):
+    """
+    Append a record to a metrics file.
+
+    Each record is written with a single `write` to a file opened for appending, so that several processes (and
+    machines, on most shared filesystems) can add to the same file.
+
+    """
+    folder = os.path.dirname(metrics_file)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(metrics_file, 'a') as f:
+        f.write(json.dumps(metrics, sort_keys=True) + '\n')
+
+
+def read_metrics(metrics_file):
+    """Read all the records of a metrics file, as a list of dictionaries."""
+    with open(metrics_file, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(records, keys=('stage', 'preset')):
+    """
+    Add up the metrics per group, slowest group first.
+
+    :param records: A list of records, as from `read_metrics`.
+
+    :param keys: The fields to group by.
+
+    :return list: A dictionary for each group, with the values of `keys`, the number of commands, the total wall and
+        CPU time, the average speed (seconds of output per second of wall time) and the highest peak RSS.
+
+    >>> records = [
+    ...     {'stage': 'a', 'preset': 'slow', 'elapsed_s': 10., 'out_time_s': 5., 'cpu_user_s': 30., 'cpu_system_s': 1.,
+    ...      'peak_rss_mib': 300., 'returncode': 0},
+    ...     {'stage': 'a', 'preset': 'slow', 'elapsed_s': 30., 'out_time_s': 15., 'cpu_user_s': 90., 'cpu_system_s': 3.,
+    ...      'peak_rss_mib': 350., 'returncode': 0},
+    ...     {'stage': 'b', 'preset': None, 'elapsed_s': 1., 'out_time_s': 100., 'cpu_user_s': None,
+    ...      'cpu_system_s': None, 'peak_rss_mib': None, 'returncode': 1},
+    ... ]
+    >>> [(g['stage'], g['commands'], g['failed'], g['elapsed_s'], g['speed']) for g in summarize(records)]
+    [('a', 2, 0, 40.0, 0.5), ('b', 1, 1, 1.0, 100.0)]
+    """
+    groups = {}
+    for record in records:
+        key = tuple(record.get(k) for k in keys)
+        group = groups.setdefault(key, dict(zip(keys, key), commands=0, failed=0, elapsed_s=0., out_time_s=0.,
+                                            cpu_s=0., peak_rss_mib=None))
+        group['commands'] += 1
+        group['failed'] += record.get('returncode') != 0
+        group['elapsed_s'] += record.get('elapsed_s') or 0.
+        group['out_time_s'] += record.get('out_time_s') or 0.
+        group['cpu_s'] += (record.get('cpu_user_s') or 0.) + (record.get('cpu_system_s') or 0.)
+        if record.get('peak_rss_mib') is not None:
+            group['peak_rss_mib'] = max(group['peak_rss_mib'] or 0., record['peak_rss_mib'])
+    for group in groups.values():
+        group['speed'] = group['out_time_s'] / group['elapsed_s'] if group['elapsed_s'] else None
+    return sorted(groups.values(), key=lambda g: -g['elapsed_s'])
+
+
+def _option(command, option):
+    # The value of the last occurrence of an option, which is the one ffmpeg uses
+    values = [command[i + 1] for i in range(len(command) - 1) if command[i] == option]
+    return values[-1] if values else None
+
+
+def _number(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None  # e.g. N/A
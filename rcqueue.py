@@ -0,0 +1,386 @@
+"""
+A work queue on shared storage, so that several machines can render the conference together.
+
+The jobs of `rcbatch.conference_jobs` are put in an SQLite database in the output folder, which every render node
+mounts. Each node runs a worker (`render_worker.py`), which takes the next job whose dependencies are done, runs it,
+and marks it done. No broker or server is needed, and any number of local worker processes can stand in for nodes.
+
+- A worker holds a lease on its job, and renews it while the job runs. When a node dies, its lease runs out and the
+  job is handed to another worker. The clocks of the nodes should agree to well within the lease time.
+- A job whose ffmpeg command fails is tried again, up to `max_attempts` times. Other errors, like a broken row in the
+  spreadsheet, fail the job at once. The jobs which depend on a failed job are skipped.
+- The stages write their outputs under a temporary name and rename them when they are complete (`rc.publishing`),
+  so a worker which is stopped halfway never leaves a file which looks finished.
+
+The database uses SQLite's default rollback journal rather than WAL, which does not work on network filesystems.
+Every change is a short transaction, which is plenty for a few dozen jobs that take minutes each.
+"""
+
+import contextlib
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+import traceback
+
+import rc
+import rcbatch
+import rcslides
+
+queue_filename = 'rcqueue.sqlite'
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    stage TEXT NOT NULL,
+    name TEXT NOT NULL,
+    depends_on TEXT NOT NULL,  -- a JSON list of the stages of the same talk that must be done first
+    profile TEXT,  -- the encoder profile for the video stages, or NULL for the default of each stage
+    state TEXT NOT NULL,  -- waiting, running, done, failed or skipped
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    error TEXT,
+    updated REAL NOT NULL,
+    UNIQUE (stage, name)
+)
+'''
+
+
+def default_queue_file():
+    """The queue in the output folder, which all the render nodes share."""
+    return os.path.join(rc.load_parameters().output_folder, queue_filename)
+
+
+def connect(filename=None):
+    """
+    Open the queue, creating it if needed.
+
+    :param filename: The database. Defaults to `default_queue_file()`.
+
+    :return sqlite3.Connection: A connection in autocommit mode. Changes are made in explicit transactions.
+
+    """
+    if filename is None:
+        filename = default_queue_file()
+    connection = sqlite3.connect(filename, timeout=60, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute(_schema)
+    return connection
+
+
+def enqueue(connection, jobs, profile=None, max_attempts=3, retry_failed=False):
+    """
+    Add jobs to the queue. Jobs which are already in it are left alone, so a queue can be filled again safely while
+    workers are running.
+
+    :param jobs: A list of `rcbatch.Job`, e.g. from `rcbatch.conference_jobs`.
+
+    :param profile: The encoder profile for the stages which encode video, as in `rcbatch.run_jobs`.
+
+    :param max_attempts: How many times to try a job whose ffmpeg command fails.
+
+    :param retry_failed: Also put the jobs that failed or were skipped back in the queue, with new attempts.
+
+    :return int: The number of jobs added or put back.
+
+    """
+    now = time.time()
+    added = 0
+    with _transaction(connection):
+        for job in jobs:
+            cursor = connection.execute(
+                'INSERT OR IGNORE INTO jobs (stage, name, depends_on, profile, state, max_attempts, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (job.stage, job.name, json.dumps(job.depends_on), profile, 'waiting', max_attempts, now))
+            if not cursor.rowcount and retry_failed:
+                cursor = connection.execute(
+                    "UPDATE jobs SET state = 'waiting', attempts = 0, max_attempts = ?, profile = ?, error = NULL, "
+                    "updated = ? WHERE stage = ? AND name = ? AND state IN ('failed', 'skipped')",
+                    (max_attempts, profile, now, job.stage, job.name))
+            added += cursor.rowcount
+    return added
+
+
+def claim(connection, worker, lease_s):
+    """
+    Take the next job that can run.
+
+    Jobs whose lease ran out are put back in the queue first, and jobs which depend on a failed job are skipped.
+
+    :param worker: The name of the worker taking the job.
+
+    :param lease_s: How long the job is held without a `heartbeat`.
+
+    :return sqlite3.Row: The job, or None if no job can run now.
+
+    """
+    now = time.time()
+    with _transaction(connection):
+        _expire_leases(connection, now)
+        states = {(row['stage'], row['name']): row['state']
+                  for row in connection.execute('SELECT stage, name, state FROM jobs')}
+        for job in connection.execute("SELECT * FROM jobs WHERE state = 'waiting' ORDER BY id").fetchall():
+            dependency_states = [states.get((stage, job['name'])) for stage in json.loads(job['depends_on'])]
+            if any(state in ('failed', 'skipped') for state in dependency_states):
+                # Jobs are queued after the jobs they depend on, so one pass also skips the jobs depending on this one
+                connection.execute(
+                    "UPDATE jobs SET state = 'skipped', error = ?, updated = ? WHERE id = ?",
+                    ("A stage it depends on did not succeed", now, job['id']))
+                states[job['stage'], job['name']] = 'skipped'
+            elif all(state == 'done' for state in dependency_states):
+                connection.execute(
+                    "UPDATE jobs SET state = 'running', worker = ?, attempts = attempts + 1, lease_expires = ?, "
+                    "updated = ? WHERE id = ?",
+                    (worker, now + lease_s, now, job['id']))
+                return connection.execute('SELECT * FROM jobs WHERE id = ?', (job['id'],)).fetchone()
+    return None
+
+
+def heartbeat(connection, job_id, worker, lease_s):
+    """
+    Renew the lease on a running job.
+
+    :return bool: Whether the worker still holds the job. If not, its lease ran out and the job was given to another
+        worker, so the worker should stop working on it.
+
+    """
+    now = time.time()
+    with _transaction(connection):
+        cursor = connection.execute(
+            "UPDATE jobs SET lease_expires = ?, updated = ? WHERE id = ? AND worker = ? AND state = 'running'",
+            (now + lease_s, now, job_id, worker))
+    return cursor.rowcount == 1
+
+
+def finish(connection, job_id, worker, error=None, retry=False):
+    """
+    Report the result of a job.
+
+    :param error: A description of what went wrong, or None if the job is done.
+
+    :param retry: Whether the error is worth another attempt, e.g. a failed ffmpeg command. The job goes back in the
+        queue unless it has used up its attempts.
+
+    :return bool: Whether the worker still held the job, and therefore the result counted.
+
+    """
+    now = time.time()
+    with _transaction(connection):
+        if error is None:
+            state = "'done'"
+        elif retry:
+            state = "CASE WHEN attempts < max_attempts THEN 'waiting' ELSE 'failed' END"
+        else:
+            state = "'failed'"
+        cursor = connection.execute(
+            "UPDATE jobs SET state = {}, worker = NULL, lease_expires = NULL, error = ?, updated = ? "
+            "WHERE id = ? AND worker = ? AND state = 'running'".format(state),
+            (error, now, job_id, worker))
+    return cursor.rowcount == 1
+
+
+def release(connection, job_id, worker):
+    """Give a job back without counting the attempt, e.g. when a worker is stopped by hand."""
+    with _transaction(connection):
+        connection.execute(
+            "UPDATE jobs SET state = 'waiting', attempts = attempts - 1, worker = NULL, lease_expires = NULL, "
+            "updated = ? WHERE id = ? AND worker = ? AND state = 'running'",
+            (time.time(), job_id, worker))
+
+
+def counts(connection):
+    """
+    Count the jobs in each state.
+
+    :return dict: A dictionary mapping each state to the number of jobs in it.
+
+    """
+    return {row['state']: row['n'] for row in connection.execute('SELECT state, COUNT(*) AS n FROM jobs GROUP BY state')}
+
+
+def all_jobs(connection):
+    """Get all the jobs, in the order they were queued."""
+    return connection.execute('SELECT * FROM jobs ORDER BY id').fetchall()
+
+
+def run_worker(filename=None, worker=None, lease_s=120, ffmpeg_threads=None, poll_s=10, keep_polling=False,
+               log=sys.stdout):
+    """
+    Run jobs from the queue until there are none left.
+
+    Each job runs in its own process, while the worker renews its lease. If the lease is lost anyway, e.g. because the
+    shared storage was unreachable for too long, the job and its ffmpeg processes are stopped, since another worker
+    has taken it over.
+
+    :param filename: The queue. Defaults to `default_queue_file()`.
+
+    :param worker: The name of this worker. Defaults to the host name and process id.
+
+    :param lease_s: How long a job is held without a heartbeat. Heartbeats are sent four times per lease.
+
+    :param ffmpeg_threads: The number of threads each ffmpeg process may use, see `rc.ffmpeg_threads`.
+
+    :param poll_s: How long to wait before looking again when every job left waits on a job of another worker.
+
+    :param keep_polling: Keep waiting for new jobs when the queue is empty, instead of returning.
+
+    :param log: Where to report progress.
+
+    :return dict: A dictionary mapping 'done', 'failed' and 'retried' to the number of jobs this worker ran with that
+        result.
+
+    """
+    if worker is None:
+        worker = '{}-{}'.format(socket.gethostname(), os.getpid())
+    connection = connect(filename)
+    results = {'done': 0, 'failed': 0, 'retried': 0}
+
+    while True:
+        job = claim(connection, worker, lease_s)
+        if job is None:
+            remaining = counts(connection)
+            if not remaining.get('running'):
+                rcslides.evict(keep_s=lease_s)  # no job on any node is reading the slide cache now
+            if not keep_polling and not remaining.get('waiting') and not remaining.get('running'):
+                return results
+            time.sleep(poll_s)
+            continue
+
+        print("{}: started {} for {} (attempt {} of {})".format(
+            worker, job['stage'], job['name'], job['attempts'], job['max_attempts']), file=log)
+        started = time.time()
+        try:
+            error, retry = _run_leased(connection, job, worker, lease_s, ffmpeg_threads)
+        except KeyboardInterrupt:
+            release(connection, job['id'], worker)
+            raise
+        elapsed = time.time() - started
+
+        if error is _lease_lost:
+            print("{}: lost the lease on {} for {}, leaving it to another worker".format(
+                worker, job['stage'], job['name']), file=log)
+        elif not finish(connection, job['id'], worker, error, retry):
+            print("{}: {} for {} was taken over by another worker".format(worker, job['stage'], job['name']), file=log)
+        elif error is None:
+            results['done'] += 1
+            print("{}: finished {} for {} in {:.0f} s".format(worker, job['stage'], job['name'], elapsed), file=log)
+        else:
+            results['retried' if retry and job['attempts'] < job['max_attempts'] else 'failed'] += 1
+            print("{}: failed {} for {} after {:.0f} s:".format(worker, job['stage'], job['name'], elapsed), file=log)
+            print(error, file=log)
+
+
+def run_local_workers(n_workers, filename=None, **kwargs):
+    """
+    Run several workers on this machine, e.g. to test a queue without other nodes.
+
+    :param n_workers: The number of worker processes.
+
+    :param kwargs: Passed on to `run_worker`.
+
+    :return: The exit codes of the worker processes.
+
+    """
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(filename,), kwargs=kwargs)
+        for _ in range(n_workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return [process.exitcode for process in processes]
+
+
+_lease_lost = object()
+
+
+def _run_leased(connection, job, worker, lease_s, ffmpeg_threads):
+    # Returns the error (None if the job is done, or _lease_lost) and whether it is worth another attempt
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(
+        target=_job_process, args=(job['stage'], job['name'], job['profile'], ffmpeg_threads, sender))
+    process.start()
+    sender.close()
+    try:
+        while not receiver.poll(lease_s / 4):
+            if not process.is_alive():
+                return "The job stopped with exit code {}".format(process.exitcode), True
+            if not heartbeat(connection, job['id'], worker, lease_s):
+                _stop(process)
+                return _lease_lost, False
+        return _receive_result(receiver, process)
+    except BaseException:
+        _stop(process)
+        raise
+    finally:
+        receiver.close()
+
+
+def _receive_result(receiver, process):
+    """
+    Get the result a job process sent, or its exit code if it ended without sending one, e.g. killed for lack of memory.
+
+    >>> receiver, sender = multiprocessing.Pipe(duplex=False)
+    >>> process = multiprocessing.Process(target=os._exit, args=(137,))
+    >>> process.start()
+    >>> sender.close()
+    >>> _receive_result(receiver, process)
+    ('The job stopped with exit code 137', True)
+    """
+    try:
+        result = receiver.recv()
+    except EOFError:  # every end of the pipe that could send was closed
+        process.join()
+        return "The job stopped with exit code {}".format(process.exitcode), True
+    process.join()
+    return result
+
+
+def _job_process(stage, name, profile, ffmpeg_threads, sender):
+    # Its own process group, so that stopping the job also stops the ffmpeg processes it started
+    os.setpgrp()
+    rc.ffmpeg_threads = ffmpeg_threads
+    try:
+        rcbatch._run_job(stage, name, profile)
+    except subprocess.CalledProcessError:
+        sender.send((traceback.format_exc(), True))
+    except Exception:
+        sender.send((traceback.format_exc(), False))
+    else:
+        sender.send((None, False))
+
+
+def _stop(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        process.terminate()  # it had not yet made its own process group
+    process.join()
+
+
+def _expire_leases(connection, now):
+    connection.execute(
+        "UPDATE jobs SET state = CASE WHEN attempts < max_attempts THEN 'waiting' ELSE 'failed' END, "
+        "error = 'The lease of ' || worker || ' ran out', worker = NULL, lease_expires = NULL, updated = ? "
+        "WHERE state = 'running' AND lease_expires < ?",
+        (now, now))
+
+
+@contextlib.contextmanager
+def _transaction(connection):
+    # BEGIN IMMEDIATE takes the write lock up front, so that two workers never claim the same job
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        yield
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
@@ -0,0 +1,261 @@
+"""
+Typed records for the rows of the info spreadsheet.
+
+The spreadsheet gives every cell as a string. These records parse and check each row once, when it is loaded, so that
+a broken row is found before any processing starts rather than hours into a batch run.
+"""
+
+import dataclasses
+import os
+from dataclasses import dataclass
+from fractions import Fraction
+
+
+@dataclass(frozen=True)
+class Parameters:
+    """The global settings from the `parameters` sheet."""
+    __slots__ = ('rc_base_folder', 'output_folder', 'source_fps', 'source_w', 'source_h')
+    rc_base_folder: str
+    output_folder: str
+    source_fps: Fraction  # str() of this is a valid frame rate for ffmpeg, e.g. '25' or '30000/1001'
+    source_w: int
+    source_h: int
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        :param dict row: The `parameters` sheet, as a dictionary of strings.
+
+        >>> Parameters.from_row({'rc_base_folder': '/rc', 'output_folder': '/out', 'source_fps': '25',
+        ...                      'source_w': '1920', 'source_h': '1080'})
+        Parameters(rc_base_folder='/rc', output_folder='/out', source_fps=Fraction(25, 1), source_w=1920, source_h=1080)
+        """
+        parser = _RowParser('parameters', row)
+        return cls(
+            rc_base_folder=parser.text('rc_base_folder'),
+            output_folder=parser.text('output_folder'),
+            source_fps=parser.number('source_fps', Fraction),
+            source_w=parser.number('source_w', int),
+            source_h=parser.number('source_h', int),
+        )
+
+
+@dataclass(frozen=True)
+class Talk:
+    """A row of the `talks` sheet."""
+    __slots__ = (
+        'name', 'cam_input_folder', 'start_video', 'start_time_ms', 'stop_video', 'stop_time_ms',
+        'original_audio_file', 'input_files',
+    )
+    name: str
+    cam_input_folder: str
+    start_video: int
+    start_time_ms: float  # in the first clip
+    stop_video: int
+    stop_time_ms: float  # in the last clip
+    original_audio_file: str  # the microphones recording, or None if it was left blank
+    input_files: tuple  # the absolute filenames of the camera clips, in order
+
+    @classmethod
+    def from_row(cls, row, parameters):
+        """
+        :param dict row: A row of the `talks` sheet, as a dictionary of strings.
+
+        :param Parameters parameters: The global settings, used to find the camera clips.
+
+        >>> p = Parameters('/rc', '/out', Fraction(25), 1920, 1080)
+        >>> t = Talk.from_row({'name': 't', 'cam_input_folder': 'cam', 'start_video': '9', 'start_time_ms': '500',
+        ...                    'stop_video': '10', 'stop_time_ms': '1000', 'original_audio_file': 'a.wav'}, p)
+        >>> t.input_files
+        ('/rc/cam/MVI_0009.MP4', '/rc/cam/MVI_0010.MP4')
+        >>> Talk.from_row({'name': 't', 'start_video': '9', 'start_time_ms': '500', 'stop_video': '8',
+        ...                'stop_time_ms': '1000'}, p)
+        Traceback (most recent call last):
+        ...
+        ValueError: Row 't' in the talks sheet: cam_input_folder is missing.
+        """
+        parser = _RowParser('talks', row)
+        name = parser.text('name')
+        cam_input_folder = parser.text('cam_input_folder')
+        start_video = parser.number('start_video', int)
+        stop_video = parser.number('stop_video', int)
+        if stop_video < start_video:
+            parser.fail('stop_video ({}) is before start_video ({}).'.format(stop_video, start_video))
+        return cls(
+            name=name,
+            cam_input_folder=cam_input_folder,
+            start_video=start_video,
+            start_time_ms=parser.number('start_time_ms', float),
+            stop_video=stop_video,
+            stop_time_ms=parser.number('stop_time_ms', float),
+            original_audio_file=parser.text('original_audio_file', required=False),
+            input_files=clip_filenames(parameters, cam_input_folder, start_video, stop_video),
+        )
+
+
+@dataclass(frozen=True)
+class QACamera:
+    """One of the cameras used during a Q&A session."""
+    __slots__ = ('input_folder', 'start_video', 'stop_video', 'sync_delay_ms', 'input_files')
+    input_folder: str
+    start_video: int
+    stop_video: int
+    sync_delay_ms: float  # how long after camera 1 this camera started (negative if before); 0 for camera 1 itself,
+    # or None if it was left blank, to be found by `rc.sync_qa_cameras`
+    input_files: tuple  # the absolute filenames of the camera clips, in order
+
+
+@dataclass(frozen=True)
+class QASession:
+    """
+    A row of the `qa` sheet.
+
+    A session has two or more cameras: `cam1_...`, `cam2_...`, `cam3_...` and so on. The delay of camera 2 is in the
+    `sync_delay_ms` column, and that of camera 3 and up in `cam3_sync_delay_ms` etc. The delays may be left blank when
+    they are found from the audio (see `rc.sync_qa_cameras`).
+    """
+    __slots__ = ('name', 'cameras', 'start_time_ms', 'stop_time_ms')
+    name: str
+    cameras: tuple  # of QACamera, starting with camera 1
+    start_time_ms: float  # in the first clip of camera 1
+    stop_time_ms: float  # in the last clip of camera 1
+
+    @property
+    def sync_delay_ms(self):
+        """How long after camera 1 camera 2 started."""
+        return self.cameras[1].sync_delay_ms
+
+    def camera_offsets_ms(self):
+        """
+        Get the offset of each camera on a timeline which starts with the camera that started first.
+
+        :return list: For each camera, how long after the first camera it started.
+
+        :raises ValueError: If the delay of a camera is not known.
+
+        >>> cameras = [QACamera('a', 1, 1, delay, ()) for delay in [0., -3235., 1000.]]
+        >>> QASession('qa', tuple(cameras), 0., 1000.).camera_offsets_ms()
+        [3235.0, 0.0, 4235.0]
+        """
+        missing = [i for i, camera in enumerate(self.cameras, 1) if camera.sync_delay_ms is None]
+        if missing:
+            raise ValueError("The sync delay of camera {} of {} is not known. Fill it in in the qa sheet, or find it "
+                             "from the audio with rc.sync_qa_cameras.".format(', '.join(map(str, missing)), self.name))
+        first = min(camera.sync_delay_ms for camera in self.cameras)
+        return [camera.sync_delay_ms - first for camera in self.cameras]
+
+    def with_sync_delays(self, sync_delays_ms):
+        """
+        Get a copy of the session with other sync delays, e.g. found from the audio.
+
+        :param sync_delays_ms: For each camera after camera 1, its delay, or None to keep the one from the sheet.
+
+        :return QASession:
+
+        """
+        cameras = self.cameras[:1] + tuple(
+            camera if delay is None else dataclasses.replace(camera, sync_delay_ms=delay)
+            for camera, delay in zip(self.cameras[1:], sync_delays_ms))
+        return dataclasses.replace(self, cameras=cameras)
+
+    @classmethod
+    def from_row(cls, row, parameters):
+        """
+        :param dict row: A row of the `qa` sheet, as a dictionary of strings.
+
+        :param Parameters parameters: The global settings, used to find the camera clips.
+
+        >>> p = Parameters('/rc', '/out', Fraction(25), 1920, 1080)
+        >>> s = QASession.from_row({'name': 'qa', 'cam1_input_folder': 'a', 'cam2_input_folder': 'b',
+        ...                         'sync_delay_ms': '-3235', 'cam1_start_video': '1', 'cam1_start_time_ms': '0',
+        ...                         'cam1_stop_video': '1', 'cam1_stop_time_ms': '1000', 'cam2_start_video': '5',
+        ...                         'cam2_stop_video': '6'}, p)
+        >>> s.sync_delay_ms
+        -3235.0
+        >>> s.cameras[1].input_files
+        ('/rc/b/MVI_0005.MP4', '/rc/b/MVI_0006.MP4')
+        >>> s = QASession.from_row({'name': 'qa', 'cam1_input_folder': 'a', 'cam2_input_folder': 'b',
+        ...                         'cam3_input_folder': 'c', 'sync_delay_ms': '-3235', 'cam3_sync_delay_ms': '1000',
+        ...                         'cam1_start_video': '1', 'cam1_start_time_ms': '0', 'cam1_stop_video': '1',
+        ...                         'cam1_stop_time_ms': '1000', 'cam2_start_video': '5', 'cam2_stop_video': '6',
+        ...                         'cam3_start_video': '2', 'cam3_stop_video': '2'}, p)
+        >>> [camera.sync_delay_ms for camera in s.cameras]
+        [0.0, -3235.0, 1000.0]
+        """
+        parser = _RowParser('qa', row)
+        name = parser.text('name')
+        cameras = []
+        n_cameras = 2
+        while parser.text('cam{}_input_folder'.format(n_cameras + 1), required=False) is not None:
+            n_cameras += 1
+        for i in range(1, n_cameras + 1):
+            input_folder = parser.text('cam{}_input_folder'.format(i))
+            start_video = parser.number('cam{}_start_video'.format(i), int)
+            stop_video = parser.number('cam{}_stop_video'.format(i), int)
+            if stop_video < start_video:
+                parser.fail('cam{}_stop_video ({}) is before cam{}_start_video ({}).'.format(
+                    i, stop_video, i, start_video))
+            cameras.append(QACamera(
+                input_folder=input_folder,
+                start_video=start_video,
+                stop_video=stop_video,
+                sync_delay_ms=0. if i == 1 else parser.number(
+                    'sync_delay_ms' if i == 2 else 'cam{}_sync_delay_ms'.format(i), float, required=False),
+                input_files=clip_filenames(parameters, input_folder, start_video, stop_video),
+            ))
+        return cls(
+            name=name,
+            cameras=tuple(cameras),
+            start_time_ms=parser.number('cam1_start_time_ms', float),
+            stop_time_ms=parser.number('cam1_stop_time_ms', float),
+        )
+
+
+def clip_filenames(parameters, input_folder, start_video, stop_video):
+    """
+    Get the filenames of a range of camera clips.
+
+    :param Parameters parameters: The global settings.
+
+    :param str input_folder: The folder with the clips, relative to `rc_base_folder`.
+
+    :param int start_video: The number of the first clip.
+
+    :param int stop_video: The number of the last clip.
+
+    :return tuple: The absolute filenames of the clips, in order.
+
+    """
+    return tuple(
+        os.path.join(parameters.rc_base_folder, input_folder, "MVI_{:04d}.MP4".format(i))
+        for i in range(start_video, stop_video + 1)
+    )
+
+
+class _RowParser:
+
+    def __init__(self, sheet, row):
+        self.sheet = sheet
+        self.row = row
+
+    def fail(self, message):
+        if 'name' in self.row:
+            raise ValueError("Row {!r} in the {} sheet: {}".format(self.row['name'], self.sheet, message))
+        raise ValueError("The {} sheet: {}".format(self.sheet, message))
+
+    def text(self, key, required=True):
+        value = self.row.get(key)
+        if value is None or not str(value).strip():
+            if required:
+                self.fail('{} is missing.'.format(key))
+            return None
+        return str(value).strip()
+
+    def number(self, key, parse, required=True):
+        value = self.text(key, required)
+        if value is None:
+            return None
+        try:
+            return parse(value)
+        except (ValueError, ZeroDivisionError):
+            self.fail('{} should be a number, but it is {!r}.'.format(key, value))
@@ -2,15 +2,126 @@
 Most of these functions were copied by Dolf from Dolf's Masters project with permission of Dolf.
 """
 
+import collections
+import contextlib
+import threading
+import time
 import numpy as np
 from scipy.io import wavfile
 import pyfftw
 
 pyfftw.interfaces.cache.enable()
-discrete_convolution_fft_cache = {}
 
 
-def discrete_convolution(x, h):
+class FFTPlanCache:
+    """
+    A cache of pyfftw plans, with their aligned buffers, for `discrete_convolution`.
+
+    Planning is slow, so plans are kept for reuse. Each set of plans is checked out by one caller at a time, so that
+    threads never share buffers; threads that need the same size at the same time simply get their own set. Sets that
+    are not in use are kept in least recently used order, and the oldest ones are dropped when the buffers would take
+    more than `max_bytes`.
+    """
+
+    def __init__(self, max_bytes=512 * 2 ** 20, threads=1):
+        """
+        :param int max_bytes: The most memory to keep in idle buffers.
+
+        :param int threads: The number of threads each FFT may use. Only plans made after changing this are affected.
+        """
+        self.max_bytes = max_bytes
+        self.threads = threads
+        self._idle = collections.OrderedDict()  # (n_fft, threads) -> list of plan sets
+        self._idle_bytes = 0
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def plans(self, n_fft):
+        """
+        Check out the plans for an FFT size.
+
+        :param int n_fft: The FFT size.
+
+        :return: A context manager which gives a tuple (rfft_input, rfft_func, irfft_input, irfft_func).
+
+        """
+        key = (n_fft, self.threads)
+        with self._lock:
+            idle = self._idle.get(key)
+            plans = idle.pop() if idle else None
+            if plans is not None:
+                self._idle_bytes -= _plans_n_bytes(plans)
+                if not idle:
+                    del self._idle[key]
+
+        if plans is None:
+            rfft_input = pyfftw.empty_aligned(n_fft, dtype='float64')
+            rfft_func = pyfftw.builders.rfft(rfft_input, overwrite_input=True, threads=self.threads)
+            irfft_input = pyfftw.empty_aligned((n_fft // 2) + 1, dtype='complex128')
+            irfft_func = pyfftw.builders.irfft(irfft_input, n=n_fft, overwrite_input=True, threads=self.threads)
+            plans = (rfft_input, rfft_func, irfft_input, irfft_func)
+
+        try:
+            yield plans
+        finally:
+            with self._lock:
+                self._idle.setdefault(key, []).append(plans)
+                self._idle.move_to_end(key)
+                self._idle_bytes += _plans_n_bytes(plans)
+                self._evict()
+
+    def clear(self):
+        """Drop all the idle plans."""
+        with self._lock:
+            self._idle.clear()
+            self._idle_bytes = 0
+
+    @property
+    def n_bytes(self):
+        """The memory currently held in idle buffers."""
+        return self._idle_bytes
+
+    def _evict(self):
+        while self._idle_bytes > self.max_bytes and self._idle:
+            key, idle = next(iter(self._idle.items()))
+            self._idle_bytes -= _plans_n_bytes(idle.pop(0))
+            if not idle:
+                del self._idle[key]
+
+
+def _plans_n_bytes(plans):
+    rfft_input, rfft_func, irfft_input, irfft_func = plans
+    return sum(a.nbytes for a in (
+        rfft_func.input_array,
+        rfft_func.output_array,
+        irfft_func.input_array,
+        irfft_func.output_array,
+    ))
+
+
+discrete_convolution_fft_cache = FFTPlanCache()
+
+
+def discrete_convolution(x, h, out=None):
+    """
+    Convolve two signals with FFTs.
+
+    The FFT length is the smallest size that FFTW handles efficiently (a product of small primes), rather than the next
+    power of two, which can be almost twice as long. The spectrum of x is copied straight into the input buffer of the
+    inverse FFT and multiplied with the spectrum of h in place, so apart from the result, nothing is allocated.
+
+    :param np.ndarray x: The first signal.
+
+    :param np.ndarray h: The second signal.
+
+    :param np.ndarray out: An array of length len(x) + len(h) - 1 to write the result to. A new array is returned if this
+        is not given.
+
+    :return: The convolution of x and h.
+
+    >>> discrete_convolution(np.array([1., 2., 3.]), np.array([0., 1., .5]))
+    array([0. , 1. , 2.5, 4. , 1.5])
+    """
     with np.errstate(all='raise'):
 
         if not np.all(np.isfinite(x)):
@@ -19,30 +130,26 @@ def discrete_convolution(x, h):
             raise ValueError("Input signal h contains non-finite values.")
 
         n_fft_min = len(x) + len(h) - 1
-        n_fft = smallest_power_of_two_greater_than(n_fft_min)
-
-        if n_fft not in discrete_convolution_fft_cache:
-            rfft_input = pyfftw.empty_aligned(n_fft, dtype='float64')
-            rfft_func = pyfftw.builders.rfft(rfft_input, overwrite_input=True)
-            irfft_input = pyfftw.empty_aligned((n_fft // 2) + 1, dtype='complex128')
-            irfft_func = pyfftw.builders.irfft(irfft_input, overwrite_input=True)
-            discrete_convolution_fft_cache[n_fft] = (rfft_input, rfft_func, irfft_input, irfft_func)
-        else:
-            rfft_input, rfft_func, irfft_input, irfft_func = discrete_convolution_fft_cache[n_fft]
+        n_fft = pyfftw.next_fast_len(n_fft_min)
+        if out is None:
+            out = np.empty(n_fft_min, dtype='float64')
+        elif out.shape != (n_fft_min,):
+            raise ValueError("out should have shape ({},), but it has shape {}.".format(n_fft_min, out.shape))
 
-        rfft_input[:len(x)] = x
-        rfft_input[len(x):] = 0
-        x_fft = np.copy(rfft_func())  # Need to copy here, since the next call to rfft_func overwrites the output
-        rfft_input[:len(h)] = h
-        rfft_input[len(h):] = 0
-        h_fft = rfft_func()
+        with discrete_convolution_fft_cache.plans(n_fft) as (rfft_input, rfft_func, irfft_input, irfft_func):
+            rfft_input[:len(x)] = x
+            rfft_input[len(x):] = 0
+            irfft_input[:] = rfft_func()  # The next call to rfft_func overwrites its output, so keep this one here
+            rfft_input[:len(h)] = h
+            rfft_input[len(h):] = 0
+            np.multiply(irfft_input, rfft_func(), out=irfft_input)
 
-        irfft_input[:] = np.copy(x_fft * h_fft)
-        return np.copy(irfft_func()[:n_fft_min])
+            out[:] = irfft_func()[:n_fft_min]
+            return out
 
 
-def cross_correlation(x, h):
-    return discrete_convolution(x, h[::-1])
+def cross_correlation(x, h, out=None):
+    return discrete_convolution(x, h[::-1], out=out)
 
 
 def cross_correlation_sample_axis(x, h):
@@ -212,7 +319,7 @@ def windows(
                 min_window_length=min_window_length,
         ):
             snit[axis] = slice(i_start, i_end)
-            yield signal[snit]
+            yield signal[tuple(snit)]
 
     else:
         raise TypeError("signal should be a list or an ndarray.")
@@ -318,19 +425,296 @@ def window_energy(signal, sample_rate, window_duration=1., axis=-1):
     ))
 
 
-def window_energy_from_file(input_filename, window_duration=1.):
+def window_energy_blocks(signal, sample_rate, window_duration=1., max_block_bytes=64 * 2 ** 20):
+    """
+    Calculate the energy in consecutive, non-overlapping windows along the first axis, for all channels at once.
+
+    This gives the same result as `window_energy` with `axis=0`, but the signal (which may be a memory-mapped WAV file)
+    is read in blocks of whole windows. Each block is reshaped to (windows, samples, channels), so the mean is taken by
+    numpy instead of in a Python loop, and memory use is bounded by `max_block_bytes` regardless of the signal length.
+
+    :param np.ndarray signal: An array of shape (samples,) or (samples, channels).
+
+    :param int|float sample_rate: The sample rate of the signal.
+
+    :param float window_duration: The length of each window, in seconds. Samples after the last whole window are
+        ignored.
+
+    :param int max_block_bytes: The (approximate) maximum size of the temporary arrays.
+
+    :return: An array of shape (windows,) or (windows, channels).
+
+    >>> a = np.arange(-12, 12).reshape(12, 2)
+    >>> window_energy_blocks(a, sample_rate=4, window_duration=1.)
+    array([[9., 8.],
+           [2., 2.],
+           [7., 8.]])
+    >>> np.allclose(
+    ...     window_energy_blocks(a, sample_rate=4, window_duration=.75, max_block_bytes=1),
+    ...     np.array(list(window_energy(a, sample_rate=4, window_duration=.75, axis=0))),
+    ... )
+    True
+    """
+    window_n_samples = int(window_duration * sample_rate)
+    n_windows = signal.shape[0] // window_n_samples
+    channel_shape = signal.shape[1:]
+    n_channels = int(np.prod(channel_shape))
+    result = np.empty((n_windows, n_channels), dtype='float64')
+
+    # float32 is exact for 16 bit samples, and halves the memory traffic compared to float64.
+    window_bytes = window_n_samples * n_channels * np.dtype('float32').itemsize
+    windows_per_block = max(1, int(max_block_bytes // window_bytes))
+    ones = np.ones(window_n_samples, dtype='float32')
+
+    for i_start in range(0, n_windows, windows_per_block):
+        i_end = min(n_windows, i_start + windows_per_block)
+        # Convert before taking the absolute value, since abs(-32768) does not fit in an int16.
+        block = np.array(signal[i_start * window_n_samples:i_end * window_n_samples], dtype='float32')
+        np.abs(block, out=block)
+        # Summing each window with a dot product is much faster than .sum(axis=1) over a short channel axis.
+        result[i_start:i_end] = np.dot(ones, block.reshape(i_end - i_start, window_n_samples, n_channels))
+
+    result /= window_n_samples
+    return result.reshape((n_windows,) + channel_shape)
+
+
+def window_energy_from_file(input_filename, window_duration=1., max_block_bytes=64 * 2 ** 20):
     audio_fs, audio_data = wavfile.read(filename=input_filename, mmap=True)
-    return np.array(list(window_energy(audio_data, audio_fs, window_duration=window_duration, axis=0)))
+    return window_energy_blocks(audio_data, audio_fs, window_duration=window_duration, max_block_bytes=max_block_bytes)
 
 
 def correlate_audio_files(input_filename1, input_filename2, window_duration=1., channel=0):
-    e1 = window_energy_from_file(input_filename1, window_duration=window_duration)[:, channel]
-    e2 = window_energy_from_file(input_filename2, window_duration=window_duration)[:, channel]
+    e1 = _channel(window_energy_from_file(input_filename1, window_duration=window_duration), channel)
+    e2 = _channel(window_energy_from_file(input_filename2, window_duration=window_duration), channel)
     conv = cross_correlation(e1, e2)
     t_conv = cross_correlation_time_axis(e1, e2, sample_rate=1./window_duration)
 
     return t_conv, conv
 
 
+def local_cross_correlation(x, h, lag_min, lag_max):
+    """
+    Calculate the cross correlation of x and h, but only for lags in a limited range.
+
+    The result at lag k is sum(x[n + k] * h[n]), as in `cross_correlation`, with x taken as zero outside its range. Only
+    the part of x that can overlap with h at these lags is used, so the FFT is about twice as long as h, instead of as
+    long as x and h together.
+
+    :param np.ndarray x: The signal to search in. It may be memory-mapped, since only a slice is read.
+
+    :param np.ndarray h: The signal to search for.
+
+    :param int lag_min: The smallest lag to calculate, in samples.
+
+    :param int lag_max: The largest lag to calculate, in samples.
+
+    :return: The lags (in samples) and the correlation at each lag.
+
+    >>> x = np.array([0., 1., 3., 2., 0., 5., 1.])
+    >>> h = np.array([1., 3., 2.])
+    >>> lags, c = local_cross_correlation(x, h, -1, 2)
+    >>> lags
+    array([-1,  0,  1,  2])
+    >>> full = cross_correlation(x, h)
+    >>> np.allclose(c, full[np.searchsorted(cross_correlation_sample_axis(x, h), lags)])
+    True
+    """
+    lag_min, lag_max = int(lag_min), int(lag_max)
+    n_segment = lag_max - lag_min + len(h)
+    segment = np.zeros(n_segment, dtype='float64')
+    i_start = max(lag_min, 0)
+    i_end = min(lag_min + n_segment, len(x))
+    if i_end > i_start:
+        segment[i_start - lag_min:i_end - lag_min] = x[i_start:i_end]
+    c = cross_correlation(segment, np.asarray(h, dtype='float64'))
+    return np.arange(lag_min, lag_max + 1), c[len(h) - 1:len(h) + lag_max - lag_min]
+
+
+def estimate_delay(
+        input_filename1,
+        input_filename2,
+        resolutions=(1., .01),
+        search_windows=2,
+        excerpt_duration=30.,
+        channel=0,
+):
+    """
+    Find the delay between two recordings of the same event, coarse to fine.
+
+    The delay is first found by correlating the energy envelopes of the whole recordings at a coarse resolution. It is
+    then refined at each finer resolution, but only for lags within a few windows of the previous estimate. Finally, if
+    the sample rates match, it is refined to a single sample by correlating the raw waveforms of a short excerpt.
+
+    The envelopes are only calculated once, at the finest resolution, and the coarser ones are averaged from that. Their
+    means are removed, so that the correlation peak stands out from the triangle caused by the changing overlap.
+
+    :param input_filename1: The WAV file to search in (e.g. the microphones), which should start before the other.
+
+    :param input_filename2: The WAV file to search for (e.g. the camera audio).
+
+    :param resolutions: The window durations (in seconds) of the energy envelopes, from coarse to fine. Each one should
+        be a multiple of the last one.
+
+    :param search_windows: How many windows (at the previous resolution) to search on either side of the previous
+        estimate.
+
+    :param excerpt_duration: The duration (in seconds) of the excerpt of the second file used for the sample-level
+        refinement. It is taken where the second file is loudest, within the part that overlaps the first file. The
+        sample-level refinement is left out when there is no such part, or when the excerpt is silent. Use None to skip
+        it.
+
+    :param channel: The channel to use in each file.
+
+    :return: The delay in seconds (the time in the first file where the second file starts), and a list with a
+        dictionary for each refinement level, with the 'resolution', 'lags' (in seconds), 'correlation', 'delay' and
+        'elapsed' (the time it took, in seconds).
+
+    >>> import os, tempfile
+    >>> rng = np.random.default_rng(0)
+    >>> fs = 2000
+    >>> loudness = np.repeat(rng.uniform(.05, 1, 400) ** 2, fs // 2)  # changes every half second
+    >>> first = rng.standard_normal(200 * fs) * loudness * 3000
+    >>> # The second file starts 120 s into the first, and its loudest second is after the end of the first
+    >>> second = np.concatenate((first[120 * fs:], rng.standard_normal(2 * fs) * 300, rng.standard_normal(fs) * 6000))
+    >>> folder = tempfile.mkdtemp()
+    >>> for name, signal in [('first', first), ('second', second), ('silent', 0 * second)]:
+    ...     wavfile.write(os.path.join(folder, name + '.wav'), fs, signal.astype(np.int16))
+    >>> delay, levels = estimate_delay(os.path.join(folder, 'first.wav'), os.path.join(folder, 'second.wav'),
+    ...                                excerpt_duration=2.)
+    >>> float(delay), len(levels)
+    (120.0, 3)
+    >>> delay, levels = estimate_delay(os.path.join(folder, 'first.wav'), os.path.join(folder, 'silent.wav'),
+    ...                                excerpt_duration=2.)
+    >>> len(levels)  # no sample level, since the silent excerpt matches nothing
+    2
+    >>> import shutil
+    >>> shutil.rmtree(folder)
+    """
+    t_start = time.time()
+    fs1, data1 = wavfile.read(filename=input_filename1, mmap=True)
+    fs2, data2 = wavfile.read(filename=input_filename2, mmap=True)
+    finest = resolutions[-1]
+    e1 = _channel(window_energy_blocks(data1, fs1, window_duration=finest), channel)
+    e2 = _channel(window_energy_blocks(data2, fs2, window_duration=finest), channel)
+    e1 = e1 - np.mean(e1)
+    e2 = e2 - np.mean(e2)
+
+    levels = []
+    delay = None
+    previous_resolution = None
+    for resolution in resolutions:
+        factor = int(round(resolution / finest))
+        x = _downsample_energy(e1, factor)
+        h = _downsample_energy(e2, factor)
+        if delay is None:
+            lags = cross_correlation_sample_axis(x, h)
+            c = cross_correlation(x, h)
+        else:
+            centre = int(round(delay / resolution))
+            width = int(np.ceil(search_windows * previous_resolution / resolution))
+            lags, c = local_cross_correlation(x, h, centre - width, centre + width)
+        delay = lags[np.argmax(c)] * resolution
+        levels.append({
+            'resolution': resolution,
+            'lags': lags * resolution,
+            'correlation': c,
+            'delay': delay,
+            'elapsed': time.time() - t_start,
+        })
+        previous_resolution = resolution
+        t_start = time.time()
+
+    if excerpt_duration is not None and fs1 == fs2:
+        x = _channel(data1, channel)
+        h = _channel(data2, channel)
+        centre = int(round(delay * fs1))
+        width = int(np.ceil(search_windows * previous_resolution * fs1))
+        # The part of the second file which overlaps the first at every lag searched, if the delay is about right
+        i_min = max(0, width - centre)
+        i_max = min(len(h), len(x) - centre - width)
+        n_excerpt = min(i_max - i_min, int(excerpt_duration * fs2))
+        if n_excerpt > 0:
+            window = finest * fs2
+            loudest = e2[int(np.ceil(i_min / window)):int(i_max / window)]
+            if len(loudest):
+                i_loudest = int((np.argmax(loudest) + np.ceil(i_min / window) + .5) * window)
+            else:
+                i_loudest = (i_min + i_max) // 2
+            i_start = min(max(i_min, i_loudest - n_excerpt // 2), i_max - n_excerpt)
+            excerpt = h[i_start:i_start + n_excerpt]
+
+            # The excerpt starts at i_start in the second file, so shift the lags to line it up with the first file.
+            lags, c = local_cross_correlation(x, excerpt, centre - width + i_start, centre + width + i_start)
+            lags -= i_start
+            # A silent excerpt correlates with nothing, and then the delay of the finer envelope is the best there is
+            if np.max(c) > 0 and np.ptp(c) > 0:
+                delay = lags[np.argmax(c)] / float(fs1)
+                levels.append({
+                    'resolution': 1. / fs1,
+                    'lags': lags / float(fs1),
+                    'correlation': c,
+                    'delay': delay,
+                    'elapsed': time.time() - t_start,
+                })
+
+    return delay, levels
+
+
+def peak_ratio(correlation, exclusion=1):
+    """
+    Compare the highest peak of a correlation to the highest value away from it.
+
+    :param np.ndarray correlation: The correlation, e.g. from `cross_correlation`.
+
+    :param int exclusion: Values within this many samples of the highest peak are considered part of it.
+
+    :return: The ratio of the highest peak to the second highest peak. This is infinite if there is a positive peak
+        but no positive second peak, and 0 if there is no positive peak at all, e.g. when one of the recordings is
+        silent.
+
+    >>> peak_ratio(np.array([0., 1., 2., 8., 3., 4., 1.]))
+    2.0
+    >>> peak_ratio(np.array([0., 1., 2., 8., 3., 4., 1.]), exclusion=2)
+    8.0
+    >>> peak_ratio(np.zeros(100)), peak_ratio(-np.ones(100))
+    (0.0, 0.0)
+    """
+    i_peak = int(np.argmax(correlation))
+    if correlation[i_peak] <= 0:
+        return 0.
+    rest = np.concatenate((correlation[:max(0, i_peak - exclusion)], correlation[i_peak + exclusion + 1:]))
+    second = np.max(rest) if len(rest) else 0.
+    if second <= 0:
+        return float('inf')
+    return float(correlation[i_peak] / second)
+
+
+def peak_confidence(ratio):
+    """
+    Turn a peak ratio into a confidence between 0 and 1.
+
+    :param ratio: The ratio from `peak_ratio`.
+
+    :return: 0 when the peak does not stand out at all, up to 1 when nothing else comes close.
+
+    >>> peak_confidence(4.), peak_confidence(float('inf')), peak_confidence(1.), peak_confidence(0.)
+    (0.75, 1.0, 0.0, 0.0)
+    """
+    if ratio <= 1:
+        return 0.
+    return 1. - 1. / ratio
+
+
+def _channel(signal, channel):
+    return signal[:, channel] if signal.ndim > 1 else signal
+
+
+def _downsample_energy(e, factor):
+    if factor == 1:
+        return e
+    n = len(e) // factor
+    return e[:n * factor].reshape(n, factor).mean(axis=1)
+
+
 def smallest_power_of_two_greater_than(x):
     return int(2 ** np.ceil(np.log2(int(x))))
@@ -0,0 +1,301 @@
+"""
+Render the slides of a talk by piping raw frames into a single encoder.
+
+The concat demuxer decodes every slide image again each time it is shown, and needs the images to be scaled to the
+video size beforehand, since scaling them in a filter graph makes ffmpeg's memory grow with the number of slides. Here
+each image is decoded and scaled once, by a short ffmpeg process, and kept in a small cache of raw frames. Each slide
+is written to the encoder once, when it is shown, and timed by a filter (`timestamps_filter`), and the encoder repeats
+it up to the camera frame rate. The memory used does not depend on the number of slides.
+
+The scaled images are also kept on disk, in a cache shared by all the talks (`cached_slide`). They are stored by the
+hash of the source image and the size, so the same slide is only ever scaled once, even when it is used in several
+talks or a talk is rendered again.
+"""
+
+import collections
+import functools
+import hashlib
+import os
+import subprocess
+import time
+from fractions import Fraction
+
+cache_folder = os.path.join('.rccache', 'slides')
+cache_max_bytes = 2 * 2 ** 30
+
+
+class SlideFrameCache:
+    """
+    Decoded and scaled slide images, as raw yuv420p frames.
+
+    The least recently used frames are dropped when the cache would take more than `max_bytes`, so that talks which go
+    back to earlier slides rarely decode an image twice, without holding every slide in memory.
+    """
+
+    def __init__(self, width, height, max_bytes=128 * 2 ** 20):
+        """
+        :param int width: The width of the video.
+
+        :param int height: The height of the video.
+
+        :param int max_bytes: The most memory to keep in frames.
+        """
+        self.width = width
+        self.height = height
+        self.max_bytes = max_bytes
+        self.decoded = 0  # the number of images decoded, for checking how well the cache works
+        self._frames = collections.OrderedDict()  # filename -> bytes
+        self._n_bytes = 0
+
+    def frame(self, filename):
+        """
+        Get an image as a raw frame, scaled to fit the video and padded with black.
+
+        :param filename: The image file.
+
+        :return bytes: The frame.
+
+        """
+        frame = self._frames.get(filename)
+        if frame is not None:
+            self._frames.move_to_end(filename)
+            return frame
+
+        frame = decode_slide(cached_slide(filename, self.width, self.height), self.width, self.height)
+        self.decoded += 1
+        self._frames[filename] = frame
+        self._n_bytes += len(frame)
+        while self._n_bytes > self.max_bytes and len(self._frames) > 1:
+            _, dropped = self._frames.popitem(last=False)
+            self._n_bytes -= len(dropped)
+        return frame
+
+    def clear(self):
+        """Drop all the frames."""
+        self._frames.clear()
+        self._n_bytes = 0
+
+
+def decode_slide(filename, width, height):
+    """
+    Decode an image and scale it to fit in `width` x `height`, keeping its aspect ratio and padding it with black.
+
+    :return bytes: The image as one raw yuv420p frame.
+
+    """
+    return subprocess.check_output([
+        'ffmpeg',
+        '-v', 'error',
+        '-i', filename,
+        '-vf', ','.join([
+            'scale={}:{}:force_original_aspect_ratio=decrease:flags=lanczos'.format(width, height),
+            'pad={}:{}:(ow-iw)/2:(oh-ih)/2'.format(width, height),
+            'format=yuv420p',
+        ]),
+        '-frames:v', '1',
+        '-f', 'rawvideo',
+        '-',
+    ])
+
+
+def cached_slide(filename, width, height):
+    """
+    Get a copy of a slide image scaled to fit in `width` x `height`, padded with black, as an RGB PNG.
+
+    The copy is made the first time it is asked for, and after that only the source image is hashed. The cache is not
+    trimmed here, since another job may be about to decode any of its images (see `evict`).
+
+    :param filename: The source image.
+
+    :return: The filename of the copy in the cache.
+
+    """
+    cached_filename = os.path.join(cache_folder, '{}_{}x{}.png'.format(_content_hash(filename), width, height))
+    try:
+        os.utime(cached_filename)  # the modification time is the last use, for `evict`
+        return cached_filename
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(cache_folder, exist_ok=True)
+    tmp_filename = '{}.{}.tmp.png'.format(cached_filename[:-len('.png')], os.getpid())
+    subprocess.check_call([
+        'ffmpeg',
+        '-v', 'error',
+        '-y',  # overwrite
+        '-i', filename,
+        '-vf', ','.join([
+            'scale={}:{}:force_original_aspect_ratio=decrease:flags=lanczos'.format(width, height),
+            'pad={}:{}:(ow-iw)/2:(oh-ih)/2'.format(width, height),
+            'format=rgb24',
+        ]),
+        '-frames:v', '1',
+        tmp_filename,
+    ])
+    os.replace(tmp_filename, cached_filename)
+    return cached_filename
+
+
+def evict(max_bytes=None, keep_s=0.):
+    """
+    Remove the least recently used images from the slide cache, until it takes at most `max_bytes`.
+
+    Only call this when no job is running which may read the cache, e.g. between the jobs of a batch run (see
+    `rcbatch.run_jobs` and `rcqueue.run_worker`): a job reads the images all through its slide video.
+
+    :param max_bytes: Defaults to `cache_max_bytes`.
+
+    :param keep_s: Keep the images used in the last this many seconds, e.g. by a job which started on another node
+        while this runs.
+
+    """
+    if max_bytes is None:
+        max_bytes = cache_max_bytes
+    try:
+        entries = list(os.scandir(cache_folder))
+    except FileNotFoundError:
+        return
+    keep_after_ns = time.time_ns() - int(keep_s * 10 ** 9)
+    images = []
+    for e in entries:
+        if not e.name.endswith('.png') or e.name.endswith('.tmp.png'):
+            continue  # not an image, or a copy which is still being made
+        try:
+            st = e.stat()
+        except FileNotFoundError:
+            continue  # removed by another process
+        images.append((st.st_mtime_ns, st.st_size, e.path))
+    total = sum(size for _, size, _ in images)
+    for mtime_ns, size, path in sorted(images):
+        if total <= max_bytes or mtime_ns > keep_after_ns:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # removed by another process
+        total -= size
+
+
+def _content_hash(filename):
+    st = os.stat(filename)
+    return _hash_file(os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=4096)
+def _hash_file(filename, size, mtime_ns):
+    # size and mtime_ns are only part of the key, so that a changed file is hashed again
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def slide_changes(slide_timings, total_duration_ms, fps):
+    """
+    Snap the slide changes to the frame grid of the video.
+
+    :param slide_timings: A list of dictionaries saying which filename should be shown at what time, as returned by
+        `rc.read_slide_timings`. The first slide is shown from the start of the video.
+
+    :param total_duration_ms: The duration of the video. The last slide persists to this time, and slides after it are
+        left out.
+
+    :param Fraction fps: The frame rate of the video.
+
+    :return: A list of (filename, first frame) for each slide shown, and the number of frames in the video. Slides
+        which are replaced on the same frame are left out.
+
+    >>> from datetime import timedelta
+    >>> slides = [{'time': timedelta(seconds=s), 'filename': f} for s, f in [(0, 'a'), (30, 'b'), (31.04, 'a')]]
+    >>> slide_changes(slides, 60000, Fraction(25))
+    ([('a', 0), ('b', 750), ('a', 776)], 1500)
+    """
+    total_frames = round(Fraction(total_duration_ms) / 1000 * fps)
+    starts = [0] + [min(round(Fraction(s['time'].total_seconds()) * fps), total_frames) for s in slide_timings[1:]]
+    stops = starts[1:] + [total_frames]
+    shown = [(s['filename'], start) for s, start, stop in zip(slide_timings, starts, stops) if stop > start]
+    return shown, total_frames
+
+
+def timestamps_filter(frames, fps):
+    """
+    Get a filter which gives the n-th frame sent to the encoder the time of the n-th frame number in `frames`.
+
+    Raw frames on a pipe have no timestamps, so this is what lets each slide be sent once, instead of once for every
+    frame (or every second) it is shown.
+
+    :param frames: The frame numbers, in order.
+
+    :param Fraction fps: The frame rate of the video.
+
+    :return str: A setpts filter.
+
+    >>> timestamps_filter([0, 750, 776, 1500], Fraction(25))
+    "setpts='round((gte(N,1)*750+gte(N,2)*26+gte(N,3)*724)/((25)*TB))'"
+    """
+    steps = ['gte(N,{})*{}'.format(i, b - a) for i, (a, b) in enumerate(zip(frames, frames[1:]), 1)]
+    return "setpts='round(({})/(({})*TB))'".format('+'.join(steps) or '0', fps)
+
+
+def render_slides(slide_timings, total_duration_ms, fps, encoder_command, width, height, cache=None, progress=None):
+    """
+    Encode the slides of a talk into a video.
+
+    Each slide is written to the encoder once, when it is shown, with the time of the slide change (see
+    `timestamps_filter`), and the encoder repeats it up to the frame rate of the video. The last slide is written once
+    more at the end of the video, so that it lasts until then.
+
+    :param slide_timings: A list of dictionaries saying which filename should be shown at what time.
+
+    :param total_duration_ms: The duration of the video. The last slide persists to this time.
+
+    :param Fraction fps: The frame rate of the video.
+
+    :param encoder_command: A function which takes the input options for the raw frames and the output options which
+        time them (two lists), and returns the full ffmpeg command, which should read the frames from stdin.
+
+    :param int width: The width of the video.
+
+    :param int height: The height of the video.
+
+    :param SlideFrameCache cache: The cache to use, e.g. to share frames between talks. Defaults to a new one.
+
+    :param rcprogress.FfmpegProgress progress: Report the progress of the encoder and record its metrics with this.
+
+    :return SlideFrameCache: The cache, which also tells how many images were decoded.
+
+    """
+    if cache is None:
+        cache = SlideFrameCache(width, height)
+    shown, total_frames = slide_changes(slide_timings, total_duration_ms, fps)
+    shown.append((shown[-1][0], total_frames))
+
+    command = encoder_command([
+        '-f', 'rawvideo',
+        '-pix_fmt', 'yuv420p',
+        '-video_size', '{}x{}'.format(width, height),
+        '-framerate', str(fps),
+        '-i', '-',
+    ], [
+        '-vf', '{},fps={}'.format(timestamps_filter([start for _, start in shown], fps), fps),
+        '-frames:v', str(total_frames),
+    ])
+    if progress is None:
+        encoder = subprocess.Popen(command, stdin=subprocess.PIPE)
+    else:
+        encoder = progress.popen(command, stdin=subprocess.PIPE)
+    try:
+        for filename, _ in shown:
+            encoder.stdin.write(cache.frame(filename))
+    except BrokenPipeError:
+        pass  # the encoder stopped early, which is reported below
+    finally:
+        try:
+            encoder.stdin.close()
+        except BrokenPipeError:
+            pass
+        return_code = encoder.wait() if progress is None else progress.wait()
+    if return_code != 0:
+        raise subprocess.CalledProcessError(return_code, command)
+    return cache
@@ -0,0 +1,250 @@
+"""
+Timing tracks: which stream or slide is shown from what time.
+
+The timing programs write one line per change, like `0:00:58->1` or `0:01:03->002.png`. The lines are parsed without
+`datetime.strptime`, cleaned up in a single pass, and kept as a `TimingTrack`: a sorted array of times (in ms) with
+the value shown from each time, so that "what is on screen at time t" is a binary search.
+
+Besides whole seconds, times may have milliseconds (`0:00:58.480`) or a frame number (`0:00:58:12`, the 12th frame
+after 0:00:58), so that a cut can be placed on the exact frame. The writers for ffmpeg snap the times to the frame
+grid of the video (`frame_at`, `format_frame_time`). Proposed timings are written in the same format
+(`write_timing_file`).
+"""
+
+import bisect
+import math
+from array import array
+from fractions import Fraction
+
+
+class TimingTrack:
+    """
+    A sorted sequence of (time in ms, value) changes. Each value is shown from its time until the next change.
+    """
+    __slots__ = ('times', 'values')
+
+    def __init__(self, changes=()):
+        """
+        :param changes: (time in ms, value) pairs, in order of time.
+
+        :raises ValueError: If the times go backwards.
+        """
+        self.times = array('q')
+        self.values = []
+        for time_ms, value in changes:
+            if self.times and time_ms < self.times[-1]:
+                raise ValueError("The time {} is before the time before it, {}.".format(
+                    format_time(time_ms), format_time(self.times[-1])))
+            self.times.append(time_ms)
+            self.values.append(value)
+
+    def __len__(self):
+        return len(self.times)
+
+    def __iter__(self):
+        return zip(self.times, self.values)
+
+    def __repr__(self):
+        return 'TimingTrack({!r})'.format(list(self))
+
+    def index_at(self, time_ms):
+        """
+        Get the index of the change in effect at a time.
+
+        :return: The index, or -1 if the time is before the first change.
+
+        """
+        return bisect.bisect_right(self.times, time_ms) - 1
+
+    def at(self, time_ms, default=None):
+        """
+        Get the value shown at a time.
+
+        :param time_ms: The time, in ms.
+
+        :param default: What to return before the first change.
+
+        >>> track = TimingTrack([(0, 'slides'), (1000, 'camera'), (58000, 'slides')])
+        >>> track.at(999), track.at(1000), track.at(10 ** 9)
+        ('slides', 'camera', 'slides')
+        """
+        i = self.index_at(time_ms)
+        return default if i < 0 else self.values[i]
+
+    def between(self, start_ms, stop_ms):
+        """
+        Get the changes in a time range: the one in effect at `start_ms` (moved to `start_ms`), followed by the ones
+        after it up to, but not including, `stop_ms`.
+
+        >>> TimingTrack([(0, 'a'), (10, 'b'), (20, 'c')]).between(5, 20)
+        TimingTrack([(5, 'a'), (10, 'b')])
+        """
+        i = max(self.index_at(start_ms), 0)
+        j = bisect.bisect_left(self.times, stop_ms)
+        changes = [(max(t, start_ms), v) for t, v in zip(self.times[i:j], self.values[i:j])]
+        return TimingTrack(changes)
+
+
+def parse_time(text, fps=None):
+    """
+    Parse a time like `H:MM:SS`, `H:MM:SS.mmm` or `H:MM:SS:FF`, where FF is a frame number.
+
+    :param str text: The time.
+
+    :param Fraction fps: The frame rate, which is needed for times with a frame number.
+
+    :return int: The time in ms. Times with a frame number are rounded to the nearest ms, which is always closer to that
+        frame than to any other.
+
+    :raises ValueError: If the time is not in one of these forms.
+
+    >>> parse_time('0:00:58'), parse_time('1:02:03.5'), parse_time('0:00:00.125')
+    (58000, 3723500, 125)
+    >>> parse_time('0:00:58:12', fps=Fraction(25)), parse_time('0:00:00:01', fps=Fraction(30000, 1001))
+    (58480, 33)
+    >>> parse_time('0:61:00')
+    Traceback (most recent call last):
+    ...
+    ValueError: '0:61:00' is not a time like H:MM:SS, H:MM:SS.mmm or H:MM:SS:FF.
+    >>> parse_time('0:00:01:25', fps=Fraction(25))
+    Traceback (most recent call last):
+    ...
+    ValueError: '0:00:01:25' has a frame number of 25, but there are only 25 frames per second.
+    """
+    try:
+        hours, minutes, seconds, *frames = text.split(':')
+        seconds, _, fraction = seconds.partition('.')
+        if len(minutes) != 2 or len(seconds) != 2 or len(fraction) > 3 or (_ and not fraction):
+            raise ValueError
+        if frames and (fraction or len(frames) > 1 or not frames[0].isdigit()):
+            raise ValueError
+        hours, minutes, seconds = int(hours), int(minutes), int(seconds)
+        ms = int(fraction.ljust(3, '0')) if fraction else 0
+        if hours < 0 or not (0 <= minutes < 60 and 0 <= seconds < 60 and 0 <= ms):
+            raise ValueError
+    except ValueError:
+        raise ValueError("{!r} is not a time like H:MM:SS, H:MM:SS.mmm or H:MM:SS:FF.".format(text)) from None
+
+    time_ms = ((hours * 60 + minutes) * 60 + seconds) * 1000 + ms
+    if frames:
+        if fps is None:
+            raise ValueError("{!r} has a frame number, which needs a frame rate.".format(text))
+        frame = int(frames[0])
+        if frame >= math.ceil(fps):
+            raise ValueError("{!r} has a frame number of {}, but there are only {} frames per second.".format(
+                text, frame, fps))
+        time_ms += round(frame * 1000 / Fraction(fps))
+    return time_ms
+
+
+def frame_at(time_ms, fps):
+    """
+    Get the frame of a video which is shown at a time, rounding to the nearest frame.
+
+    >>> frame_at(58480, Fraction(25)), frame_at(33, Fraction(30000, 1001)), frame_at(58499, Fraction(25))
+    (1462, 1, 1462)
+    """
+    return round(Fraction(time_ms) * Fraction(fps) / 1000)
+
+
+def format_frame_time(frame, fps):
+    """
+    Format the time of a frame for ffmpeg, like `H:MM:SS.uuuuuu`.
+
+    The time is rounded down to the microsecond, so that a command given for this time applies from this frame on,
+    and not from the frame after it.
+
+    >>> format_frame_time(1462, Fraction(25)), format_frame_time(1, Fraction(30000, 1001))
+    ('0:00:58.480000', '0:00:00.033366')
+    """
+    microseconds = math.floor(Fraction(frame) / Fraction(fps) * 10 ** 6)
+    seconds, microseconds = divmod(microseconds, 10 ** 6)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}.{:06d}'.format(hours, minutes, seconds, microseconds)
+
+
+def format_time(time_ms):
+    """
+    Format a time in ms like `H:MM:SS.mmm`, leaving out the ms when they are 0.
+
+    >>> format_time(58000), format_time(3723500)
+    ('0:00:58', '1:02:03.500')
+    """
+    seconds, ms = divmod(int(time_ms), 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    text = '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+    return text + '.{:03d}'.format(ms) if ms else text
+
+
+def clean_changes(changes):
+    """
+    Clean up the changes written by the timing programs, in a single pass.
+
+    When there are several changes at the same time, only the last one counts. After that, a change to the value that
+    is already shown does nothing, so it is dropped.
+
+    :param changes: (time in ms, value) pairs, in order of time.
+
+    :return list: The cleaned up pairs.
+
+    >>> clean_changes([(0, 1), (1, 2), (58, 1), (59, 1), (70, 2), (70, 1), (80, 2)])
+    [(0, 1), (1, 2), (58, 1), (80, 2)]
+    """
+    cleaned = []
+    for time_ms, value in changes:
+        if cleaned and cleaned[-1][0] == time_ms:
+            cleaned.pop()
+        if not cleaned or cleaned[-1][1] != value:
+            cleaned.append((time_ms, value))
+    return cleaned
+
+
+def read_timing_file(filename, parse_value=str, fps=None):
+    """
+    Read the output of one of Simon's timing programs.
+
+    :param filename: The timing file, with lines like `0:00:58->1`, `0:00:58.480->1` or `0:00:58:12->1`.
+
+    :param parse_value: A function to interpret the part after the arrow.
+
+    :param Fraction fps: The frame rate of the video, for times with a frame number.
+
+    :return TimingTrack: The cleaned up changes.
+
+    :raises ValueError: If a line cannot be read, or the times go backwards.
+
+    """
+    changes = []
+    with open(filename, 'r') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                time_text, value = line.split('->')
+                changes.append((parse_time(time_text, fps), parse_value(value)))
+            except (ValueError, KeyError) as e:
+                raise ValueError("{}, line {}: {}".format(filename, line_number, e)) from None
+            if len(changes) > 1 and changes[-1][0] < changes[-2][0]:
+                raise ValueError("{}, line {}: {} is before the line before it.".format(
+                    filename, line_number, time_text))
+    return TimingTrack(clean_changes(changes))
+
+
+def write_timing_file(filename, changes, format_value=str):
+    """
+    Write changes in the format of the timing programs, so that `read_timing_file` and the timing programs can read
+    them.
+
+    :param filename: The timing file.
+
+    :param changes: (time in ms, value) pairs, in order of time.
+
+    :param format_value: A function to write the part after the arrow.
+
+    """
+    with open(filename, 'w') as f:
+        for time_ms, value in changes:
+            f.write('{}->{}\n'.format(format_time(time_ms), format_value(value)))
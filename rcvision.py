@@ -0,0 +1,229 @@
+"""
+Propose timings for a talk from the camera video, as a starting point for the timing programs.
+
+The camera video is decoded once at a low resolution and a low frame rate, as grey frames, into one numpy array. Slide
+changes are found as steps in the picture: a frame which differs a lot from the one before it, after which the picture
+stays the same (`detect_changes`), unlike a speaker walking through the picture. The picture after each step is then
+matched against all the slide images at once, by normalised correlation (`match_slides`). When no slide matches well,
+e.g. because the projection screen is not in the picture, the next slide is assumed.
+
+The stream switches follow from the slide changes: the slides are shown for a while after each change, and the camera
+the rest of the time (`propose_stream_switches`).
+
+Everything here works on whole arrays of frames, in blocks so that an hour of video does not need several copies of
+itself in memory.
+"""
+
+import numpy as np
+
+# The size and rate of the frames analysed. Slides and speakers are still easy to tell apart at this size.
+frame_width = 128
+frame_height = 72
+sample_fps = 2
+
+_block_frames = 1024
+
+
+def read_frames(stream, width=frame_width, height=frame_height, expected_frames=0):
+    """
+    Read grey raw frames one at a time, e.g. from ffmpeg writing `-f rawvideo -pix_fmt gray -` (see
+    `rc.read_ffmpeg_output`), so that only the frames are kept in memory and not the whole output as well.
+
+    :param stream: A binary file.
+
+    :param int expected_frames: The number of frames to make room for up front. More room is made as needed.
+
+    :return np.ndarray: The frames, with shape (number of frames, height, width) and dtype uint8. An incomplete last
+        frame is left out.
+
+    >>> import io
+    >>> read_frames(io.BytesIO(bytes(range(13))), width=3, height=2).tolist()
+    [[[0, 1, 2], [3, 4, 5]], [[6, 7, 8], [9, 10, 11]]]
+    """
+    frames = np.empty((max(expected_frames, 1), height, width), dtype=np.uint8)
+    n_frames = 0
+    while True:
+        if n_frames == len(frames):
+            frames = np.concatenate([frames, np.empty_like(frames)])
+        frame = memoryview(frames[n_frames]).cast('B')
+        size = 0
+        while size < len(frame):
+            n_read = stream.readinto(frame[size:])
+            if not n_read:
+                return frames[:n_frames]
+            size += n_read
+        n_frames += 1
+
+
+def frame_differences(frames, lag=1):
+    """
+    Measure how much the picture changed at each frame.
+
+    :param np.ndarray frames: The frames, with shape (n, height, width).
+
+    :param int lag: Compare each frame with the one this many frames before it.
+
+    :return np.ndarray: The mean absolute difference of each frame with the one `lag` frames before it, or 0 for the
+        first frames, which have none.
+
+    >>> frames = np.zeros((6, 2, 2), dtype=np.uint8)
+    >>> frames[3:] = 100
+    >>> frame_differences(frames).tolist(), frame_differences(frames, lag=2).tolist()
+    ([0.0, 0.0, 0.0, 100.0, 0.0, 0.0], [0.0, 0.0, 0.0, 100.0, 100.0, 0.0])
+    """
+    differences = np.zeros(len(frames), dtype=np.float32)
+    for start in range(lag, len(frames), _block_frames):
+        stop = min(start + _block_frames, len(frames))
+        block = frames[start - lag:stop].astype(np.int16)
+        differences[start:stop] = np.abs(block[lag:] - block[:-lag]).mean(axis=(1, 2))
+    return differences
+
+
+def detect_changes(frames, fps=sample_fps, sensitivity=6., min_gap_s=2., persistence=2):
+    """
+    Find the frames where the picture steps to something else and stays there, like a slide change.
+
+    :param np.ndarray frames: The frames, with shape (n, height, width).
+
+    :param fps: The frame rate of the frames.
+
+    :param sensitivity: How far above the usual frame difference a step must be, in median absolute deviations.
+
+    :param min_gap_s: The shortest time between two changes. Of several steps closer together, the biggest counts.
+
+    :param int persistence: How many frames the picture should stay the same after a step.
+
+    :return list: The indices of the frames where the changes happen.
+
+    >>> rng = np.random.default_rng(0)
+    >>> frames = rng.integers(0, 8, (40, 4, 4)).astype(np.uint8)  # noise
+    >>> frames[10:] += 100  # a change which stays
+    >>> frames[25] += 100  # a flash, which does not
+    >>> detect_changes(frames)
+    [10]
+    """
+    n = len(frames)
+    step = frame_differences(frames)
+    # How much the picture changes in the frames after each frame, and between the frames some time before and after
+    # it, which is small for a flash or something passing by
+    after = np.full(n, np.inf, dtype=np.float32)
+    across = np.zeros(n, dtype=np.float32)
+    after[:n - persistence] = frame_differences(frames, persistence)[persistence:]
+    across[:n - persistence] = frame_differences(frames, 2 * persistence + 1)[persistence:]
+
+    median = np.median(step)
+    threshold = median + sensitivity * max(np.median(np.abs(step - median)), 1.)
+    # A step which stays, rather than something passing by or a flash
+    candidates = np.flatnonzero((step > threshold) & (after < step / 2) & (across > step / 2))
+
+    changes = []
+    min_gap = max(1, int(round(min_gap_s * fps)))
+    for i in candidates[np.argsort(-step[candidates], kind='stable')]:
+        if all(abs(i - j) >= min_gap for j in changes):
+            changes.append(int(i))
+    return sorted(changes)
+
+
+def standardize(images):
+    """
+    Flatten images and scale each to zero mean and unit length, so that the dot product of two of them is their
+    normalised correlation.
+
+    :param np.ndarray images: The images, with shape (n, height, width).
+
+    :return np.ndarray: An array with shape (n, height * width) and dtype float32.
+
+    """
+    flat = images.reshape(len(images), -1).astype(np.float32)
+    flat -= flat.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(flat, axis=1, keepdims=True)
+    flat /= np.maximum(norms, 1e-6)  # a uniform image matches nothing
+    return flat
+
+
+def match_slides(frames, slides):
+    """
+    Find the slide which looks most like each frame.
+
+    :param np.ndarray frames: The frames, with shape (n, height, width).
+
+    :param np.ndarray slides: The slide images, scaled and padded to the frame size, with shape (m, height, width).
+
+    :return: Two arrays of length n: the index of the best slide, and its normalised correlation with the frame (from -1
+        to 1).
+
+    >>> slides = np.array([[[0, 9], [0, 9]], [[9, 0], [0, 0]]], dtype=np.uint8)
+    >>> best, score = match_slides(slides[[1, 0, 0]] + 1, slides)
+    >>> best.tolist(), np.round(score, 2).tolist()
+    ([1, 0, 0], [1.0, 1.0, 1.0])
+    """
+    s = standardize(slides)
+    best = np.zeros(len(frames), dtype=np.int64)
+    score = np.zeros(len(frames), dtype=np.float32)
+    for start in range(0, len(frames), _block_frames):
+        correlation = standardize(frames[start:start + _block_frames]) @ s.T
+        best[start:start + len(correlation)] = np.argmax(correlation, axis=1)
+        score[start:start + len(correlation)] = np.max(correlation, axis=1)
+    return best, score
+
+
+def propose_slide_changes(frames, slides, slide_names, fps=sample_fps, min_match=.5, persistence=2):
+    """
+    Propose when each slide is shown.
+
+    :param np.ndarray frames: The frames of the camera, with shape (n, height, width), from the start of the talk.
+
+    :param np.ndarray slides: The slide images, scaled and padded to the frame size, in the order of the talk.
+
+    :param slide_names: The value to write for each slide, e.g. its filename.
+
+    :param fps: The frame rate of the frames.
+
+    :param min_match: The lowest normalised correlation at which a frame is taken to show a slide. Below it, a change
+        is taken to be the next slide.
+
+    :param int persistence: The number of frames after a change that are compared with the slides.
+
+    :return list: (time in ms, slide name) pairs, starting with the first slide at 0.
+
+    """
+    if not len(slides):
+        return []
+    changes = [0] + [i for i in detect_changes(frames, fps, persistence=persistence) if i > 0]
+    best, score = match_slides(frames, slides)
+
+    proposal = []
+    current = -1
+    for i in changes:
+        window = slice(i, i + persistence + 1)
+        # The slide which matches best for most of the frames after the change
+        candidates, counts = np.unique(best[window], return_counts=True)
+        slide = int(candidates[np.argmax(counts)])
+        if score[window][best[window] == slide].mean() < min_match:
+            slide = min(current + 1, len(slides) - 1)
+        if slide != current:
+            proposal.append((int(round(i * 1000 / fps)), slide_names[slide]))
+            current = slide
+    return proposal
+
+
+def propose_stream_switches(slide_changes, slide_hold_ms=15000):
+    """
+    Propose when to show the slides and when the camera: the slides from every slide change for `slide_hold_ms`, and
+    the camera the rest of the time.
+
+    :param slide_changes: (time in ms, slide) pairs, as from `propose_slide_changes`.
+
+    :return list: (time in ms, 'slides' or 'camera') pairs.
+
+    >>> propose_stream_switches([(0, 'a'), (5000, 'b'), (60000, 'c')], slide_hold_ms=15000)
+    [(0, 'slides'), (20000, 'camera'), (60000, 'slides'), (75000, 'camera')]
+    """
+    switches = []
+    for time_ms, _ in slide_changes:
+        if switches and switches[-1][1] == 'camera' and switches[-1][0] >= time_ms:
+            switches.pop()  # the slides are still shown
+        else:
+            switches.append((time_ms, 'slides'))
+        switches.append((time_ms + slide_hold_ms, 'camera'))
+    return switches
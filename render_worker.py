@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+
+import argparse
+
+import rcqueue
+
+parser = argparse.ArgumentParser(description="Render jobs from the shared work queue (see queue_conference.py) until "
+                                             "it is empty. Run one on each machine that should help.")
+parser.add_argument('--queue', default=None, help="The queue database. Defaults to one in the output folder.")
+parser.add_argument('--processes', type=int, default=1,
+                    help="The number of workers to run on this machine, each taking its own jobs.")
+parser.add_argument('--threads', type=int, default=None, help="The number of threads for each ffmpeg process.")
+parser.add_argument('--lease', type=float, default=120, help="How long a job is held without a heartbeat, in s.")
+parser.add_argument('--keep-polling', action='store_true', help="Wait for new jobs when the queue is empty.")
+args = parser.parse_args()
+
+options = dict(lease_s=args.lease, ffmpeg_threads=args.threads, keep_polling=args.keep_polling)
+if args.processes == 1:
+    results = rcqueue.run_worker(args.queue, **options)
+    print("Done: {done}, failed: {failed}, retried: {retried}".format(**results))
+    exit(1 if results['failed'] else 0)
+else:
+    exit_codes = rcqueue.run_local_workers(args.processes, args.queue, **options)
+    exit(1 if any(exit_codes) else 0)
@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+
+import argparse
+
+import rc
+import rcprogress
+
+parser = argparse.ArgumentParser(description="Show where the encoding time went, from the metrics that every ffmpeg "
+                                             "command records.")
+parser.add_argument('--metrics', default=None, help="The metrics file. Defaults to the one in the output folder.")
+parser.add_argument('--by', action='append', dest='keys',
+                    help="Group by this field, e.g. stage, preset, name or threads. May be repeated. "
+                         "Defaults to stage and preset.")
+args = parser.parse_args()
+
+keys = args.keys or ['stage', 'preset']
+records = rcprogress.read_metrics(args.metrics or rc.get_metrics_file())
+print("{:<48} {:>8} {:>7} {:>10} {:>10} {:>7} {:>9}".format(
+    ' / '.join(keys), 'commands', 'failed', 'wall (s)', 'CPU (s)', 'speed', 'peak MiB'))
+for group in rcprogress.summarize(records, keys):
+    print("{:<48} {:>8} {:>7} {:>10.0f} {:>10.0f} {:>6.2f}x {:>9}".format(
+        ' / '.join(str(group[k]) for k in keys), group['commands'], group['failed'], group['elapsed_s'],
+        group['cpu_s'], group['speed'] or 0., '?' if group['peak_rss_mib'] is None else round(group['peak_rss_mib'])))
@@ -0,0 +1,13 @@
+#!/usr/bin/env python3
+
+import rc
+import sys
+
+qa_name = sys.argv[1]
+
+print("Syncing the cameras of Q&A session {}".format(qa_name))
+
+report = rc.sync_qa_cameras(qa_name)
+
+for camera in report['cameras']:
+    print("Camera {camera}: delay {sync_delay_ms:.0f} ms, confidence {confidence:.2f}".format(**camera))